@@ -0,0 +1,611 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import httpx
+import joblib
+import numpy as np
+import uvicorn
+import main
+from scoring import NumpyScorer, OnnxScorer, export_onnx
+from serve import child_pids, memory_usage
+
+
+# ====================
+# = Stand-in for a   =
+# = Remote DynamoDB  =
+# ====================
+class SlowTable:
+    # In-memory table whose calls block for `latency_ms`,
+    # like a boto3 call waiting on the network.
+    def __init__(self, name="Bench_Cache", latency_ms=20.0):
+        self.name = name
+        self.table_name = name
+        self.table_status = "ACTIVE"
+        self.latency = latency_ms / 1000.0
+        self._storage = {}
+        self.reads = 0
+        self.meta = types.SimpleNamespace(
+            client=types.SimpleNamespace(batch_get_item=self._batch_get,
+                                         batch_write_item=self._batch_put))
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def get_item(self, Key):
+        self.reads += 1
+        self._wait()
+        item = self._storage.get(Key["text_hash"])
+        return {"Item": item} if item is not None else {}
+
+    def put_item(self, Item):
+        self._wait()
+        self._storage[Item["text_hash"]] = Item
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def _batch_get(self, RequestItems):
+        self.reads += 1
+        self._wait()
+        keys = RequestItems[self.name]["Keys"]
+        items = [self._storage[k["text_hash"]] for k in keys
+                 if k["text_hash"] in self._storage]
+        return {"Responses": {self.name: items}, "UnprocessedKeys": {}}
+
+    def _batch_put(self, RequestItems):
+        self._wait()
+        for req in RequestItems[self.name]:
+            item = req["PutRequest"]["Item"]
+            self._storage[item["text_hash"]] = item
+        return {"UnprocessedItems": {}}
+
+
+# ===========
+# = Helpers =
+# ===========
+def load_texts(path, limit=None):
+    # test_data.json is one JSON list, the log files are JSON lines
+    with open(path, "r", encoding="utf-8") as f:
+        head = f.read(1)
+        f.seek(0)
+        if head == "[":
+            rows = [(r["text"], r["bought"]) for r in json.load(f)]
+        else:
+            rows = []
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # blank or half-written line
+                # older logs call the label true_sentiment
+                label = r.get("true_record") or r.get("true_sentiment")
+                rows.append((r["request_text"], label))
+    return rows[:limit] if limit else rows
+
+
+def latency_summary(latencies, wall):
+    arr = np.asarray(latencies) * 1000.0
+    return {
+        "requests": len(arr),
+        "throughput_rps": round(len(arr) / wall, 1) if wall else 0.0,
+        "p50_ms": round(float(np.percentile(arr, 50)), 2),
+        "p95_ms": round(float(np.percentile(arr, 95)), 2),
+        "p99_ms": round(float(np.percentile(arr, 99)), 2),
+        "max_ms": round(float(arr.max()), 2)}
+
+
+class ServerThread:
+    # Run the app with uvicorn on its own thread and event loop,
+    # so a blocked server loop does not also stall the clients.
+    def __init__(self, app):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        config = uvicorn.Config(app, host="127.0.0.1", port=self.port,
+                                log_level="warning", lifespan="off")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+        return False
+
+
+async def drive(base_url, payloads, clients, path="/predict"):
+    # `clients` concurrent callers share the payload list
+    latencies = []
+    todo = list(payloads)
+    todo.reverse()
+    limits = httpx.Limits(max_connections=clients)
+
+    async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=60.0,
+            headers={"X-Traffic-Source": "benchmark"}) as client:
+        async def worker():
+            while todo:
+                payload = todo.pop()
+                start = time.perf_counter()
+                resp = await client.post(path, json=payload)
+                resp.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(clients)))
+        wall = time.perf_counter() - start
+    return latencies, wall
+
+
+def install_model(model):
+    holder = main.ModelHolder()
+    holder.install(model, "bench")
+    main.MODEL_HOLDER = holder
+
+
+def install_table(table, budget_ms=0, breaker=None):
+    # no lookup budget and no breaker unless a bench asks for them,
+    # so every lookup waits for the table
+    handle = main.StoreHandle(
+        table_name=table.name,
+        breaker=breaker or main.CircuitBreaker(enabled=False))
+    handle.install(main.DynamoStore(table))
+    main.STORE = handle
+    main.STORE_LOOKUP_BUDGET_MS = budget_ms
+
+
+# ====================
+# = Event Loop Bench =
+# ====================
+async def _inline(func, *args):
+    # the old handler: blocking calls run right on the event loop
+    return func(*args)
+
+
+def bench_event_loop(args):
+    model = joblib.load(args.model)
+    install_model(model)
+    main.LOG_PATH = os.path.join(tempfile.mkdtemp(), "bench_logs.json")
+    rows = load_texts(args.data, limit=args.requests)
+    payloads = [{"text": text, "bought": label} for text, label in rows]
+
+    offloaded = (main.run_io, main.run_scoring)
+    results = {}
+    # inline: the old handler, offloaded: thread pools but the log
+    # write still in the response path, write-behind: queued log writes
+    for mode in ["inline", "offloaded", "write-behind"]:
+        if mode == "inline":
+            main.run_io, main.run_scoring = _inline, _inline
+        else:
+            main.run_io, main.run_scoring = offloaded
+        install_table(SlowTable(latency_ms=args.ddb_latency_ms))
+        main.LOCAL_CACHE = main.LocalCache(max_size=0)
+        main.LOG_WRITER = main.LogWriter()
+        if mode == "write-behind":
+            main.LOG_WRITER.start()
+        with ServerThread(main.app) as server:
+            latencies, wall = asyncio.run(drive(server.url, payloads,
+                                                args.clients))
+        main.LOG_WRITER.stop()
+        results[mode] = latency_summary(latencies, wall)
+        print(f"{mode:>12}: {results[mode]}")
+    main.run_io, main.run_scoring = offloaded
+    return results
+
+
+# ====================
+# = Cache Tier Bench =
+# ====================
+def bench_cache_tier(args):
+    # repetitive traffic: every text is asked `repeat` times
+    model = joblib.load(args.model)
+    install_model(model)
+    main.LOG_PATH = os.path.join(tempfile.mkdtemp(), "bench_logs.json")
+    rows = load_texts(args.data, limit=args.requests)
+    payloads = [{"text": text, "bought": label}
+                for text, label in rows] * args.repeat
+    np.random.default_rng(0).shuffle(payloads)
+
+    results = {}
+    modes = [("dynamodb-only", 0), ("memory+dynamodb", args.cache_size)]
+    for mode, size in modes:
+        table = SlowTable(latency_ms=args.ddb_latency_ms)
+        install_table(table)
+        main.LOCAL_CACHE = main.LocalCache(max_size=size)
+        main.LOG_WRITER = main.LogWriter()
+        main.LOG_WRITER.start()
+        with ServerThread(main.app) as server:
+            latencies, wall = asyncio.run(drive(server.url, payloads,
+                                                args.clients))
+        main.LOG_WRITER.stop()
+        results[mode] = latency_summary(latencies, wall)
+        results[mode]["ddb_reads"] = table.reads
+        results[mode]["local_cache"] = main.LOCAL_CACHE.status()
+        print(f"{mode:>16}: {results[mode]}")
+    return results
+
+
+# ==================
+# = Degraded Bench =
+# ==================
+def bench_degraded(args):
+    # /predict while DynamoDB answers in --ddb-latency-ms: waiting
+    # for every call vs. the lookup budget vs. budget + breaker
+    model = joblib.load(args.model)
+    install_model(model)
+    main.LOG_PATH = os.path.join(tempfile.mkdtemp(), "bench_logs.json")
+    rows = load_texts(args.data, limit=args.requests)
+    payloads = [{"text": text, "bought": label} for text, label in rows]
+
+    results = {}
+    modes = [("wait", 0, False), ("budget", args.budget_ms, False),
+             ("budget+breaker", args.budget_ms, True)]
+    for mode, budget_ms, breaker_on in modes:
+        table = SlowTable(latency_ms=args.ddb_latency_ms)
+        breaker = main.CircuitBreaker(
+            failure_threshold=args.failures,
+            slow_call_seconds=args.budget_ms / 1000.0,
+            reset_timeout=60.0, enabled=breaker_on)
+        install_table(table, budget_ms=budget_ms, breaker=breaker)
+        main.LOCAL_CACHE = main.LocalCache(max_size=0)
+        main.LOG_WRITER = main.LogWriter()
+        main.LOG_WRITER.start()
+        with ServerThread(main.app) as server:
+            latencies, wall = asyncio.run(drive(server.url, payloads,
+                                                args.clients))
+        main.LOG_WRITER.stop()
+        results[mode] = latency_summary(latencies, wall)
+        results[mode]["ddb_reads"] = table.reads
+        results[mode]["breaker"] = breaker.state
+        print(f"{mode:>15}: {results[mode]}")
+    return results
+
+
+# ===============
+# = Store Bench =
+# ===============
+def time_calls(func, args_list):
+    # p50 / p99 / mean of single calls in ms
+    latencies = []
+    for call_args in args_list:
+        start = time.perf_counter()
+        func(*call_args)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    arr = np.asarray(latencies)
+    return {"p50_ms": round(float(np.percentile(arr, 50)), 4),
+            "p99_ms": round(float(np.percentile(arr, 99)), 4),
+            "mean_ms": round(float(arr.mean()), 4)}
+
+
+def bench_store(args):
+    # get / put / batch latency of every store backend, with the
+    # DynamoDB stand-in at --ddb-latency-ms per call
+    rows = load_texts(args.data, limit=args.requests)
+    records = [main.build_log_record(text, "Positive", label)
+               for text, label in rows]
+    keys = [(r["text_hash"],) for r in records]
+    chunks = [records[i:i + args.batch_size]
+              for i in range(0, len(records), args.batch_size)]
+    tmp = tempfile.mkdtemp()
+    stores = {
+        "memory": main.MemoryStore(),
+        "sqlite": main.SQLiteStore(os.path.join(tmp, "cache.db")),
+        "dynamodb": main.DynamoStore(
+            SlowTable(latency_ms=args.ddb_latency_ms), base_delay=0.0)}
+    results = {}
+    for name, store in stores.items():
+        row = {"put": time_calls(store.put, [(r,) for r in records]),
+               "get_hit": time_calls(store.get, keys),
+               "get_miss": time_calls(store.get,
+                                      [(f"miss-{i}",) for i in
+                                       range(len(keys))]),
+               f"batch_put_{args.batch_size}": time_calls(
+                   store.batch_put, [(c,) for c in chunks]),
+               f"batch_get_{args.batch_size}": time_calls(
+                   store.batch_get,
+                   [([r["text_hash"] for r in c],) for c in chunks])}
+        store.close()
+        results[name] = row
+        print(f"{name:>8}: {row}")
+    return results
+
+
+# ==================
+# = Prefork Bench  =
+# ==================
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/health", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+def bench_workers(args):
+    # serve.py with 1..N workers: CPU-bound /predict (every text is
+    # new, no cache tier answers) and the memory of every process
+    here = os.path.dirname(os.path.abspath(__file__))
+    counts = [int(n) for n in args.workers.split(",")]
+    rows = load_texts(args.data, limit=args.requests)
+    tmp = tempfile.mkdtemp()
+    results = {}
+    for n in counts:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, WORKERS=str(n), PORT=str(port),
+                   HOST="127.0.0.1", STORE_BACKEND="memory",
+                   LOCAL_CACHE_SIZE="0", MODEL_POLL_SECONDS="0",
+                   REWARM_TOP_N="0", METRICS_MODE="light",
+                   INFERENCE_ENGINE=args.engine, LOG_LEVEL="warning",
+                   LOG_PATH=os.path.join(tmp, f"logs_{n}.json"))
+        proc = subprocess.Popen([sys.executable, "serve.py"], cwd=here,
+                                env=env, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(url)
+            payloads = [{"text": f"{text} zzworkers{n}r{i}", "bought": label}
+                        for i, (text, label) in enumerate(rows)]
+            latencies, wall = asyncio.run(drive(url, payloads,
+                                                args.clients))
+            workers = [memory_usage(pid) for pid in child_pids(proc.pid)]
+            master = memory_usage(proc.pid)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=60)
+        row = latency_summary(latencies, wall)
+        row["master"] = master
+        row["workers"] = workers
+        row["total_pss_mb"] = round(
+            master["pss_mb"] + sum(w["pss_mb"] for w in workers), 1)
+        row["total_rss_mb"] = round(
+            master["rss_mb"] + sum(w["rss_mb"] for w in workers), 1)
+        results[n] = row
+        print(f"{n:>3} workers: {row['throughput_rps']} req/s, "
+              f"p99 {row['p99_ms']} ms, worker RSS "
+              f"{[w['rss_mb'] for w in workers]} MB, worker private "
+              f"{[w['private_dirty_mb'] for w in workers]} MB, "
+              f"total PSS {row['total_pss_mb']} MB "
+              f"(RSS sum {row['total_rss_mb']} MB)")
+    base = results[counts[0]]["throughput_rps"]
+    for n, row in results.items():
+        row["scaling"] = round(row["throughput_rps"] / base, 2)
+    return results
+
+
+# ===================
+# = Inference Bench =
+# ===================
+def build_engines(pipeline, onnx_threads=1):
+    engines = {"sklearn": pipeline,
+               "numpy": NumpyScorer.from_pipeline(pipeline)}
+    try:
+        path = os.path.join(tempfile.mkdtemp(), "purchase_model.onnx")
+        export_onnx(pipeline, path)
+        engines["onnx"] = OnnxScorer.load(path, onnx_threads)
+    except ImportError as e:
+        # skl2onnx / onnxruntime are optional
+        print(f"skip onnx engine: {e}")
+    return engines
+
+
+def time_engine(engine, texts, batch_size, repeat):
+    # best of `repeat` passes over texts, in ms per text
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(0, len(texts), batch_size):
+            engine.predict(texts[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(texts) * 1000.0
+
+
+def bench_engines(args):
+    pipeline = joblib.load(args.model)
+    texts = [text for text, _ in load_texts(args.data, limit=args.requests)]
+    reference = pipeline.predict(texts)
+    results = {}
+    for name, engine in build_engines(pipeline,
+                                      args.onnx_threads).items():
+        same = bool((np.asarray(engine.predict(texts)) == reference).all())
+        results[name] = {
+            "per_request_ms": round(time_engine(engine, texts, 1,
+                                                args.repeat), 4),
+            f"batch_{args.batch_size}_ms_per_text": round(
+                time_engine(engine, texts, args.batch_size, args.repeat), 4),
+            "matches_sklearn": same}
+    base = results["sklearn"]["per_request_ms"]
+    for name, row in results.items():
+        row["speedup_per_request"] = round(base / row["per_request_ms"], 2)
+        print(f"{name:>8}: {row}")
+    return results
+
+
+# ==================
+# = Artifact Bench =
+# ==================
+# Run in a fresh interpreter per format, so nothing is loaded or
+# cached yet; prints one JSON line
+_COLD_START = """
+import json, sys, time
+import joblib
+from scoring import NumpyScorer
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+fmt, path, text = sys.argv[1:4]
+before = rss_mb()
+start = time.perf_counter()
+if fmt == "pickle":
+    model = joblib.load(path)
+elif fmt == "pickle+numpy":
+    model = NumpyScorer.from_pipeline(joblib.load(path))
+else:
+    model = NumpyScorer.load_mmap(path)
+loaded = time.perf_counter()
+model.predict([text])
+first = time.perf_counter()
+print(json.dumps({"load_ms": (loaded - start) * 1000,
+                  "first_predict_ms": (first - loaded) * 1000,
+                  "rss_growth_mb": rss_mb() - before}))
+"""
+
+
+def bench_artifact(args):
+    # cold start of the pickle vs. the memory-mapped layout: load
+    # time, first prediction and RSS growth, median of --repeat runs
+    here = os.path.dirname(os.path.abspath(__file__))
+    mmap_dir = os.path.join(tempfile.mkdtemp(), main.MMAP_DIR_NAME)
+    NumpyScorer.from_pipeline(joblib.load(args.model)).save_mmap(mmap_dir)
+    text = load_texts(args.data, limit=1)[0][0]
+    paths = {"pickle": args.model, "pickle+numpy": args.model,
+             "mmap": mmap_dir}
+    results = {}
+    for fmt, path in paths.items():
+        runs = []
+        for _ in range(args.repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", _COLD_START, fmt, path, text],
+                cwd=here, check=True, capture_output=True, text=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        row = {key: round(float(np.median([r[key] for r in runs])), 2)
+               for key in runs[0]}
+        results[fmt] = row
+        print(f"{fmt:>12}: {row}")
+    return results
+
+
+# =================
+# = Start Program =
+# =================
+def build_parser():
+    parser = argparse.ArgumentParser(description="Backend benchmarks")
+    parser.add_argument("--model", default="./purchase_model.pkl")
+    parser.add_argument("--data", default="./logs/prediction_logs_moive.json")
+    parser.add_argument("--out", default=None,
+                        help="write the results as JSON to this file")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    loop_p = sub.add_parser(
+        "event-loop",
+        help="tail latency of /predict with blocking calls inline "
+             "vs. offloaded to thread pools")
+    loop_p.add_argument("--clients", type=int, default=32)
+    loop_p.add_argument("--requests", type=int, default=500)
+    loop_p.add_argument("--ddb-latency-ms", type=float, default=20.0)
+    loop_p.set_defaults(func=bench_event_loop)
+
+    cache_p = sub.add_parser(
+        "cache-tier",
+        help="latency and DynamoDB reads of repeated texts with and "
+             "without the in-process cache")
+    cache_p.add_argument("--clients", type=int, default=32)
+    cache_p.add_argument("--requests", type=int, default=200)
+    cache_p.add_argument("--repeat", type=int, default=5)
+    cache_p.add_argument("--cache-size", type=int, default=10000)
+    cache_p.add_argument("--ddb-latency-ms", type=float, default=20.0)
+    cache_p.set_defaults(func=bench_cache_tier)
+
+    deg_p = sub.add_parser(
+        "degraded",
+        help="/predict latency against a slow DynamoDB with and without "
+             "the lookup budget and the circuit breaker")
+    deg_p.add_argument("--clients", type=int, default=16)
+    deg_p.add_argument("--requests", type=int, default=500)
+    deg_p.add_argument("--ddb-latency-ms", type=float, default=300.0)
+    deg_p.add_argument("--budget-ms", type=float, default=50.0)
+    deg_p.add_argument("--failures", type=int, default=5)
+    deg_p.set_defaults(func=bench_degraded)
+
+    store_p = sub.add_parser(
+        "store",
+        help="get / put / batch latency of the memory, SQLite and "
+             "DynamoDB stores")
+    store_p.add_argument("--requests", type=int, default=2000)
+    store_p.add_argument("--batch-size", type=int, default=100)
+    store_p.add_argument("--ddb-latency-ms", type=float, default=5.0)
+    store_p.set_defaults(func=bench_store)
+
+    work_p = sub.add_parser(
+        "workers",
+        help="throughput and memory of serve.py with 1..N prefork workers")
+    work_p.add_argument("--workers", default=",".join(
+        str(n) for n in sorted({1, 2, os.cpu_count() or 1})),
+        help="comma separated worker counts")
+    work_p.add_argument("--clients", type=int, default=64)
+    work_p.add_argument("--requests", type=int, default=2000)
+    work_p.add_argument("--engine", default="numpy",
+                        choices=["sklearn", "numpy"])
+    work_p.set_defaults(func=bench_workers)
+
+    eng_p = sub.add_parser(
+        "engines",
+        help="per-request and batched latency of every inference engine")
+    eng_p.add_argument("--requests", type=int, default=1000)
+    eng_p.add_argument("--batch-size", type=int, default=256)
+    eng_p.add_argument("--repeat", type=int, default=3)
+    eng_p.add_argument("--onnx-threads", type=int, default=1,
+                       help="onnxruntime intra-op threads")
+    eng_p.set_defaults(func=bench_engines)
+
+    art_p = sub.add_parser(
+        "artifact",
+        help="cold start of the pickled pipeline vs. the memory-mapped "
+             "artifact")
+    art_p.add_argument("--repeat", type=int, default=5)
+    art_p.set_defaults(func=bench_artifact)
+    return parser
+
+
+def main_cli(argv=None):
+    args = build_parser().parse_args(argv)
+    results = args.func(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"bench": args.bench, "results": results}, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main_cli()
+
+# python3 benchmark.py event-loop --clients 32 --requests 500
+# python3 benchmark.py --data ./test_data.json event-loop --clients 64
+# python3 benchmark.py --data ./test_data.json engines --batch-size 256
+# python3 benchmark.py cache-tier --requests 200 --repeat 5
+# python3 benchmark.py store --requests 2000 --batch-size 100
+# python3 benchmark.py degraded --ddb-latency-ms 300 --budget-ms 50
+# python3 benchmark.py workers --workers 1,2,4,8 --requests 4000
+# python3 benchmark.py artifact --repeat 5
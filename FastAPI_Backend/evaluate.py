@@ -1,36 +1,404 @@
+import asyncio
+import httpx
 import json
+import math
 import os
 import requests
-from sklearn.metrics import accuracy_score
+import resource
+import time
+import uuid
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.metrics import accuracy_score, confusion_matrix
 
 backend_url = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+# records per /predict/batch call, 0 falls back to one /predict per record
+batch_size = int(os.getenv("EVAL_BATCH_SIZE", "500"))
+# source the accuracy run is logged with; empty sends no header and
+# its records count as user traffic (monitor, model refresh)
+eval_source = os.getenv("EVAL_SOURCE", "evaluate")
+# accuracy: score test_data.json through the API once,
+# load: run the load generator, offline: score the artifact directly
+eval_mode = os.getenv("EVAL_MODE", "accuracy")
+
+# = Offline evaluation settings =
+eval_data = os.getenv("EVAL_DATA", "./test_data.json")
+# records per model.predict call
+eval_chunk_size = int(os.getenv("EVAL_CHUNK_SIZE", "2000"))
+# scoring processes, 1 scores in this process
+eval_workers = int(os.getenv("EVAL_WORKERS", "1"))
+eval_out = os.getenv("EVAL_OUT", "./logs/offline_eval.json")
+
+# = Load generator settings =
+# requests in flight at most
+load_concurrency = int(os.getenv("LOAD_CONCURRENCY", "32"))
+# target requests/sec (open loop), 0 sends as fast as the
+# `load_concurrency` clients get answers (closed loop)
+load_rate = float(os.getenv("LOAD_RATE", "0"))
+# seconds to go from 0 to the full rate / all clients
+load_ramp_up = float(os.getenv("LOAD_RAMP_UP", "0"))
+# records per phase, 0 uses all of test_data.json
+load_requests = int(os.getenv("LOAD_REQUESTS", "0"))
+# cold: texts the server has not seen yet, warm: the same texts again
+load_phases = os.getenv("LOAD_PHASES", "cold,warm").split(",")
+load_timeout = float(os.getenv("LOAD_TIMEOUT", "30"))
+load_out = os.getenv("LOAD_OUT", "./logs/load_results.json")
+# The backend logs these requests with this `source`, so they are not
+# taken for user feedback (see main.TrafficSourceMiddleware)
+TRAFFIC_SOURCE_HEADER = "X-Traffic-Source"
+
 
 def load_test_data(path):
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def get_prediction(text, true_label, url="http://127.0.0.1:8000/predict"):
+def get_prediction(text, true_label, url="http://127.0.0.1:8000/predict",
+                   session=None):
     payload = {
         "text": text,
         "bought": true_label
     }
-    resp = requests.post(url, json=payload)
+    resp = (session or requests).post(url, json=payload)
     resp.raise_for_status()
     return resp.json()["predicted_bought"]
 
 
+def get_batch_predictions(entries, url="http://127.0.0.1:8000/predict/batch",
+                          session=None):
+    payload = {"items": [{"text": e["text"], "bought": e["bought"]}
+                         for e in entries]}
+    resp = (session or requests).post(url, json=payload)
+    resp.raise_for_status()
+    return [r["predicted_bought"] for r in resp.json()["results"]]
+
+
+# ==================
+# = Load Generator =
+# ==================
+def cold_texts(entries, tag):
+    # Append a run-unique token to every text. It is not in the
+    # vocabulary, so the prediction stays the same, but the cache
+    # key is new: the cold phase really misses every cache tier.
+    return [{"text": f"{e['text']} {tag}", "bought": e["bought"]}
+            for e in entries]
+
+
+def send_offsets(n, rate, ramp_up):
+    # Seconds after the phase start at which each request is sent.
+    # The rate rises linearly from 0 to `rate` during `ramp_up`,
+    # so the first r*R/2 requests fall into the ramp.
+    offsets = []
+    ramp_n = rate * ramp_up / 2.0
+    for i in range(n):
+        if i < ramp_n:
+            offsets.append(math.sqrt(2.0 * ramp_up * i / rate))
+        else:
+            offsets.append(ramp_up + (i - ramp_n) / rate)
+    return offsets
+
+
+async def run_phase(client, entries, concurrency, rate=0.0, ramp_up=0.0,
+                    offsets=None):
+    # Return one (latency, ok, error, pred, true_label, cached, sent_at)
+    # row per entry, plus the wall time of the phase. sent_at is
+    # seconds after the phase start. `offsets` gives the send time
+    # of every entry, e.g. from recorded traffic.
+    rows = []
+    gate = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+
+    async def send(entry, scheduled):
+        # latency counts from the scheduled send time, so a server
+        # that falls behind is not hidden by clients waiting on it
+        sent_at = scheduled - start
+        async with gate:
+            try:
+                resp = await client.post("/predict", json=entry)
+                resp.raise_for_status()
+                body = resp.json()
+                rows.append((time.perf_counter() - scheduled, True, None,
+                             body["predicted_bought"], entry["bought"],
+                             body.get("cached"), sent_at))
+            except Exception as e:
+                if isinstance(e, httpx.HTTPStatusError):
+                    error = f"http_{e.response.status_code}"
+                else:
+                    error = type(e).__name__
+                rows.append((time.perf_counter() - scheduled, False, error,
+                             None, entry["bought"], None, sent_at))
+
+    if offsets is None and rate > 0:
+        offsets = send_offsets(len(entries), rate, ramp_up)
+    if offsets is not None:
+        # open loop: requests leave on schedule, whatever the server does
+        tasks = []
+        for entry, offset in zip(entries, offsets):
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(
+                send(entry, start + offset)))
+        await asyncio.gather(*tasks)
+    else:
+        # closed loop: `concurrency` clients, started one by one
+        # over the ramp-up, each sends its next request on an answer
+        todo = list(reversed(entries))
+
+        async def worker(k):
+            await asyncio.sleep(ramp_up * k / concurrency)
+            while todo:
+                await send(todo.pop(), time.perf_counter())
+
+        await asyncio.gather(*(worker(k) for k in range(concurrency)))
+    return rows, time.perf_counter() - start
+
+
+def summarize(rows, wall):
+    ok = [r for r in rows if r[1]]
+    errors = {}
+    for r in rows:
+        if not r[1]:
+            errors[r[2]] = errors.get(r[2], 0) + 1
+    latencies = np.array([r[0] for r in ok]) * 1000.0
+    tiers = {}
+    for r in ok:
+        tier = r[5] or "miss"
+        tiers[tier] = tiers.get(tier, 0) + 1
+
+    summary = {
+        "requests": len(rows),
+        "ok": len(ok),
+        "errors": len(rows) - len(ok),
+        "error_rate": round((len(rows) - len(ok)) / max(len(rows), 1), 4),
+        "errors_by_type": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 1) if wall else 0.0,
+        "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None,
+        "accuracy": None,
+        "cache_tiers": tiers}
+    if ok:
+        for q in (50, 95, 99):
+            summary[f"p{q}_ms"] = round(
+                float(np.percentile(latencies, q)), 2)
+        summary["max_ms"] = round(float(latencies.max()), 2)
+        summary["accuracy"] = round(accuracy_score(
+            [r[4] for r in ok], [r[3] for r in ok]), 4)
+    return summary
+
+
+async def run_load(entries, base_url, concurrency=load_concurrency,
+                   rate=load_rate, ramp_up=load_ramp_up, phases=load_phases,
+                   timeout=load_timeout, transport=None):
+    # One pooled client for every phase. With a cold phase the texts
+    # are tagged, later phases replay the exact same (tagged) texts.
+    for phase in phases:
+        if phase not in ("cold", "warm"):
+            raise ValueError(f"Unknown load phase {phase!r}")
+    started_at = time.time()
+    texts = entries
+    if "cold" in phases:
+        texts = cold_texts(entries, f"zzrun{uuid.uuid4().hex}")
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    results = {}
+    async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=timeout,
+            transport=transport,
+            headers={TRAFFIC_SOURCE_HEADER: "loadtest"}) as client:
+        for phase in phases:
+            rows, wall = await run_phase(client, texts, concurrency,
+                                         rate, ramp_up)
+            results[phase] = summarize(rows, wall)
+            print(f"{phase:>5}: {results[phase]}")
+    return {
+        "started_at": started_at,
+        "backend_url": base_url,
+        "config": {"concurrency": concurrency, "rate": rate,
+                   "ramp_up": ramp_up, "requests": len(entries),
+                   "phases": list(phases)},
+        "phases": results}
+
+
+def load_main():
+    test_data = load_test_data("./test_data.json")
+    if load_requests > 0:
+        test_data = test_data[:load_requests]
+    report = asyncio.run(run_load(test_data, backend_url.rstrip("/")))
+    os.makedirs(os.path.dirname(load_out) or ".", exist_ok=True)
+    with open(load_out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Load test results written to {load_out}")
+    return report
+
+
+# ======================
+# = Offline Evaluation =
+# ======================
+LABELS = {"Negative": 0, "Positive": 1}
+
+
+def iter_json_array(path, block_size=1 << 20):
+    # Yield the records of a JSON list one by one, reading the file
+    # `block_size` characters at a time, so memory stays bounded
+    # however large test_data.json gets.
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(block_size).lstrip()
+        if not buf.startswith("["):
+            raise ValueError(f"{path} is not a JSON list")
+        pos, eof = 1, False
+        while True:
+            # skip whitespace and the comma between records
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = f.read(block_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield obj
+            pos = end
+
+
+def iter_chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def score_chunk(model, chunk):
+    # 2x2 confusion matrix of one chunk, rows = true label
+    texts = [r["text"] for r in chunk]
+    y_true = [LABELS[r["bought"].capitalize()] for r in chunk]
+    y_pred = np.asarray(model.predict(texts)).astype(int)
+    return confusion_matrix(y_true, y_pred, labels=[0, 1])
+
+
+_worker_model = None
+
+
+def _init_worker(model):
+    # runs once per process: the model is unpickled once, not per chunk
+    global _worker_model
+    _worker_model = model
+
+
+def _score_in_worker(chunk):
+    return score_chunk(_worker_model, chunk)
+
+
+def offline_evaluate(model, path, chunk_size=eval_chunk_size,
+                     workers=eval_workers):
+    # Score every record of `path` with one model.predict per chunk.
+    # With workers > 1 the chunks go to a process pool; at most
+    # 2 chunks per worker are in flight.
+    start = time.perf_counter()
+    cm = np.zeros((2, 2), dtype=np.int64)
+    chunks = iter_chunks(iter_json_array(path), chunk_size)
+    if workers <= 1:
+        for chunk in chunks:
+            cm += score_chunk(model, chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(model,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_score_in_worker, chunk))
+                if len(pending) >= 2 * workers:
+                    cm += pending.popleft().result()
+            while pending:
+                cm += pending.popleft().result()
+    seconds = time.perf_counter() - start
+
+    (tn, fp), (fn, tp) = cm.tolist()
+    rows = tn + fp + fn + tp
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return {
+        "rows": rows,
+        "accuracy": round((tp + tn) / rows, 4) if rows else None,
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(2 * precision * recall / (precision + recall), 4)
+        if precision + recall else 0.0,
+        "confusion_matrix": {"labels": ["Negative", "Positive"],
+                             "rows_are": "true label",
+                             "matrix": cm.tolist()},
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds, 1) if seconds else None,
+        "chunk_size": chunk_size,
+        "workers": workers,
+        # kilobytes on Linux, this process only
+        "peak_rss_mb": round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def offline_main():
+    # The same artifact and engine the API serves, without the API:
+    # nothing is written to DynamoDB or the prediction log.
+    from main import build_engine, engine_name, load_artifact
+    model = build_engine(load_artifact())
+    report = offline_evaluate(model, eval_data)
+    report["engine"] = engine_name(model)
+    print(f"Overall Accuracy is {report['accuracy']:.2%} on "
+          f"{report['rows']} rows ({report['rows_per_sec']} rows/sec).")
+    print(json.dumps(report, indent=2))
+    os.makedirs(os.path.dirname(eval_out) or ".", exist_ok=True)
+    with open(eval_out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
 def main():
+    if eval_mode == "load":
+        return load_main()
+    if eval_mode == "offline":
+        return offline_main()
     test_data = load_test_data("./test_data.json")
     y_true = []
     y_pred = []
-    url = backend_url.rstrip("/") + "/predict"
+    base = backend_url.rstrip("/")
+    session = requests.Session()
+    if eval_source:
+        session.headers[TRAFFIC_SOURCE_HEADER] = eval_source
+    if batch_size > 0:
+        url = base + "/predict/batch"
+        for start in range(0, len(test_data), batch_size):
+            chunk = test_data[start:start + batch_size]
+            try:
+                preds = get_batch_predictions(chunk, url, session)
+            except Exception as e:
+                print(f"Error predicting batch at {start}: {e}")
+                continue
+            y_true.extend(entry["bought"] for entry in chunk)
+            y_pred.extend(preds)
+            print(f"Scored {len(y_pred)} / {len(test_data)} records")
+        accuracy = accuracy_score(y_true, y_pred)
+        print(f"Overall Accuracy is {accuracy:.2%}.")
+        return
+
+    url = base + "/predict"
     cnt = 0
     for entry in test_data:
         text = entry["text"]
         true_label = entry["bought"]
         try:
-            pred = get_prediction(text, true_label, url)
+            pred = get_prediction(text, true_label, url, session)
         except Exception as e:
             print(f"Error predicting for text '{text[:30]}...': {e}")
             continue
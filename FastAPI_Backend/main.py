@@ -1,21 +1,107 @@
+import asyncio
 import boto3
+import contextvars
+import functools
 import hashlib
 import joblib
 import json
 import os
+import queue
 import requests
+import threading
 import time
+import unicodedata
 import wandb
+from botocore.config import Config
+from collections import Counter, OrderedDict, deque, namedtuple
 from botocore.exceptions import ClientError, NoCredentialsError
-from botocore.exceptions import EndpointConnectionError
-from decimal import Decimal
+from botocore.exceptions import BotoCoreError, EndpointConnectionError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from metrics import Metrics, MetricsMiddleware
 from pydantic import BaseModel, Field
-# from typing import List
+from scoring import NumpyScorer, OnnxScorer, onnxruntime
+from store import (CircuitBreaker, DynamoStore, MemoryStore, SQLiteStore,
+                   StoreUnavailable, credentials_expired)
+from typing import List
 
+# dynamodb, sqlite (one file, no network) or memory (tests, benchmarks)
+STORE_BACKEND = os.environ.get("STORE_BACKEND", "dynamodb")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "./logs/cache.db")
 DDB_TABLE_NAME = os.environ.get("DDB_TABLE", "Backend_Log_Cache")
 DDB_REGION = os.environ.get("AWS_REGION", "us-east-1")
+# botocore connection pool and retry settings for the shared client
+DDB_MAX_POOL = int(os.environ.get("DDB_MAX_POOL", "50"))
+DDB_RETRY_MODE = os.environ.get("DDB_RETRY_MODE", "standard")
+DDB_MAX_ATTEMPTS = int(os.environ.get("DDB_MAX_ATTEMPTS", "3"))
+# seconds per DynamoDB call, so a hung connection cannot hold a request
+DDB_CONNECT_TIMEOUT = float(os.environ.get("DDB_CONNECT_TIMEOUT", "1"))
+DDB_READ_TIMEOUT = float(os.environ.get("DDB_READ_TIMEOUT", "2"))
+# ms a /predict cache lookup may take before the model answers instead,
+# 0 waits for the store however long it takes
+STORE_LOOKUP_BUDGET_MS = float(os.environ.get("STORE_LOOKUP_BUDGET_MS",
+                                              "50"))
+# the breaker opens after BREAKER_FAILURES failed or slow store calls
+# in a row (lookups slower than BREAKER_SLOW_MS, writes slower than
+# BREAKER_WRITE_SLOW_MS, 0: only failed writes count) and probes again
+# after BREAKER_RESET_SECONDS; meanwhile /predict serves from the model
+BREAKER_ENABLED = os.environ.get("BREAKER_ENABLED", "1") == "1"
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+BREAKER_SLOW_MS = float(os.environ.get("BREAKER_SLOW_MS",
+                                       str(STORE_LOOKUP_BUDGET_MS)))
+BREAKER_WRITE_SLOW_MS = float(os.environ.get("BREAKER_WRITE_SLOW_MS", "0"))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", "30"))
+# largest number of records accepted by /predict/batch
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "1000"))
+CATEGORY = ["Negative", "Positive"]
+# opt-in micro-batching of concurrent /predict cache misses
+MICROBATCH_ENABLED = os.environ.get("MICROBATCH_ENABLED", "0") == "1"
+MICROBATCH_MAX_SIZE = int(os.environ.get("MICROBATCH_MAX_SIZE", "32"))
+MICROBATCH_MAX_WAIT_MS = float(os.environ.get("MICROBATCH_MAX_WAIT_MS", "2"))
+# write-behind logging: queue bound, what to do when it is full
+# (drop_oldest, drop_newest or block), batch size and flush interval
+LOG_WRITE_BEHIND = os.environ.get("LOG_WRITE_BEHIND", "1") == "1"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_QUEUE_POLICY = os.environ.get("LOG_QUEUE_POLICY", "drop_oldest")
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_MS = float(os.environ.get("LOG_FLUSH_MS", "200"))
+LOG_MAX_RETRIES = int(os.environ.get("LOG_MAX_RETRIES", "5"))
+LOG_SHUTDOWN_TIMEOUT = float(os.environ.get("LOG_SHUTDOWN_TIMEOUT", "10"))
+# threads for blocking DynamoDB / file / W&B calls and for model scoring
+IO_THREADS = int(os.environ.get("IO_THREADS", "32"))
+SCORING_THREADS = int(os.environ.get("SCORING_THREADS",
+                                     str(os.cpu_count() or 1)))
+LOG_PATH = os.environ.get("LOG_PATH", "./logs/prediction_logs.json")
+MODEL_NAME = os.environ.get("MODEL_NAME", "MultinomialNB-artifact")
+MODEL_ALIAS = os.environ.get("MODEL_ALIAS", "latest")
+# sklearn: the pickled Pipeline, numpy: compiled NumpyScorer,
+# onnx: purchase_model.onnx of the same artifact on onnxruntime
+INFERENCE_ENGINE = os.environ.get("INFERENCE_ENGINE", "sklearn")
+ONNX_FILE_NAME = "purchase_model.onnx"
+# onnxruntime threads per request; keep WORKERS x threads <= cores
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", "1"))
+# pickle: purchase_model.pkl, mmap: the pickle-free purchase_model_mmap/
+# directory, opened memory-mapped and always served by the numpy engine
+MODEL_FORMAT = os.environ.get("MODEL_FORMAT", "pickle")
+MMAP_DIR_NAME = "purchase_model_mmap"
+# seconds between two registry checks, 0 turns the poller off
+MODEL_POLL_SECONDS = float(os.environ.get("MODEL_POLL_SECONDS", "300"))
+# hottest texts re-scored into the cache before a new model goes live,
+# 0 turns the re-warm off
+REWARM_TOP_N = int(os.environ.get("REWARM_TOP_N", "500"))
+HOT_KEYS_SIZE = int(os.environ.get("HOT_KEYS_SIZE", "10000"))
+# concurrent identical /predict misses share one lookup + score + write
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") == "1"
+# in-process cache tier in front of DynamoDB, size 0 turns it off
+LOCAL_CACHE_SIZE = int(os.environ.get("LOCAL_CACHE_SIZE", "10000"))
+LOCAL_CACHE_TTL = float(os.environ.get("LOCAL_CACHE_TTL", "300"))
+# seconds a DynamoDB miss is remembered, 0 turns it off
+NEGATIVE_CACHE_TTL = float(os.environ.get("NEGATIVE_CACHE_TTL", "0"))
 os.makedirs("./logs", exist_ok=True)
+# stage histograms and counters of the predict path, see metrics.py
+METRICS = Metrics()
 # print(json.dumps(boto3.client("sts").get_caller_identity(), indent=2))
 
 
@@ -33,7 +119,10 @@ def is_ec2_env1():
         return False
 
 
+@functools.lru_cache(maxsize=1)
 def is_ec2_env():
+    # The answer never changes inside one process,
+    # so the IMDS probes only run on the first call.
     try:
         token_url = "http://169.254.169.254/latest/api/token"
         headers = {"X-aws-ec2-metadata-token-ttl-seconds": "60"}
@@ -55,15 +144,29 @@ def is_ec2_env():
 # = Set up AWS =
 # = DynamoDB   =
 # ==============
+def ddb_client_config(max_pool=None, retry_mode=None, max_attempts=None):
+    # One pooled botocore client is shared by all requests,
+    # so the pool must be as large as the request concurrency.
+    return Config(
+        region_name=DDB_REGION,
+        connect_timeout=DDB_CONNECT_TIMEOUT,
+        read_timeout=DDB_READ_TIMEOUT,
+        max_pool_connections=max_pool or DDB_MAX_POOL,
+        retries={"mode": retry_mode or DDB_RETRY_MODE,
+                 "max_attempts": max_attempts or DDB_MAX_ATTEMPTS})
+
+
 # get temporary permit
-def connect_dynamodb():
+def connect_dynamodb(config=None):
     # figure out the current environment: local or AWS learner lab EC2
     # connect to DynamoDB based on different environment
+    config = config or ddb_client_config()
     if is_ec2_env():
         # boto3 will pick up credentials from env
         # or ~/.aws/credentials automatically
         print("Detected EC2 (Learner Lab). Using IAM Role credentials...")
-        dynamodb = boto3.resource("dynamodb", region_name=DDB_REGION)
+        dynamodb = boto3.resource("dynamodb", region_name=DDB_REGION,
+                                  config=config)
         return dynamodb
     else:
         print("Detected local environment. \
@@ -81,7 +184,7 @@ def connect_dynamodb():
         #                           aws_access_key_id=aws_key,
         #                           aws_secret_access_key=aws_secret,
         #                           aws_session_token=aws_token)
-        return session.resource("dynamodb")
+        return session.resource("dynamodb", config=config)
 
 
 def ensure_table(table_name=DDB_TABLE_NAME, create_if_missing=True,
@@ -125,39 +228,521 @@ def ensure_table(table_name=DDB_TABLE_NAME, create_if_missing=True,
         return table
 
 
-def query_dynamodb_cache(text: str, table=None):
+STORE_BACKENDS = ("dynamodb", "sqlite", "memory")
+
+
+class StoreHandle:
+    """
+    Shared Cache/Log Store Handle
+    Opens the configured store (STORE_BACKEND) once and hands
+    the same one to every request. For DynamoDB it resolves
+    environment, session, pooled client and table once; the
+    handle is only rebuilt when the credentials expire. Every
+    call goes through the circuit breaker: when it is open,
+    call() raises StoreUnavailable without touching the store.
+    """
+
+    def __init__(self, backend=None, table_name=DDB_TABLE_NAME,
+                 sqlite_path=None, breaker=None):
+        self.backend = backend or STORE_BACKEND
+        if self.backend not in STORE_BACKENDS:
+            raise ValueError(f"Unknown STORE_BACKEND {self.backend!r}, "
+                             f"use one of {STORE_BACKENDS}")
+        self.table_name = table_name
+        self.sqlite_path = sqlite_path or SQLITE_PATH
+        self._store = None
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=BREAKER_FAILURES,
+            slow_call_seconds=BREAKER_SLOW_MS / 1000.0,
+            reset_timeout=BREAKER_RESET_SECONDS,
+            enabled=BREAKER_ENABLED,
+            slow_write_seconds=BREAKER_WRITE_SLOW_MS / 1000.0)
+
+    def _open(self):
+        if self.backend == "sqlite":
+            return SQLiteStore(self.sqlite_path)
+        if self.backend == "memory":
+            return MemoryStore()
+        with METRICS.stage("ensure_table"):
+            return DynamoStore(ensure_table(table_name=self.table_name,
+                                            create_if_missing=True))
+
+    def get(self):
+        store = self._store
+        if store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = self._open()
+                store = self._store
+        return store
+
+    def install(self, store):
+        # serve `store` from now on, e.g. a test or benchmark double
+        self._store = store
+        self.backend = store.backend
+        return store
+
+    def invalidate(self):
+        self._store = None
+
+    def call(self, func, write=False):
+        # Run func(store) and tell the breaker how it went; `write`
+        # calls are timed against the write threshold
+        if not self.breaker.allow():
+            raise StoreUnavailable(f"{self.backend} breaker is open")
+        start = time.perf_counter()
+        try:
+            result = self._call(func)
+        except Exception as e:
+            self.breaker.record(error=e, write=write)
+            raise
+        self.breaker.record(time.perf_counter() - start, write=write)
+        return result
+
+    def _call(self, func):
+        # When the token expired, rebuild the session
+        # once and try again with the fresh handle.
+        try:
+            return func(self.get())
+        except ClientError as e:
+            if not credentials_expired(e):
+                raise
+            print("[DDB] Credentials expired - refreshing table handle")
+            self.invalidate()
+            self.refreshes += 1
+            return func(self.get())
+
+    def status(self):
+        info = {"backend": self.backend,
+                "connected": self._store is not None,
+                "refreshes": self.refreshes,
+                "lookup_budget_ms": STORE_LOOKUP_BUDGET_MS,
+                "breaker": self.breaker.status()}
+        if self._store is not None:
+            info.update(self._store.status())
+        if self.backend == "dynamodb":
+            info.update({"table_name": self.table_name,
+                         "max_pool_connections": DDB_MAX_POOL,
+                         "retry_mode": DDB_RETRY_MODE,
+                         "max_attempts": DDB_MAX_ATTEMPTS,
+                         "connect_timeout": DDB_CONNECT_TIMEOUT,
+                         "read_timeout": DDB_READ_TIMEOUT})
+        return info
+
+
+STORE = StoreHandle()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_text(text):
+    # Canonical form of a review: NFKC folds full-width and
+    # compatibility characters, runs of whitespace become one space.
+    # Near-identical inputs then share one cache key.
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def cache_key(text, namespace=None):
+    # Cache items are keyed per model: a new model never reads
+    # the predictions of an old one. No namespace gives the old
+    # sha256(text) key.
+    if namespace is None:
+        return hash_text(text)
+    return hash_text(f"{namespace}\n{text}")
+
+
+def query_cache(text, store, key=None):
     # Return stored item or None.
-    # Item contains predicted_sentiment and true_sentiment etc.
-    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
-    resp = table.get_item(Key={"text_hash": text_hash})
-    if resp:
-        return resp.get("Item")
-    else:
-        print("[DDB] get_item error")
-        return None
+    # Item contains predicted_bought and true_record etc.
+    return store.get(key or hash_text(text))
 
 
-def log_cache(text, pred, true_label, table):
-    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
-    ts = time.time()
-    data = {
-        "timestamp": ts,
+def build_log_record(text, pred, true_label, state=None, source=None):
+    # `state` is the ModelState that made the prediction,
+    # its digest namespaces the cache key
+    state = state or MODEL_HOLDER.peek_state()
+    record = {
+        "timestamp": time.time(),
         "request_text": text,
-        "text_hash": text_hash,
+        "text_hash": cache_key(text, state.digest if state else None),
         "predicted_bought": pred,
         "true_record": true_label,
-        "model_name": "MultinomialNB-artifact",
-        "model_alias": "staging"}
-    with open("./logs/prediction_logs.json", "a", encoding="utf-8") as f:
+        "model_name": MODEL_HOLDER.model_name,
+        "model_alias": MODEL_HOLDER.alias,
+        "model_version": state.version if state else None,
+        "model_digest": state.digest if state else None}
+    source = source or _traffic_source.get()
+    if source:
+        record["source"] = source
+    return record
+
+
+def append_local_logs(records):
+    # one buffered write for the whole batch
+    lines = [json.dumps(d, ensure_ascii=False) + "\n" for d in records]
+    with open(LOG_PATH, "a", encoding="utf-8") as f:
+        f.write("".join(lines))
+
+
+def log_cache_batch(records):
+    # Same as log_cache for many records: one file append
+    # and one batch put (BatchWriteItem calls of 25 items on DynamoDB).
+    append_local_logs(records)
+    try:
+        failed, _ = STORE.call(lambda store: store.batch_put(
+            records, max_retries=LOG_MAX_RETRIES), write=True)
+    except (ClientError, BotoCoreError, StoreUnavailable) as e:
+        print(f"[STORE] batch put of {len(records)} items failed: {e}")
+        return
+    print(f"[STORE] batch put: cached {len(records) - failed} items, "
+          f"{failed} failed")
+
+
+def log_cache(text, pred, true_label, state=None, source=None):
+    data = build_log_record(text, pred, true_label, state, source)
+    text_hash = data["text_hash"]
+    with open(LOG_PATH, "a", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False)
         f.write("\n")
-        print("Create local log file at ./logs/prediction_logs.json")
-        data["timestamp"] = Decimal(str(ts))
+        print(f"Create local log file at {LOG_PATH}")
     try:
-        table.put_item(Item=data)
-        print("[DDB] put succeed: Cache data to DynamoDB")
-    except ClientError as e:
-        print(f"[DDB] put failed for: {text_hash} error: {e}")
+        # an expired token is refreshed inside STORE.call
+        STORE.call(lambda store: store.put(data), write=True)
+        print(f"[STORE] put succeed: Cache data to {STORE.backend}")
+    except (ClientError, BotoCoreError, StoreUnavailable) as e:
+        # the record is in the local log file, the request goes on
+        print(f"[STORE] put failed for: {text_hash} error: {e}")
+
+
+# ====================
+# = Local Cache Tier =
+# ====================
+class LocalCache:
+    """
+    In-Process LRU/TTL Cache
+    Sits in front of DynamoDB and uses the same keys. Holds at
+    most max_size predictions, each for ttl seconds; the least
+    recently used one goes first. With negative_ttl > 0 a
+    DynamoDB miss is remembered too, get() then returns MISS
+    and the caller skips the DynamoDB round-trip.
+    """
+
+    MISS = object()
+
+    def __init__(self, max_size=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL,
+                 negative_ttl=NEGATIVE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # key -> (value, expires_at), oldest use first
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        # cached value, MISS for a remembered DynamoDB miss, or None
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._items[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            if entry[0] is self.MISS:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        self._set(key, value, self.ttl)
+
+    def put_miss(self, key):
+        if self.negative_ttl > 0:
+            self._set(key, self.MISS, self.negative_ttl)
+
+    def _set(self, key, value, ttl):
+        if not self.enabled or ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def status(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "negative_ttl": self.negative_ttl,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations}
+
+
+LOCAL_CACHE = LocalCache()
+
+
+# ===========================
+# = Write-Behind Log Writer =
+# ===========================
+class LogWriter:
+    """
+    Write-Behind Log Writer
+    Requests only put their log record on a bounded queue.
+    A background thread drains it in batches: one buffered append
+    to the local log file and one batch put to the store. Batches
+    the open breaker turned away are held (up to `maxsize`
+    records) and put again, oldest first, once it lets calls
+    through. stop() flushes what is left before the process exits.
+    """
+
+    POLICIES = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE, policy=LOG_QUEUE_POLICY,
+                 batch_size=LOG_BATCH_SIZE, flush_ms=LOG_FLUSH_MS,
+                 max_retries=LOG_MAX_RETRIES):
+        if policy not in self.POLICIES:
+            raise ValueError(f"LOG_QUEUE_POLICY must be one of "
+                             f"{self.POLICIES}, got {policy!r}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_ms / 1000.0
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=maxsize)
+        # batches in the local log file, not yet in the store
+        self._held = deque()
+        self.held = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.batches = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="log-writer",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=LOG_SHUTDOWN_TIMEOUT):
+        # the worker drains the queue before it exits
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"[LOG] {self._queue.qsize()} records not flushed "
+                  f"after {timeout}s")
+        self._thread = None
+
+    def flush(self):
+        # wait until every queued record is written
+        self._queue.join()
+
+    def enqueue(self, record):
+        if self.policy == "block":
+            self._queue.put(record)
+        elif self.policy == "drop_newest":
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+                return False
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(record)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._queue.task_done()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        self.enqueued += 1
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._put_held()
+                if self._stopping.is_set():
+                    self._drop_held()
+                    return
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"[LOG] failed to write {len(batch)} records: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        append_local_logs(batch)
+        # behind the held batches, so the store sees them in order
+        self._held.append(batch)
+        self.held += len(batch)
+        while self.held > self.maxsize:
+            oldest = self._held.popleft()
+            self.held -= len(oldest)
+            self.skipped += len(oldest)
+        self._put_held()
+
+    def _put_held(self):
+        while self._held:
+            batch = self._held[0]
+            try:
+                failed, retries = STORE.call(
+                    lambda store: store.batch_put(
+                        batch, max_retries=self.max_retries), write=True)
+            except StoreUnavailable:
+                # breaker open: try again after the next batch or
+                # flush interval
+                return
+            except Exception as e:
+                failed, retries = len(batch), 0
+                print(f"[LOG] failed to put {len(batch)} records: {e}")
+            self._held.popleft()
+            self.held -= len(batch)
+            self.batches += 1
+            self.written += len(batch) - failed
+            self.failed += failed
+            self.retries += retries
+
+    def _drop_held(self):
+        # shutting down: the records are in the local log file only
+        if self._held:
+            print(f"[LOG] {self.held} records not put to the store, "
+                  f"breaker open")
+        self.skipped += self.held
+        self._held.clear()
+        self.held = 0
+
+    def status(self):
+        return {
+            "enabled": self.running,
+            "policy": self.policy,
+            "capacity": self.maxsize,
+            "queue_depth": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+            "held": self.held,
+            "skipped": self.skipped,
+            "retries": self.retries,
+            "batches": self.batches}
+
+
+LOG_WRITER = LogWriter()
+
+
+# ====================
+# = Thread Pools for =
+# = Blocking Work    =
+# ====================
+# The handlers are async, so nothing blocking may run on the event loop.
+# boto3, file appends and W&B downloads go to IO_EXECUTOR, sklearn
+# scoring goes to SCORING_EXECUTOR. The pool sizes bound the concurrency.
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_THREADS,
+                                 thread_name_prefix="io")
+SCORING_EXECUTOR = ThreadPoolExecutor(max_workers=SCORING_THREADS,
+                                      thread_name_prefix="scoring")
+
+
+async def run_io(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(IO_EXECUTOR, func, *args)
+
+
+async def run_scoring(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(SCORING_EXECUTOR, func, *args)
+
+
+async def store_lookup(func):
+    # Run func(store) for a cache lookup within STORE_LOOKUP_BUDGET_MS.
+    # Return (True, result), or (False, None) when the store is slow,
+    # failing or its breaker is open: the caller then treats the
+    # lookup as a miss it must not remember, and the model answers.
+    call = run_io(STORE.call, func)
+    try:
+        if STORE_LOOKUP_BUDGET_MS > 0:
+            return True, await asyncio.wait_for(
+                call, STORE_LOOKUP_BUDGET_MS / 1000.0)
+        return True, await call
+    except asyncio.TimeoutError:
+        reason = "budget"
+    except StoreUnavailable:
+        reason = "breaker_open"
+    except Exception as e:
+        print(f"[STORE] lookup failed, serving from the model: {e}")
+        reason = "error"
+    METRICS.inc("store_degraded_total", (("reason", reason),))
+    return False, None
+
+
+async def enqueue_logs(records):
+    # Hand log records to the write-behind writer.
+    # Return False when it is not running, the caller then
+    # writes them itself.
+    if not LOG_WRITER.running:
+        return False
+    for record in records:
+        if LOG_WRITER.policy == "block":
+            # a full queue must not stall the event loop
+            await run_io(LOG_WRITER.enqueue, record)
+        else:
+            LOG_WRITER.enqueue(record)
+    return True
 
 
 # =======================
@@ -167,34 +752,519 @@ def log_cache(text, pred, true_label, table):
 def load_artifact(model_name="MultinomialNB-artifact", alias="latest"):
     # Load Weights & Biases Model Registry.
     # method 1
-    api = wandb.Api()
     try:
+        api = wandb.Api()
         # Pull certain version from Model Registry
         # and Download to local path
         # method 1
         pname = "Book_Purchase_Intention_Prediction"
         art = api.artifact(f"jsfoggy/{pname}/{model_name}:{alias}")
-        artifact = art.get_path("purchase_model.pkl").download()
-        print(artifact)
-        model = joblib.load(artifact)
+        name, load = artifact_layout()
+        if name == MMAP_DIR_NAME:
+            root = art.download()
+            model = load(os.path.join(root, MMAP_DIR_NAME))
+        else:
+            artifact = art.get_path(name).download()
+            print(artifact)
+            model = load(artifact)
         print(f"Model '{model_name}:{alias}' loaded successfully from W&B.")
         return model
 
     except Exception as e:
         print(f"Could not load model from W&B: {e}")
+        name, load = artifact_layout()
         local_paths = [
-            "../Model_Management/purchase_model.pkl",
-            "./Model_Management/purchase_model.pkl",
-            "./purchase_model.pkl"
+            f"../Model_Management/{name}",
+            f"./Model_Management/{name}",
+            f"./{name}"
         ]
         for path in local_paths:
             if os.path.exists(path):
-                model = joblib.load(path)
+                model = load(path)
                 print(f"Model loaded locally from {path}")
                 return model
         raise FileNotFoundError("No model found locally or in W&B Registry.")
 
 
+def artifact_layout():
+    # (file or directory in the artifact, loader) of the configured
+    # format and engine
+    if MODEL_FORMAT == "mmap":
+        return MMAP_DIR_NAME, NumpyScorer.load_mmap
+    if INFERENCE_ENGINE == "onnx":
+        if onnxruntime is not None:
+            return ONNX_FILE_NAME, functools.partial(
+                OnnxScorer.load, intra_op_threads=ONNX_INTRA_OP_THREADS)
+        print("onnxruntime is not installed, serve sklearn instead")
+    return "purchase_model.pkl", joblib.load
+
+
+def build_engine(model, engine=None):
+    # Turn the loaded sklearn pipeline into the configured
+    # inference engine. Every engine has predict(list_of_texts).
+    engine = engine or INFERENCE_ENGINE
+    if isinstance(model, (NumpyScorer, OnnxScorer)):
+        # a pickle-free or ONNX artifact is already compiled
+        return model
+    if engine == "numpy":
+        try:
+            return NumpyScorer.from_pipeline(model)
+        except (AttributeError, KeyError, ValueError) as e:
+            print(f"Can not compile model for numpy engine, "
+                  f"serve sklearn instead: {e}")
+    return model
+
+
+def engine_name(model):
+    if isinstance(model, NumpyScorer):
+        return "numpy"
+    if isinstance(model, OnnxScorer):
+        return "onnx"
+    return "sklearn"
+
+
+def resolve_model_version(model_name="MultinomialNB-artifact",
+                          alias="latest"):
+    # Ask W&B Registry which version the alias points to.
+    # It only reads metadata, nothing is downloaded.
+    # Return None when the registry can not be reached.
+    try:
+        api = wandb.Api()
+        pname = "Book_Purchase_Intention_Prediction"
+        art = api.artifact(f"jsfoggy/{pname}/{model_name}:{alias}")
+        return art.version
+    except Exception as e:
+        print(f"Could not resolve model version from W&B: {e}")
+        return None
+
+
+# ================
+# = Model Holder =
+# ================
+# digest: content hash of the loaded pipeline, the cache namespace.
+# Re-promoting the same artifact under a new version keeps the cache.
+ModelState = namedtuple(
+    "ModelState", ["model", "version", "loaded_at", "load_seconds", "digest"])
+
+
+def model_digest(model):
+    # a pickle-free artifact carries its digest in the manifest,
+    # hashing it here would read every page of its arrays
+    return getattr(model, "digest", None) or joblib.hash(model)[:16]
+
+
+class ModelHolder:
+    """
+    Process-wide Model Holder
+    Keeps one loaded model in memory for every request.
+    refresh() checks the registry and swaps in a new version
+    by replacing a single state tuple, so readers never see
+    a half-loaded model. before_swap(new_state) runs before
+    a new version goes live, e.g. to re-warm the cache.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, alias=MODEL_ALIAS,
+                 before_swap=None):
+        self.model_name = model_name
+        self.alias = alias
+        self.before_swap = before_swap
+        self._state = None
+        self._lock = threading.Lock()
+        self.swaps = 0
+        self.last_check = None
+        self.last_error = None
+
+    def install(self, model, version="local", digest=None):
+        # serve `model` right away, without the registry
+        self._state = ModelState(model, version, time.time(), 0.0,
+                                 digest or model_digest(model))
+        return self._state
+
+    def peek_state(self):
+        return self._state
+
+    def peek(self):
+        # model in memory or None, never loads
+        state = self._state
+        return state.model if state else None
+
+    def get_state(self):
+        state = self._state
+        if state is None:
+            # startup load failed or never ran, try again now
+            state = self.refresh()
+        return state
+
+    def get(self):
+        state = self.get_state()
+        return state.model if state else None
+
+    @property
+    def version(self):
+        state = self._state
+        return state.version if state else None
+
+    def refresh(self, force=False):
+        with self._lock:
+            self.last_check = time.time()
+            version = resolve_model_version(self.model_name, self.alias)
+            state = self._state
+            if state is not None and not force:
+                # registry unreachable or nothing new: keep serving
+                if version is None or version == state.version:
+                    return state
+
+            start = time.perf_counter()
+            try:
+                with METRICS.stage("model_load"):
+                    model = load_artifact(model_name=self.model_name,
+                                          alias=version or self.alias)
+                    digest = model_digest(model)
+                    model = build_engine(model)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Model refresh failed, keep current model: {e}")
+                return state
+
+            new_state = ModelState(model, version or "local", time.time(),
+                                   time.perf_counter() - start, digest)
+            if state is not None:
+                if self.before_swap is not None:
+                    try:
+                        self.before_swap(new_state)
+                    except Exception as e:
+                        print(f"before_swap failed, swap anyway: {e}")
+                self.swaps += 1
+                print(f"Model swapped: {state.version} -> "
+                      f"{new_state.version}")
+            self._state = new_state
+            self.last_error = None
+            return new_state
+
+    def status(self):
+        state = self._state
+        return {
+            "model_name": self.model_name,
+            "alias": self.alias,
+            "loaded": state is not None,
+            "engine": engine_name(state.model) if state else None,
+            "version": state.version if state else None,
+            "digest": state.digest if state else None,
+            "loaded_at": state.loaded_at if state else None,
+            "load_seconds": round(state.load_seconds, 4) if state else None,
+            "swaps": self.swaps,
+            "last_check": self.last_check,
+            "last_error": self.last_error}
+
+
+# ======================
+# = Hot Keys / Re-warm =
+# ======================
+class HotKeys:
+    """
+    Hot Key Tracker
+    Counts how often each normalized text is requested, with
+    the last label seen, so a new model can re-score the most
+    requested texts before it takes over. Holds at most about
+    max_size texts, the rarest are dropped first.
+    """
+
+    def __init__(self, max_size=HOT_KEYS_SIZE):
+        self.max_size = max(1, max_size)
+        self._counts = Counter()
+        self._labels = {}
+        self._lock = threading.Lock()
+
+    def touch(self, text, true_label):
+        with self._lock:
+            self._counts[text] += 1
+            self._labels[text] = true_label
+            if len(self._counts) > 2 * self.max_size:
+                # amortized: prune only once the map doubled
+                self._counts = Counter(
+                    dict(self._counts.most_common(self.max_size)))
+                self._labels = {t: self._labels[t] for t in self._counts}
+
+    def top(self, n):
+        # [(text, true_label)] of the n most requested texts
+        with self._lock:
+            return [(text, self._labels[text])
+                    for text, _ in self._counts.most_common(n)]
+
+    def __len__(self):
+        return len(self._counts)
+
+
+HOT_KEYS = HotKeys()
+REWARM_STATS = {"runs": 0, "items": 0, "failed": 0, "seconds": 0.0}
+
+
+def rewarm_cache(new_state, top_n=None):
+    # Score the hottest texts with the new model and write them
+    # under its cache namespace, before it serves any request.
+    # Runs on the thread doing the refresh, never on the event loop.
+    top_n = REWARM_TOP_N if top_n is None else top_n
+    hot = HOT_KEYS.top(top_n) if top_n > 0 else []
+    if not hot:
+        return 0
+    start = time.perf_counter()
+    preds = new_state.model.predict([text for text, _ in hot])
+    records = []
+    for (text, true_label), prediction in zip(hot, preds):
+        record = build_log_record(text, CATEGORY[int(prediction)],
+                                  true_label, new_state)
+        record["source"] = "rewarm"
+        records.append(record)
+    # the store only: the local log file keeps real requests
+    failed, _ = STORE.call(lambda store: store.batch_put(records),
+                           write=True)
+    for record in records:
+        LOCAL_CACHE.put(record["text_hash"], record["predicted_bought"])
+    REWARM_STATS["runs"] += 1
+    REWARM_STATS["items"] += len(records) - failed
+    REWARM_STATS["failed"] += failed
+    REWARM_STATS["seconds"] = round(time.perf_counter() - start, 4)
+    print(f"Re-warmed {len(records) - failed} cache items "
+          f"for model {new_state.version}")
+    return len(records) - failed
+
+
+MODEL_HOLDER = ModelHolder(before_swap=rewarm_cache)
+
+
+async def current_state():
+    # no thread hop once the model is in memory,
+    # a (re)load runs on the io pool
+    state = MODEL_HOLDER.peek_state()
+    if state is None:
+        state = await run_io(MODEL_HOLDER.get_state)
+    return state
+
+
+async def poll_model_registry(holder, interval):
+    # Background task: check the registry every `interval` seconds.
+    # Download and unpickle run in a worker thread.
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_io(holder.refresh)
+        except Exception as e:
+            print(f"Model registry poll failed: {e}")
+
+
+# ==========================
+# = Micro-Batching Scorer  =
+# ==========================
+class MicroBatcher:
+    """
+    Micro-Batching Scheduler
+    Concurrent /predict cache misses wait in a queue for up to
+    max_wait_ms or until max_size texts are collected, then one
+    vectorized model.predict call per model state scores the batch
+    and every caller gets its own result back.
+    """
+
+    def __init__(self, max_size=MICROBATCH_MAX_SIZE,
+                 max_wait_ms=MICROBATCH_MAX_WAIT_MS):
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = None
+        self._task = None
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.last_batch_size = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        # nobody will score what is left, fail the waiting callers
+        while not self._queue.empty():
+            _, _, fut, _ = self._queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError("micro-batcher stopped"))
+
+    async def predict(self, text, state=None):
+        # `state` is the ModelState the request resolved, so a model
+        # swap while the item waits does not change who scores it
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, state, fut, time.perf_counter()))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._score(batch)
+
+    async def _score(self, batch):
+        started = time.perf_counter()
+        waits = [started - queued for _, _, _, queued in batch]
+        self.batches += 1
+        self.items += len(batch)
+        self.last_batch_size = len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.total_wait += sum(waits)
+        self.max_wait_seen = max(self.max_wait_seen, max(waits))
+
+        # one model.predict call per state in the batch
+        groups = {}
+        for item in batch:
+            state = item[1]
+            if state is None:
+                state = await current_state()
+            groups.setdefault(id(state), (state, []))[1].append(item)
+        for state, items in groups.values():
+            await self._score_group(state, items)
+
+    async def _score_group(self, state, items):
+        try:
+            if state is None:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Model is not loaded. Cannot make predictions.")
+            texts = [text for text, _, _, _ in items]
+            preds = await run_scoring(state.model.predict, texts)
+        except Exception as e:
+            for _, _, fut, _ in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, _, fut, _), prediction in zip(items, preds):
+            if not fut.done():
+                fut.set_result(CATEGORY[int(prediction)])
+
+    def status(self):
+        return {
+            "enabled": self.running,
+            "max_size": self.max_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": (round(self.items / self.batches, 2)
+                               if self.batches else 0.0),
+            "largest_batch": self.largest_batch,
+            "last_batch_size": self.last_batch_size,
+            "avg_wait_ms": (round(self.total_wait / self.items * 1000, 3)
+                            if self.items else 0.0),
+            "max_wait_ms_seen": round(self.max_wait_seen * 1000, 3)}
+
+
+MICRO_BATCHER = MicroBatcher()
+
+
+# =================
+# = Single Flight =
+# =================
+class SingleFlight:
+    """
+    Single-Flight Request Coalescing
+    The first request for a key runs the work, identical requests
+    that arrive while it is in flight wait on the same task and get
+    its result (or its error). So a burst of one text does one
+    cache lookup, one model call and one log write.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self._waiters = {}
+
+    async def do(self, key, work):
+        # `work` is a coroutine function, called once per flight
+        task = self._flights.get(key)
+        if task is None:
+            self.leaders += 1
+            # its own task: a cancelled caller does not cancel the others
+            task = asyncio.ensure_future(work())
+            self._flights[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda _: self._land(key))
+        else:
+            self.coalesced += 1
+            self._waiters[key] += 1
+            self.max_waiters = max(self.max_waiters, self._waiters[key])
+        return await asyncio.shield(task)
+
+    def in_flight(self, key):
+        return key in self._flights
+
+    def _land(self, key):
+        self._flights.pop(key, None)
+        self._waiters.pop(key, None)
+
+    def status(self):
+        return {
+            "enabled": SINGLE_FLIGHT_ENABLED,
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "max_waiters": self.max_waiters}
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load the model and open the store once
+    # before serving the first request,
+    # a serve.py worker inherits the master's model
+    if MODEL_HOLDER.peek_state() is None:
+        await run_io(MODEL_HOLDER.refresh)
+    try:
+        await run_io(STORE.get)
+    except Exception as e:
+        # keep serving, the handle retries on the next request
+        print(f"[STORE] Could not connect at startup: {e}")
+    poller = None
+    if MODEL_POLL_SECONDS > 0:
+        poller = asyncio.create_task(
+            poll_model_registry(MODEL_HOLDER, MODEL_POLL_SECONDS))
+    if MICROBATCH_ENABLED:
+        MICRO_BATCHER.start()
+    if LOG_WRITE_BEHIND:
+        LOG_WRITER.start()
+    yield
+    await MICRO_BATCHER.stop()
+    # flush queued log records before the process exits
+    await run_io(LOG_WRITER.stop)
+    if poller is not None:
+        poller.cancel()
+        with suppress(asyncio.CancelledError):
+            await poller
+
+
 class TextInput(BaseModel):
     text: str = Field(...,
                       json_schema_extra={"example": "I loved this book.\
@@ -203,12 +1273,56 @@ class TextInput(BaseModel):
                         json_schema_extra={"example": "Positive"})
 
 
+class BatchInput(BaseModel):
+    items: List[TextInput] = Field(
+        ...,
+        json_schema_extra={"example": [
+            {"text": "Four Stars. compelling read", "bought": "Negative"},
+            {"text": "Five Stars. Gift for my mom", "bought": "Positive"}]})
+
+
+# ==================
+# = Traffic Source =
+# ==================
+# Load tests, evaluation runs, replays and benchmarks send this header.
+# Their records are logged with that `source`, and feedback readers
+# (replay.py, the model refresh) skip them.
+TRAFFIC_SOURCE_HEADER = b"x-traffic-source"
+_traffic_source = contextvars.ContextVar("traffic_source", default=None)
+
+
+class TrafficSourceMiddleware:
+    # plain ASGI, so the handler runs in the same task and sees it
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        source = None
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == TRAFFIC_SOURCE_HEADER:
+                    source = value.decode("latin-1")[:32] or None
+        if source is None:
+            await self.app(scope, receive, send)
+            return
+        token = _traffic_source.set(source)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _traffic_source.reset(token)
+
+
 # ====================
 # = Predict Endpoint =
 # ====================
 app = FastAPI(
     title="Personalized Book Recommender",
+    lifespan=lifespan,
 )
+# times /predict and /predict/batch, adds the Server-Timing header
+app.add_middleware(MetricsMiddleware, get_metrics=lambda: METRICS,
+                   paths=["/predict", "/predict/batch"])
+app.add_middleware(TrafficSourceMiddleware)
 
 
 @app.get("/health")
@@ -218,17 +1332,83 @@ def health():
     This endpoint is used to verify that the
     API server is running and responsive.
     It's a common practice for monitoring services.
+    While the store breaker is open the API still answers
+    from the model, so it reports "degraded", not an error.
     """
-    return {"status": "ok"}
+    breaker = STORE.breaker.state
+    return {"status": "ok" if breaker == CircuitBreaker.CLOSED
+            else "degraded",
+            "store_breaker": breaker}
 
 
-@app.post("/predict")
-async def predict(input_data: TextInput):
+@app.get("/status")
+def service_status():
     """
-    Prediction Endpoint
-    Takes a feature vector and returns predicted book list.
+    Status Endpoint
+    Reports which model version is served, when and how
+    fast it was loaded, the shared cache/log store, the
+    micro-batching queue, the write-behind log queue, the
+    in-process cache, request coalescing and the re-warm of
+    the last model swap.
+    """
+    return {"model": MODEL_HOLDER.status(),
+            "store": STORE.status(),
+            "batcher": MICRO_BATCHER.status(),
+            "log_writer": LOG_WRITER.status(),
+            "local_cache": LOCAL_CACHE.status(),
+            "single_flight": SINGLE_FLIGHT.status(),
+            "rewarm": dict(REWARM_STATS, hot_keys=len(HOT_KEYS))}
+
+
+def metric_gauges():
+    # (name, labels, value) of every number in the /status
+    # sections, plus the served model and the cache hit ratio
+    gauges = []
+    state = MODEL_HOLDER.peek_state()
+    if state is not None:
+        gauges.append(("model_info", (
+            ("version", state.version), ("digest", state.digest),
+            ("engine", engine_name(state.model))), 1))
+    tiers = {labels[0][1]: value
+             for (name, labels), value in METRICS.counters.items()
+             if name == "predict_cache_total"}
+    total = sum(tiers.values())
+    hits = total - tiers.get("miss", 0)
+    gauges.append(("cache_hit_ratio", (), hits / total if total else 0.0))
+    breaker = STORE.breaker.status()
+    for value in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN,
+                  CircuitBreaker.HALF_OPEN):
+        gauges.append(("store_breaker_state", (("state", value),),
+                       breaker["state"] == value))
+    sections = {"model": MODEL_HOLDER.status(),
+                "local_cache": LOCAL_CACHE.status(),
+                "single_flight": SINGLE_FLIGHT.status(),
+                "batcher": MICRO_BATCHER.status(),
+                "log_writer": LOG_WRITER.status(),
+                "store_breaker": breaker,
+                "rewarm": dict(REWARM_STATS, hot_keys=len(HOT_KEYS))}
+    for section, info in sections.items():
+        for key, value in info.items():
+            if isinstance(value, (bool, int, float)):
+                gauges.append((f"{section}_{key}", (), value))
+    return gauges
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Metrics Endpoint
+    Per-stage and per-request latency histograms, cache
+    tier counters, the served model and the in-flight
+    requests in the Prometheus text format.
     """
+    return PlainTextResponse(METRICS.render(metric_gauges()),
+                             media_type="text/plain; version=0.0.4")
 
+
+def validate_input(input_data):
+    # Return the cleaned (text, true_label) pair of one request,
+    # or raise HTTPException for a bad record.
     text_val = input_data.text
     if text_val is None:
         raise HTTPException(
@@ -240,7 +1420,7 @@ async def predict(input_data: TextInput):
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail="review must be string.")
 
-    text = text_val.strip()
+    text = normalize_text(text_val)
     if not text:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -262,35 +1442,192 @@ async def predict(input_data: TextInput):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="True_bought can only be either negative or positive.")
+    return text, true_label
+
 
-    # 1) After getting book name, check if it is already cached in the
-    # DynamoDB. set True if you want code to auto-create table
-    table = ensure_table(create_if_missing=True)
-    print("Table status:", table.table_status)
-    item = query_dynamodb_cache(text, table=table)
-
-    if item:
-        # Cache hit: return the stored predicted sentiment
-        # item may store predicted_bought as string
-        pred = item.get("predicted_bought")
-        return {"predicted_bought": pred, "cached": True}
-
-    # 2) Not found in DB => do prediction
-    model = load_artifact(model_name="MultinomialNB-artifact",
-                          alias="latest")
-    if model is None:
+@app.post("/predict")
+async def predict(input_data: TextInput):
+    """
+    Prediction Endpoint
+    Takes a feature vector and returns predicted book list.
+    """
+
+    text, true_label = validate_input(input_data)
+    HOT_KEYS.touch(text, true_label)
+    # one state for the whole request: the cache namespace and
+    # the scoring model always belong to the same version
+    state = await current_state()
+    key = cache_key(text, state.digest if state else None)
+
+    # 1) After getting book name, check the in-process cache
+    with METRICS.stage("memory_cache"):
+        pred = LOCAL_CACHE.get(key)
+    if pred is not None and pred is not LocalCache.MISS:
+        out = {"predicted_bought": pred, "cached": "memory"}
+    else:
+        resolve = functools.partial(resolve_prediction, text, true_label,
+                                    key, state, check_ddb=pred is None)
+        if not SINGLE_FLIGHT_ENABLED:
+            out = await resolve()
+        elif SINGLE_FLIGHT.in_flight(key):
+            # identical texts in flight share one result, each caller
+            # gets its own copy of the response
+            with METRICS.stage("coalesced_wait"):
+                out = dict(await SINGLE_FLIGHT.do(key, resolve))
+        else:
+            out = dict(await SINGLE_FLIGHT.do(key, resolve))
+    METRICS.inc("predict_cache_total",
+                (("tier", out.get("cached") or "miss"),))
+    return out
+
+
+async def resolve_prediction(text, true_label, key, state, check_ddb=True):
+    # Cache miss path of /predict: store lookup, scoring and
+    # the log write of one text.
+    # 2) Check the store (DynamoDB by default). The handle is shared
+    # by all requests; the tier and stage are named after the backend.
+    # A slow or broken store costs at most the lookup budget.
+    if check_ddb:
+        with METRICS.stage(f"{STORE.backend}_get"):
+            ok, item = await store_lookup(
+                lambda store: query_cache(text, store, key))
+        if item:
+            # Cache hit: return the stored predicted sentiment
+            # item may store predicted_bought as string
+            pred = item.get("predicted_bought")
+            LOCAL_CACHE.put(key, pred)
+            return {"predicted_bought": pred, "cached": STORE.backend}
+        if ok:
+            LOCAL_CACHE.put_miss(key)
+
+    if state is None:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Model is not loaded. Cannot make predictions."
         )
-
-    category = ["Negative", "Positive"]
-    prediction = model.predict([text])[0]
-    pred = category[int(prediction)]
-    log_cache(text, pred, true_label, table)
+    # 3) Not found in DB => do prediction with the in-memory model,
+    # coalesced with other concurrent misses when micro-batching is on
+    with METRICS.stage("score"):
+        if MICRO_BATCHER.running:
+            pred = await MICRO_BATCHER.predict(text, state)
+        else:
+            prediction = (await run_scoring(state.model.predict,
+                                            [text]))[0]
+            pred = CATEGORY[int(prediction)]
+    LOCAL_CACHE.put(key, pred)
+    record = build_log_record(text, pred, true_label, state)
+    with METRICS.stage("log"):
+        if not await enqueue_logs([record]):
+            # the IO thread does not see the request's traffic source
+            await run_io(log_cache, text, pred, true_label, state,
+                         record.get("source"))
 
     return {"predicted_bought": pred}
 
+
+@app.post("/predict/batch")
+async def predict_batch(batch: BatchInput):
+    """
+    Batch Prediction Endpoint
+    Takes many reviews at once. Cache hits come from the in-process
+    cache or one BatchGetItem per 100 keys, all misses are scored with
+    a single model.predict call and written with BatchWriteItem.
+    """
+
+    if not batch.items:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="items cannot be empty.")
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {BATCH_MAX_ITEMS} items per batch.")
+
+    records = []
+    for idx, input_data in enumerate(batch.items):
+        try:
+            records.append(validate_input(input_data))
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code,
+                                detail=f"items[{idx}]: {e.detail}")
+
+    for text, true_label in records:
+        HOT_KEYS.touch(text, true_label)
+    state = await current_state()
+    namespace = state.digest if state else None
+
+    # 1) Resolve all cache hits at once: in-process tier first,
+    # one BatchGetItem per 100 keys for the rest
+    hashes = [cache_key(text, namespace) for text, _ in records]
+    memory, known_misses = {}, set()
+    with METRICS.stage("memory_cache"):
+        for text_hash in hashes:
+            pred = LOCAL_CACHE.get(text_hash)
+            if pred is LocalCache.MISS:
+                known_misses.add(text_hash)
+            elif pred is not None:
+                memory[text_hash] = pred
+    lookup = [h for h in hashes if h not in memory and h not in known_misses]
+    found, ok = {}, True
+    if lookup:
+        with METRICS.stage(f"{STORE.backend}_batch_get"):
+            ok, found = await store_lookup(
+                lambda store: store.batch_get(lookup))
+        found = found or {}
+    for text_hash in lookup:
+        if text_hash in found:
+            LOCAL_CACHE.put(text_hash,
+                            found[text_hash].get("predicted_bought"))
+        elif ok:
+            LOCAL_CACHE.put_miss(text_hash)
+
+    # 2) Score every distinct miss in one vectorized call
+    misses = {}
+    for (text, true_label), text_hash in zip(records, hashes):
+        if (text_hash not in memory and text_hash not in found
+                and text_hash not in misses):
+            misses[text_hash] = (text, true_label)
+
+    preds = {}
+    if misses:
+        if state is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Model is not loaded. Cannot make predictions.")
+        texts = [text for text, _ in misses.values()]
+        with METRICS.stage("score"):
+            scored = await run_scoring(state.model.predict, texts)
+        for text_hash, prediction in zip(misses, scored):
+            preds[text_hash] = CATEGORY[int(prediction)]
+            LOCAL_CACHE.put(text_hash, preds[text_hash])
+        new_records = [build_log_record(text, preds[h], true_label, state)
+                       for h, (text, true_label) in misses.items()]
+        with METRICS.stage("log"):
+            if not await enqueue_logs(new_records):
+                await run_io(log_cache_batch, new_records)
+
+    results = []
+    for text_hash in hashes:
+        if text_hash in memory:
+            results.append({"predicted_bought": memory[text_hash],
+                            "cached": "memory"})
+        elif text_hash in found:
+            results.append({
+                "predicted_bought": found[text_hash].get("predicted_bought"),
+                "cached": STORE.backend})
+        else:
+            results.append({"predicted_bought": preds[text_hash]})
+    for tier, count in [("memory", len(memory)),
+                        (STORE.backend,
+                         sum(1 for h in hashes if h in found)),
+                        ("miss", len(misses))]:
+        METRICS.inc("predict_cache_total", (("tier", tier),), count)
+    return {"results": results,
+            "cache_hits": sum(1 for h in hashes
+                              if h in memory or h in found),
+            "memory_hits": sum(1 for h in hashes if h in memory),
+            "scored": len(misses)}
+
 # uvicorn main:app --reload
 # curl 'http://127.0.0.1:8000/health'
 # POST http://localhost:8000/predict?text=This%20movie%20was
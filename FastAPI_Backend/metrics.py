@@ -0,0 +1,250 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# full: histograms + Server-Timing header, light: histograms only,
+# off: nothing is timed
+METRICS_MODE = os.environ.get("METRICS_MODE", "full")
+# upper bounds in seconds, like the prometheus_client defaults
+# with finer steps below 10 ms
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (stage, seconds) of the running request, only set in full mode.
+# Work handed to a thread pool does not see it, so the stages
+# are timed around the await on the event loop.
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+# =============
+# = Histogram =
+# =============
+class Histogram:
+    """
+    Latency Histogram
+    Cumulative buckets, sum and count in the Prometheus sense.
+    One bisect and three additions per observation.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        # ([(le, cumulative count)], sum, count)
+        with self._lock:
+            counts, total, n = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for le, c in zip(self.buckets + (float("inf"),), counts):
+            running += c
+            cumulative.append((le, running))
+        return cumulative, total, n
+
+
+# ============
+# = Registry =
+# ============
+class Metrics:
+    """
+    Predict Path Metrics
+    Stage latency histograms, request histograms per path,
+    counters and the in-flight gauge, rendered in the
+    Prometheus text format by render().
+    """
+
+    def __init__(self, mode=METRICS_MODE, prefix="backend"):
+        if mode not in ("full", "light", "off"):
+            raise ValueError(f"Unknown METRICS_MODE {mode!r}")
+        self.mode = mode
+        self.prefix = prefix
+        self.stages = {}
+        self.requests = {}
+        self.counters = {}
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def _histogram(self, table, key):
+        hist = table.get(key)
+        if hist is None:
+            with self._lock:
+                hist = table.setdefault(key, Histogram())
+        return hist
+
+    def observe(self, stage_name, seconds):
+        if not self.enabled:
+            return
+        self._histogram(self.stages, stage_name).observe(seconds)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage_name, seconds))
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def inc(self, name, labels=(), value=1):
+        # labels: tuple of (key, value) pairs
+        key = (name, tuple(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # ===========
+    # = Request =
+    # ===========
+    def begin_request(self):
+        # Return a token for end_request, or None when off
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.in_flight += 1
+        timings = [] if self.mode == "full" else None
+        return (time.perf_counter(), _request_timings.set(timings))
+
+    def server_timing(self, token):
+        # Server-Timing header value of the stages seen so far
+        if token is None:
+            return None
+        timings = _request_timings.get()
+        if timings is None:
+            return None
+        elapsed = time.perf_counter() - token[0]
+        parts = [f"{name};dur={seconds * 1000:.2f}"
+                 for name, seconds in timings]
+        parts.append(f"total;dur={elapsed * 1000:.2f}")
+        return ", ".join(parts)
+
+    def end_request(self, token, path):
+        if token is None:
+            return
+        start, reset = token
+        self._histogram(self.requests, path).observe(
+            time.perf_counter() - start)
+        with self._lock:
+            self.in_flight -= 1
+        _request_timings.reset(reset)
+
+    # ==========
+    # = Render =
+    # ==========
+    def render(self, gauges=()):
+        # gauges: (name, labels, value) triples added as they are
+        p = self.prefix
+        lines = [f"# TYPE {p}_stage_seconds histogram"]
+        for name, hist in sorted(self.stages.items()):
+            lines += _histogram_lines(f"{p}_stage_seconds",
+                                      f'stage="{name}"', hist)
+        lines.append(f"# TYPE {p}_request_seconds histogram")
+        for path, hist in sorted(self.requests.items()):
+            lines += _histogram_lines(f"{p}_request_seconds",
+                                      f'path="{path}"', hist)
+        lines.append(f"# TYPE {p}_requests_in_flight gauge")
+        lines.append(f"{p}_requests_in_flight {self.in_flight}")
+
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {p}_{name} counter")
+            lines.append(f"{p}_{name}{_labels(labels)} {value}")
+        for name, labels, value in gauges:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# ==============
+# = Middleware =
+# ==============
+class MetricsMiddleware:
+    """
+    ASGI Timing Middleware
+    Times every request to one of `paths`, counts it as in flight
+    and, in full mode, adds a Server-Timing header with the stages
+    the handler recorded. Plain ASGI, so the handler runs in the
+    same task and sees the per-request context.
+    """
+
+    def __init__(self, app, get_metrics, paths):
+        self.app = app
+        # called per request, so a swapped registry is picked up
+        self.get_metrics = get_metrics
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        metrics = self.get_metrics()
+        token = metrics.begin_request()
+        if token is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                value = metrics.server_timing(token)
+                if value is not None:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", value.encode()))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            metrics.end_request(token, scope["path"])
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+    return "{" + inner + "}"
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _histogram_lines(metric, label, hist):
+    cumulative, total, count = hist.snapshot()
+    lines = []
+    for le, running in cumulative:
+        bound = "+Inf" if le == float("inf") else repr(le)
+        lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {running}')
+    lines.append(f"{metric}_sum{{{label}}} {total}")
+    lines.append(f"{metric}_count{{{label}}} {count}")
+    return lines
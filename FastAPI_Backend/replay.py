@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import httpx
+from boto3.dynamodb.types import TypeDeserializer
+from evaluate import TRAFFIC_SOURCE_HEADER, run_phase, summarize
+
+
+# ==================
+# = Read Traffic   =
+# ==================
+def _open(path):
+    # DynamoDB exports to S3 come gzipped
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def _record(row):
+    # (timestamp, text, label) of one log record, or None when it is
+    # not a real request (re-warm, load test, evaluation, replay...).
+    # Older logs call the label true_sentiment.
+    if row.get("source"):
+        return None
+    text = row.get("request_text")
+    label = row.get("true_record") or row.get("true_sentiment")
+    ts = row.get("timestamp")
+    if not text or not label or ts is None:
+        return None
+    return float(ts), text, str(label).capitalize()
+
+
+def read_log_file(path):
+    # ./logs/prediction_logs.json: one JSON record per line,
+    # half-written or corrupt lines are skipped
+    records = []
+    with _open(path) as f:
+        for line in f:
+            try:
+                rec = _record(json.loads(line))
+            except (json.JSONDecodeError, AttributeError, ValueError):
+                continue
+            if rec is not None:
+                records.append(rec)
+    return records
+
+
+def read_dynamodb_export(path):
+    # Either an S3 export (one {"Item": {...typed...}} per line)
+    # or the output of `aws dynamodb scan` ({"Items": [...]})
+    deserializer = TypeDeserializer()
+
+    def plain(item):
+        return {k: deserializer.deserialize(v) for k, v in item.items()}
+
+    with _open(path) as f:
+        content = f.read()
+    try:
+        doc = json.loads(content)
+    except json.JSONDecodeError:
+        doc = None
+    if isinstance(doc, dict) and "Items" in doc:
+        rows = [plain(item) for item in doc["Items"]]
+    else:
+        rows = []
+        for line in content.splitlines():
+            try:
+                rows.append(plain(json.loads(line)["Item"]))
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue
+    records = []
+    for row in rows:
+        try:
+            rec = _record(row)
+        except (AttributeError, ValueError):
+            continue
+        if rec is not None:
+            records.append(rec)
+    return records
+
+
+def build_schedule(records, speed=1.0, max_gap=0.0, limit=0):
+    # Sort by time and turn timestamps into send offsets in seconds.
+    # `speed` 10 replays ten times faster, `max_gap` > 0 cuts idle
+    # periods down to that many (recorded) seconds.
+    records = sorted(records)
+    if limit > 0:
+        records = records[:limit]
+    offsets, entries = [], []
+    elapsed, prev = 0.0, None
+    for ts, text, label in records:
+        if prev is not None:
+            gap = ts - prev
+            if max_gap > 0:
+                gap = min(gap, max_gap)
+            elapsed += gap
+        prev = ts
+        offsets.append(elapsed / speed)
+        entries.append({"text": text, "bought": label})
+    return entries, offsets
+
+
+# ==========
+# = Report =
+# ==========
+def window_report(rows, window):
+    # summarize() per `window` seconds of replay time, by send time
+    buckets = {}
+    for row in rows:
+        buckets.setdefault(int(row[6] // window), []).append(row)
+    report = []
+    for index in sorted(buckets):
+        summary = summarize(buckets[index], window)
+        ok = summary["ok"]
+        hits = ok - summary["cache_tiers"].get("miss", 0)
+        summary["start_seconds"] = index * window
+        summary["cache_hit_ratio"] = round(hits / ok, 4) if ok else None
+        report.append(summary)
+    return report
+
+
+async def replay(entries, offsets, base_url, concurrency=256, window=10.0,
+                 timeout=30.0, transport=None):
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=timeout,
+            transport=transport,
+            headers={TRAFFIC_SOURCE_HEADER: "replay"}) as client:
+        rows, wall = await run_phase(client, entries, concurrency,
+                                     offsets=offsets)
+    total = summarize(rows, wall)
+    ok = total["ok"]
+    total["cache_hit_ratio"] = (
+        round((ok - total["cache_tiers"].get("miss", 0)) / ok, 4)
+        if ok else None)
+    return {"total": total, "windows": window_report(rows, window)}
+
+
+# =================
+# = Start Program =
+# =================
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded /predict traffic against a backend")
+    parser.add_argument("--logs", nargs="*",
+                        default=["./logs/prediction_logs.json"],
+                        help="prediction log files (JSON lines)")
+    parser.add_argument("--ddb-export", nargs="*", default=[],
+                        help="DynamoDB export or scan output files")
+    parser.add_argument("--url", default=os.getenv("BACKEND_URL",
+                                                   "http://127.0.0.1:8000"))
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="10 replays ten times faster")
+    parser.add_argument("--max-gap", type=float, default=0.0,
+                        help="cut idle periods to this many seconds")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--window", type=float, default=10.0,
+                        help="report window in seconds of replay time")
+    parser.add_argument("--concurrency", type=int, default=256,
+                        help="requests in flight at most")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--out", default="./logs/replay_results.json")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    records = []
+    for path in args.logs:
+        records += read_log_file(path)
+    for path in args.ddb_export:
+        records += read_dynamodb_export(path)
+    # the same request in the file and in the export is sent once
+    records = list(dict.fromkeys(records))
+    entries, offsets = build_schedule(records, args.speed, args.max_gap,
+                                      args.limit)
+    if not entries:
+        print("No requests to replay.")
+        return None
+    print(f"Replaying {len(entries)} requests over "
+          f"{offsets[-1]:.1f} s against {args.url}")
+    report = asyncio.run(replay(entries, offsets, args.url.rstrip("/"),
+                                args.concurrency, args.window,
+                                args.timeout))
+    for w in report["windows"]:
+        print(f"[{w['start_seconds']:>7.1f}s] {w['requests']:>5} req, "
+              f"p50 {w['p50_ms']} ms, p99 {w['p99_ms']} ms, "
+              f"hit ratio {w['cache_hit_ratio']}, errors {w['errors']}")
+    print(f"total: {report['total']}")
+    report["config"] = dict(vars(args))
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Replay results written to {args.out}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
+
+# python3 replay.py --speed 10 --window 5
+# python3 replay.py --logs ./logs/prediction_logs_moive.json --max-gap 1
+# python3 replay.py --logs --ddb-export ./export/data/abc.json.gz --speed 60
@@ -0,0 +1,427 @@
+import hashlib
+import json
+import os
+import re
+import sys
+import joblib
+import numpy as np
+
+try:
+    # optional, only needed for INFERENCE_ENGINE=onnx
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# sklearn's default token_pattern for TfidfVectorizer
+TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+# pickle-free artifact: .npy arrays + manifest.json in one directory,
+# written by save_mmap() (train_model.py calls it too)
+MMAP_FORMAT = "tfidf-nb-mmap"
+MMAP_FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+# ONNX export: onnxruntime's tokenizer uses RE2, which has no (?u)
+# and an ASCII-only \w, so TOKEN_PATTERN is spelled out with Unicode
+# classes. Model_Management/train_model.py exports with this module.
+ONNX_TOKEN_EXP = r"[\p{L}\p{N}_]{2,}"
+ONNX_LOCALE = "C.UTF-8"
+ONNX_OPSET = 17
+
+
+# =====================
+# = Sorted Vocabulary =
+# =====================
+class SortedVocabulary:
+    """
+    Pickle-free Vocabulary Table
+    All terms as UTF-8 in one byte blob, grouped by byte length and
+    sorted inside each group, plus the column of every term. Terms
+    of one length form a fixed-width array, so a batch of tokens is
+    looked up with one np.searchsorted per length. Works on
+    memory-mapped arrays: nothing is copied at load time.
+    """
+
+    def __init__(self, blob, starts, columns):
+        # blob: uint8, starts[L]..starts[L + 1]: terms of L bytes
+        self.blob = blob
+        self.starts = np.asarray(starts)
+        self.columns = columns
+        self._tables = {}
+        offset = 0
+        for length in range(1, len(self.starts) - 1):
+            count = int(self.starts[length + 1] - self.starts[length])
+            if count:
+                end = offset + count * length
+                self._tables[length] = blob[offset:end].view(f"S{length}")
+                offset = end
+
+    @classmethod
+    def from_dict(cls, vocabulary):
+        return cls(*build_vocabulary_table(vocabulary))
+
+    def __len__(self):
+        return len(self.columns)
+
+    def lookup(self, tokens):
+        # column of every token, -1 when it is not in the vocabulary
+        encoded = [t.encode("utf-8") for t in tokens]
+        groups = {}
+        for i, term in enumerate(encoded):
+            groups.setdefault(len(term), []).append(i)
+        cols = np.full(len(encoded), -1, dtype=np.int64)
+        for length, idx in groups.items():
+            table = self._tables.get(length)
+            if table is None:
+                continue
+            first = self.starts[length]
+            if len(idx) <= 2:
+                # a single request has a few tokens per length, building
+                # arrays for them costs more than the search itself
+                for i in idx:
+                    pos = int(np.searchsorted(table, encoded[i]))
+                    if pos < len(table) and table[pos] == encoded[i]:
+                        cols[i] = self.columns[first + pos]
+                continue
+            idx = np.array(idx)
+            probe = np.array([encoded[i] for i in idx], dtype=table.dtype)
+            pos = np.minimum(np.searchsorted(table, probe), len(table) - 1)
+            hit = table[pos] == probe
+            cols[idx[hit]] = self.columns[first + pos[hit]]
+        return cols
+
+    def items(self):
+        for length, table in self._tables.items():
+            first = int(self.starts[length])
+            for i, term in enumerate(table.tolist()):
+                yield term.decode("utf-8"), int(self.columns[first + i])
+
+
+def build_vocabulary_table(vocabulary):
+    # (blob, starts, columns) of a {term: column} dict
+    terms = sorted((term.encode("utf-8"), col)
+                   for term, col in vocabulary.items())
+    terms.sort(key=lambda item: len(item[0]))  # stable: sorted per length
+    max_len = max((len(t) for t, _ in terms), default=0)
+    counts = np.bincount([len(t) for t, _ in terms], minlength=max_len + 1)
+    starts = np.zeros(max_len + 2, dtype=np.int64)
+    starts[1:] = np.cumsum(counts)
+    blob = np.frombuffer(b"".join(t for t, _ in terms), dtype=np.uint8)
+    columns = np.array([col for _, col in terms], dtype=np.int32)
+    return blob, starts, columns
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# =========================
+# = Compiled NumPy Scorer =
+# =========================
+class NumpyScorer:
+    """
+    Compiled TF-IDF + MultinomialNB Scorer
+    Holds only what inference needs from the fitted pipeline:
+    the vocabulary-to-column map, the IDF vector and the
+    per-class feature_log_prob_ / class_log_prior_ arrays.
+    A text is tokenized like sklearn (lowercase + token_pattern),
+    weighted by tf-idf, l2-normalized and scored with a sparse
+    dot product, so predictions match Pipeline.predict.
+    """
+
+    def __init__(self, vocabulary, idf, feature_log_prob, class_log_prior,
+                 classes, norm="l2", sublinear_tf=False,
+                 token_pattern=TOKEN_PATTERN, digest=None):
+        # vocabulary: {term: column} or a SortedVocabulary
+        self.vocabulary = vocabulary
+        # content hash of a loaded artifact, None otherwise
+        self.digest = digest
+        self.idf = np.asarray(idf)
+        self.feature_log_prob = np.asarray(feature_log_prob)
+        # one row per feature, so a document gathers its rows at once
+        self.weights = np.ascontiguousarray(self.feature_log_prob.T)
+        self.class_log_prior = np.asarray(class_log_prior)
+        self.classes = np.asarray(classes)
+        self.norm = norm
+        self.sublinear_tf = sublinear_tf
+        self.token_pattern = token_pattern
+        self._findall = re.compile(token_pattern).findall
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        # Only the settings create_pipeline uses are supported,
+        # anything else raises ValueError so the caller keeps sklearn.
+        vec = pipeline.named_steps["tfidf"]
+        clf = pipeline.named_steps["clf"]
+        params = vec.get_params()
+        expected = {"analyzer": "word", "ngram_range": (1, 1),
+                    "tokenizer": None, "preprocessor": None,
+                    "strip_accents": None, "stop_words": None,
+                    "lowercase": True, "binary": False, "use_idf": True}
+        for key, value in expected.items():
+            if params.get(key) != value:
+                raise ValueError(f"Unsupported TfidfVectorizer setting "
+                                 f"{key}={params.get(key)!r}")
+        if params.get("norm") not in ("l2", None):
+            raise ValueError(f"Unsupported norm {params.get('norm')!r}")
+        return cls(vocabulary=dict(vec.vocabulary_),
+                   idf=vec.idf_,
+                   feature_log_prob=clf.feature_log_prob_,
+                   class_log_prior=clf.class_log_prior_,
+                   classes=clf.classes_,
+                   norm=params["norm"],
+                   sublinear_tf=params["sublinear_tf"],
+                   token_pattern=params["token_pattern"])
+
+    @property
+    def n_features(self):
+        return self.idf.shape[0]
+
+    def _columns(self, texts):
+        # (document id, column) of every in-vocabulary token
+        findall = self._findall
+        if isinstance(self.vocabulary, SortedVocabulary):
+            tokens = [findall(text.lower()) for text in texts]
+            cols = self.vocabulary.lookup(
+                [tok for doc in tokens for tok in doc])
+            docs = np.repeat(np.arange(len(texts), dtype=np.int64),
+                             [len(doc) for doc in tokens])
+            found = cols >= 0
+            return docs[found], cols[found]
+        get = self.vocabulary.get
+        docs, cols = [], []
+        for i, text in enumerate(texts):
+            found = [c for c in map(get, findall(text.lower()))
+                     if c is not None]
+            cols.extend(found)
+            docs.extend([i] * len(found))
+        return (np.array(docs, dtype=np.int64),
+                np.array(cols, dtype=np.int64))
+
+    def joint_log_likelihood(self, texts):
+        # (n_texts, n_classes) scores, the same as
+        # MultinomialNB.predict_joint_log_proba on the tf-idf rows
+        jll = np.tile(self.class_log_prior, (len(texts), 1))
+        docs, cols = self._columns(texts)
+        if cols.size == 0:
+            return jll
+
+        # term counts of the whole batch in one pass, rows come out
+        # sorted by document and column like a CSR matrix
+        keys, counts = np.unique(docs * self.n_features + cols,
+                                 return_counts=True)
+        docs, cols = np.divmod(keys, self.n_features)
+        starts = np.flatnonzero(np.r_[True, docs[1:] != docs[:-1]])
+
+        tf = counts.astype(self.idf.dtype)
+        if self.sublinear_tf:
+            tf = np.log(tf) + 1.0
+        values = tf * self.idf[cols]
+        if self.norm == "l2":
+            norms = np.sqrt(np.add.reduceat(values * values, starts))
+            values /= np.repeat(norms, np.diff(np.r_[starts, values.size]))
+
+        contrib = self.weights[cols] * values[:, None]
+        jll[docs[starts]] += np.add.reduceat(contrib, starts, axis=0)
+        return jll
+
+    def predict(self, texts):
+        jll = self.joint_log_likelihood(texts)
+        return self.classes[np.argmax(jll, axis=1)]
+
+    # ==========
+    # = Export =
+    # ==========
+    def save_mmap(self, directory):
+        # Pickle-free artifact directory, see MMAP_FORMAT.
+        # Returns the manifest.
+        os.makedirs(directory, exist_ok=True)
+        vocabulary = self.vocabulary
+        if isinstance(vocabulary, SortedVocabulary):
+            vocabulary = dict(vocabulary.items())
+        blob, starts, columns = build_vocabulary_table(vocabulary)
+        arrays = {"idf": self.idf,
+                  "weights": self.weights,
+                  "class_log_prior": self.class_log_prior,
+                  "classes": self.classes,
+                  "vocab_blob": blob,
+                  "vocab_starts": starts,
+                  "vocab_columns": columns}
+        files = {}
+        for name, array in arrays.items():
+            path = os.path.join(directory, f"{name}.npy")
+            np.save(path, np.ascontiguousarray(array))
+            files[f"{name}.npy"] = file_sha256(path)
+        digest = hashlib.sha256("".join(
+            f"{name}:{sha}\n" for name, sha in sorted(files.items()))
+            .encode()).hexdigest()[:16]
+        manifest = {"format": MMAP_FORMAT,
+                    "format_version": MMAP_FORMAT_VERSION,
+                    "n_features": int(self.n_features),
+                    "norm": self.norm,
+                    "sublinear_tf": bool(self.sublinear_tf),
+                    "token_pattern": self.token_pattern,
+                    "files": files,
+                    "digest": digest}
+        with open(os.path.join(directory, MANIFEST_NAME), "w",
+                  encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    @classmethod
+    def load_mmap(cls, directory, mmap_mode="r", verify=False):
+        # Open an artifact directory. The arrays stay on disk and are
+        # paged in on first use; verify=True re-hashes every file.
+        with open(os.path.join(directory, MANIFEST_NAME),
+                  encoding="utf-8") as f:
+            manifest = json.load(f)
+        if (manifest.get("format") != MMAP_FORMAT
+                or manifest.get("format_version") != MMAP_FORMAT_VERSION):
+            raise ValueError(f"Unsupported artifact format "
+                             f"{manifest.get('format')!r} "
+                             f"v{manifest.get('format_version')}")
+        arrays = {}
+        for name, sha in manifest["files"].items():
+            path = os.path.join(directory, name)
+            if verify and file_sha256(path) != sha:
+                raise ValueError(f"{path} does not match its manifest")
+            arrays[name[:-len(".npy")]] = np.load(path, mmap_mode=mmap_mode)
+        weights = arrays["weights"]
+        return cls(vocabulary=SortedVocabulary(arrays["vocab_blob"],
+                                               arrays["vocab_starts"],
+                                               arrays["vocab_columns"]),
+                   idf=arrays["idf"],
+                   feature_log_prob=weights.T,
+                   class_log_prior=arrays["class_log_prior"],
+                   classes=arrays["classes"],
+                   norm=manifest["norm"],
+                   sublinear_tf=manifest["sublinear_tf"],
+                   token_pattern=manifest["token_pattern"],
+                   digest=manifest["digest"])
+
+    def save(self, path):
+        # terms in column order, so no pickled dict is needed
+        terms = np.empty(self.n_features, dtype=object)
+        for term, col in self.vocabulary.items():
+            terms[col] = term
+        np.savez(path, terms=terms.astype(str), idf=self.idf,
+                 feature_log_prob=self.feature_log_prob,
+                 class_log_prior=self.class_log_prior,
+                 classes=self.classes,
+                 settings=np.array([self.norm or "", self.token_pattern,
+                                    str(int(self.sublinear_tf))]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            terms = data["terms"].tolist()
+            norm, token_pattern, sublinear = data["settings"].tolist()
+            return cls(vocabulary={t: i for i, t in enumerate(terms)},
+                       idf=data["idf"],
+                       feature_log_prob=data["feature_log_prob"],
+                       class_log_prior=data["class_log_prior"],
+                       classes=data["classes"],
+                       norm=norm or None,
+                       sublinear_tf=sublinear == "1",
+                       token_pattern=token_pattern)
+
+
+# ===============
+# = ONNX Engine =
+# ===============
+class OnnxScorer:
+    """
+    onnxruntime CPU Engine
+    Runs the TF-IDF + MultinomialNB pipeline exported to ONNX.
+    The session is created on first use in every process, so a
+    model loaded before serve.py forks does not share onnxruntime's
+    threads with the workers.
+    """
+
+    def __init__(self, model_bytes, intra_op_threads=1, digest=None):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is not installed")
+        self.model_bytes = model_bytes
+        self.intra_op_threads = intra_op_threads
+        self.digest = digest or hashlib.sha256(
+            model_bytes).hexdigest()[:16]
+        self._session = None
+        self._pid = None
+
+    @classmethod
+    def load(cls, path, intra_op_threads=1):
+        with open(path, "rb") as f:
+            return cls(f.read(), intra_op_threads)
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = self.intra_op_threads
+            options.inter_op_num_threads = 1
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            self._session = onnxruntime.InferenceSession(
+                self.model_bytes, options,
+                providers=["CPUExecutionProvider"])
+            self._input = self._session.get_inputs()[0].name
+            self._label = self._session.get_outputs()[0].name
+            self._pid = os.getpid()
+        return self._session
+
+    def predict(self, texts):
+        session = self.session
+        if not texts:
+            return np.empty(0, dtype=np.int64)
+        batch = np.array(list(texts), dtype=object).reshape(-1, 1)
+        return session.run([self._label], {self._input: batch})[0]
+
+
+def export_onnx(pipeline, path):
+    # needs skl2onnx; only the settings NumpyScorer supports
+    from skl2onnx import to_onnx
+    from skl2onnx.common.data_types import StringTensorType
+
+    vec = pipeline.named_steps["tfidf"]
+    clf = pipeline.named_steps["clf"]
+    NumpyScorer.from_pipeline(pipeline)  # raises on unsupported settings
+    if vec.token_pattern != TOKEN_PATTERN:
+        raise ValueError(f"Unsupported token_pattern {vec.token_pattern!r}")
+    onx = to_onnx(pipeline,
+                  initial_types=[("text", StringTensorType([None, 1]))],
+                  options={id(vec): {"tokenexp": ONNX_TOKEN_EXP,
+                                     "locale": ONNX_LOCALE},
+                           id(clf): {"zipmap": False}},
+                  target_opset=ONNX_OPSET)
+    with open(path, "wb") as f:
+        f.write(onx.SerializeToString())
+    return path
+
+
+def export_engine(pipeline_path, engine_path):
+    # a directory (no .npz suffix) gets the memory-mappable layout
+    pipeline = joblib.load(pipeline_path)
+    if str(engine_path).endswith(".onnx"):
+        export_onnx(pipeline, engine_path)
+        print(f"Exported ONNX model to {engine_path}")
+        return None
+    scorer = NumpyScorer.from_pipeline(pipeline)
+    if str(engine_path).endswith(".npz"):
+        scorer.save(engine_path)
+    else:
+        scorer.save_mmap(engine_path)
+    print(f"Exported {scorer.n_features} features to {engine_path}")
+    return scorer
+
+
+# =================
+# = Start Program =
+# =================
+if __name__ == "__main__":
+    # python3 scoring.py ./purchase_model.pkl ./purchase_model_engine.npz
+    # python3 scoring.py ./purchase_model.pkl ./purchase_model_mmap
+    # python3 scoring.py ./purchase_model.pkl ./purchase_model.onnx
+    src = sys.argv[1] if len(sys.argv) > 1 else "./purchase_model.pkl"
+    dst = sys.argv[2] if len(sys.argv) > 2 else "./purchase_model_engine.npz"
+    export_engine(src, dst)
@@ -0,0 +1,255 @@
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import uvicorn
+
+# worker processes, default one per usable core
+WORKERS = int(os.environ.get(
+    "WORKERS", str(getattr(os, "process_cpu_count", os.cpu_count)() or 1)))
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8000"))
+BACKLOG = int(os.environ.get("BACKLOG", "2048"))
+# seconds the workers get to finish requests and flush logs on shutdown
+GRACEFUL_TIMEOUT = float(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "info")
+
+
+# ==================
+# = Shared Socket  =
+# = and Workers    =
+# ==================
+def bind_socket(host=HOST, port=PORT, backlog=BACKLOG):
+    # bound once in the master, every worker accepts on it
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def setup_worker(backend, poller):
+    # Only the poller worker checks the model registry. Once it has
+    # re-warmed the cache for a new version it asks the master to
+    # load that version and fork fresh workers (SIGHUP).
+    if not poller:
+        backend.MODEL_POLL_SECONDS = 0
+        return
+
+    def rewarm_then_reload(new_state):
+        try:
+            backend.rewarm_cache(new_state)
+        finally:
+            os.kill(os.getppid(), signal.SIGHUP)
+
+    backend.MODEL_HOLDER.before_swap = rewarm_then_reload
+
+
+def run_worker(app, sock):
+    # Child side of the fork: back to normal GC, default signal
+    # handlers (uvicorn installs its own) and one uvicorn server
+    # on the inherited socket. Never returns.
+    gc.enable()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    config = uvicorn.Config(app, lifespan="on", log_level=LOG_LEVEL)
+    code = 0
+    try:
+        uvicorn.Server(config).run(sockets=[sock])
+    except BaseException as e:
+        print(f"[serve] worker {os.getpid()} crashed: {e}")
+        code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(code)
+
+
+class Master:
+    """
+    Prefork Master
+    Loads the model once, freezes the GC so the objects of the
+    loaded pipeline stay in pages the workers share copy-on-write,
+    then forks `workers` uvicorn processes on one listening socket.
+    One of them polls the model registry. A worker that dies is
+    replaced; SIGHUP reloads the model here and replaces all of
+    them; SIGTERM / SIGINT stop them all gracefully, SIGKILL after
+    GRACEFUL_TIMEOUT.
+    """
+
+    def __init__(self, backend, sock, workers=WORKERS,
+                 graceful_timeout=GRACEFUL_TIMEOUT):
+        self.backend = backend
+        self.sock = sock
+        self.workers = max(1, workers)
+        self.graceful_timeout = graceful_timeout
+        self.pids = {}
+        self.retiring = set()
+        self.poller = None
+        self.stopping = False
+
+    def spawn(self, poller=False):
+        pid = os.fork()
+        if pid == 0:
+            setup_worker(self.backend, poller)
+            run_worker(self.backend.app, self.sock)
+        self.pids[pid] = time.monotonic()
+        if poller:
+            self.poller = pid
+        print(f"[serve] started worker {pid}")
+        return pid
+
+    def _reload(self, signum, frame):
+        # The poller worker found a new model version: load it once
+        # here, then replace the workers so they share its pages
+        # instead of each loading a private copy.
+        if self.stopping:
+            return
+        holder = self.backend.MODEL_HOLDER
+        old = holder.peek_state()
+        state = holder.refresh()
+        if state is None or state is old:
+            print("[serve] reload requested, no new model loaded")
+            return
+        gc.freeze()
+        print(f"[serve] model {state.version} ({state.digest}) loaded, "
+              f"replacing {len(self.pids)} workers")
+        old_pids = list(self.pids)
+        for pid in old_pids:
+            self.pids.pop(pid)
+            self.retiring.add(pid)
+        for i in range(self.workers):
+            self.spawn(poller=i == 0)
+        # the old workers finish their requests and flush their logs
+        for pid in old_pids:
+            with _no_such_process():
+                os.kill(pid, signal.SIGTERM)
+
+    def _stop(self, signum, frame):
+        # waitpid() is retried after a signal, so the workers are told
+        # right here; the master returns once they have exited
+        if not self.stopping:
+            self.stopping = True
+            self._signal_all(signal.SIGTERM)
+
+    def _signal_all(self, signum):
+        for pid in list(self.pids):
+            with _no_such_process():
+                os.kill(pid, signum)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        for i in range(self.workers):
+            self.spawn(poller=i == 0)
+        while not self.stopping:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.retiring.discard(pid)
+            started = self.pids.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            print(f"[serve] worker {pid} exited with status {status}")
+            if time.monotonic() - started < 1.0:
+                # do not spin when workers die right at startup
+                time.sleep(1.0)
+            self.spawn(poller=pid == self.poller)
+        self.shutdown()
+
+    def shutdown(self):
+        if not self.stopping:
+            self.stopping = True
+            self._signal_all(signal.SIGTERM)
+        # replaced workers got their SIGTERM already, wait for them too
+        for pid in self.retiring:
+            self.pids.setdefault(pid, time.monotonic())
+        self.retiring = set()
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.pids and time.monotonic() < deadline:
+            for pid in list(self.pids):
+                with _no_such_process():
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                    if done == 0:
+                        continue
+                self.pids.pop(pid, None)
+            time.sleep(0.05)
+        for pid in list(self.pids):
+            print(f"[serve] killing worker {pid}")
+            with _no_such_process():
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+        self.pids = {}
+
+
+class _no_such_process:
+    # ignore workers that are already gone
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return exc_type in (ProcessLookupError, ChildProcessError)
+
+
+# ================
+# = Memory Usage =
+# ================
+def memory_usage(pid):
+    # RSS counts shared pages in every process that maps them,
+    # PSS splits them between those processes. Values in MB.
+    fields = {"Rss": "rss_mb", "Pss": "pss_mb",
+              "Shared_Clean": "shared_clean_mb",
+              "Shared_Dirty": "shared_dirty_mb",
+              "Private_Clean": "private_clean_mb",
+              "Private_Dirty": "private_dirty_mb"}
+    usage = {}
+    with open(f"/proc/{pid}/smaps_rollup", encoding="utf-8") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if name in fields:
+                usage[fields[name]] = round(int(rest.split()[0]) / 1024, 1)
+    return usage
+
+
+def child_pids(pid):
+    with open(f"/proc/{pid}/task/{pid}/children", encoding="utf-8") as f:
+        return [int(p) for p in f.read().split()]
+
+
+# =================
+# = Start Program =
+# =================
+def main():
+    # No collections while the model is loaded: freed slots would
+    # be refilled later and dirty the shared pages in the workers.
+    gc.disable()
+    import main as backend
+
+    # the poller worker re-warms before asking for a reload
+    backend.MODEL_HOLDER.before_swap = None
+    state = backend.MODEL_HOLDER.refresh()
+    if state is None:
+        print("[serve] no model loaded in the master, "
+              "every worker loads its own")
+    else:
+        print(f"[serve] model {state.version} ({state.digest}) loaded in "
+              f"{state.load_seconds:.2f}s, forking {WORKERS} workers")
+    sock = bind_socket()
+    # Move everything allocated so far out of the collector's reach:
+    # the workers' GC never writes to these objects' pages.
+    gc.freeze()
+    Master(backend, sock).run()
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
+
+# python3 serve.py
+# WORKERS=4 PORT=8000 python3 serve.py
@@ -0,0 +1,438 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from decimal import Decimal
+
+# DynamoDB request limits
+DDB_BATCH_GET_LIMIT = 100
+DDB_BATCH_WRITE_LIMIT = 25
+# keys per SELECT ... IN (...), below SQLite's variable limit
+SQLITE_BATCH_GET_LIMIT = 500
+
+# Error codes that mean the session token ran out.
+# The Learner Lab hands out tokens that expire after a few hours.
+EXPIRED_CREDENTIAL_CODES = {"ExpiredToken", "ExpiredTokenException",
+                            "RequestExpired", "UnrecognizedClientException"}
+
+
+def credentials_expired(err):
+    if not isinstance(err, ClientError):
+        return False
+    code = err.response.get("Error", {}).get("Code", "")
+    return code in EXPIRED_CREDENTIAL_CODES
+
+
+class StoreUnavailable(Exception):
+    # raised instead of calling a store whose breaker is open
+    pass
+
+
+def _latest_per_key(items):
+    # one write per text_hash, the last one wins
+    latest = {}
+    for item in items:
+        latest[item["text_hash"]] = item
+    return list(latest.values())
+
+
+# ===================
+# = Circuit Breaker =
+# ===================
+class CircuitBreaker:
+    """
+    Store Circuit Breaker
+    Opens after `failure_threshold` failed or slow calls in a row;
+    writes count as slow against their own `slow_write_seconds`
+    (0: never), batch puts take longer than lookups. While open,
+    allow() says no and callers skip the store. After
+    `reset_timeout` seconds one probe call is let through: success
+    closes the breaker, failure opens it for another period.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, slow_call_seconds=0.05,
+                 reset_timeout=30.0, enabled=True, slow_write_seconds=0.0):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_write_seconds = slow_write_seconds
+        self.reset_timeout = reset_timeout
+        self.enabled = enabled
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.opened = 0
+        self.short_circuited = 0
+        self.last_error = None
+        self._changed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # open, or half open with a probe that never came back:
+            # let one probe through once the period is over
+            now = time.monotonic()
+            if now - self._changed_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._changed_at = now
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record(self, seconds=0.0, error=None, write=False):
+        # outcome of one call that allow() let through
+        limit = self.slow_write_seconds if write else self.slow_call_seconds
+        slow = error is None and seconds > limit > 0
+        with self._lock:
+            if error is None and not slow:
+                self.consecutive = 0
+                if self.state != self.CLOSED:
+                    print("[STORE] breaker closed, store recovered")
+                    self.state = self.CLOSED
+                    self._changed_at = time.monotonic()
+                return
+            self.consecutive += 1
+            self.failures += error is not None
+            self.slow_calls += slow
+            if error is not None:
+                self.last_error = f"{type(error).__name__}: {error}"
+            if (self.enabled and self.state != self.OPEN
+                    and (self.state == self.HALF_OPEN
+                         or self.consecutive >= self.failure_threshold)):
+                print(f"[STORE] breaker open after {self.consecutive} "
+                      f"failed or slow calls")
+                self.state = self.OPEN
+                self.opened += 1
+                self._changed_at = time.monotonic()
+
+    def status(self):
+        return {"state": self.state,
+                "enabled": self.enabled,
+                "consecutive_failures": self.consecutive,
+                "failures": self.failures,
+                "slow_calls": self.slow_calls,
+                "opened": self.opened,
+                "short_circuited": self.short_circuited,
+                "last_error": self.last_error}
+
+
+# ===================
+# = Store Interface =
+# ===================
+class Store:
+    """
+    Cache / Log Store
+    Items are the log records of build_log_record, keyed by
+    text_hash and carrying a float timestamp. Every backend
+    offers the same five calls:
+      get(key)                 -> item or None
+      put(item)
+      batch_get(keys)          -> {key: item} of the keys found
+      batch_put(items)         -> (failed, retries)
+      scan_since(ts, limit)    -> items with timestamp >= ts, oldest first
+    """
+
+    backend = None
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, item):
+        raise NotImplementedError
+
+    def batch_get(self, keys):
+        raise NotImplementedError
+
+    def batch_put(self, items, max_retries=5):
+        raise NotImplementedError
+
+    def scan_since(self, since=0.0, limit=None):
+        raise NotImplementedError
+
+    def status(self):
+        return {"backend": self.backend}
+
+    def close(self):
+        pass
+
+
+# ============
+# = DynamoDB =
+# ============
+class DynamoStore(Store):
+    """
+    DynamoDB Store
+    Wraps a boto3 Table. Batch reads use BatchGetItem (100 keys
+    per call), batch writes BatchWriteItem (25 puts per call);
+    unprocessed keys and throttled calls are retried with
+    full-jitter exponential backoff. An expired session token is
+    raised to the caller, which rebuilds the table handle.
+    """
+
+    backend = "dynamodb"
+
+    def __init__(self, table, base_delay=0.05):
+        self.table = table
+        self.base_delay = base_delay
+
+    @staticmethod
+    def _to_item(record):
+        # DynamoDB takes no floats
+        item = dict(record)
+        item["timestamp"] = Decimal(str(record["timestamp"]))
+        return item
+
+    @staticmethod
+    def _from_item(item):
+        if item is not None and isinstance(item.get("timestamp"), Decimal):
+            item = dict(item, timestamp=float(item["timestamp"]))
+        return item
+
+    def get(self, key):
+        resp = self.table.get_item(Key={"text_hash": key})
+        return self._from_item(resp.get("Item")) if resp else None
+
+    def put(self, item):
+        self.table.put_item(Item=self._to_item(item))
+
+    def batch_get(self, keys, max_retries=3):
+        # The client behind a resource table speaks plain python types.
+        client = self.table.meta.client
+        name = self.table.name
+        keys = list(dict.fromkeys(keys))  # BatchGetItem rejects dups
+        found = {}
+        for start in range(0, len(keys), DDB_BATCH_GET_LIMIT):
+            chunk = keys[start:start + DDB_BATCH_GET_LIMIT]
+            request = {name: {"Keys": [{"text_hash": h} for h in chunk]}}
+            for attempt in range(max_retries + 1):
+                resp = client.batch_get_item(RequestItems=request)
+                for item in resp.get("Responses", {}).get(name, []):
+                    found[item["text_hash"]] = self._from_item(item)
+                request = resp.get("UnprocessedKeys") or {}
+                if not request:
+                    break
+                time.sleep(self.base_delay * 2 ** attempt)
+            else:
+                print(f"[DDB] batch_get gave up on {len(request)} tables")
+        return found
+
+    def batch_put(self, items, max_retries=5):
+        client = self.table.meta.client
+        name = self.table.name
+        items = [self._to_item(i) for i in _latest_per_key(items)]
+        failed = retries = 0
+        for start in range(0, len(items), DDB_BATCH_WRITE_LIMIT):
+            pending = [{"PutRequest": {"Item": item}}
+                       for item in items[start:start + DDB_BATCH_WRITE_LIMIT]]
+            attempt = 0
+            while pending:
+                try:
+                    resp = client.batch_write_item(
+                        RequestItems={name: pending})
+                    pending = resp.get("UnprocessedItems", {}).get(name, [])
+                except ClientError as e:
+                    if credentials_expired(e):
+                        raise
+                    print(f"[DDB] batch put error: {e}")
+                if not pending:
+                    break
+                if attempt >= max_retries:
+                    failed += len(pending)
+                    print(f"[DDB] batch put gave up on {len(pending)} items")
+                    break
+                time.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
+                attempt += 1
+                retries += 1
+        return failed, retries
+
+    def scan_since(self, since=0.0, limit=None):
+        # A full scan with a filter: DynamoDB has no index on
+        # timestamp, this is for exports and offline jobs only.
+        kwargs = {"FilterExpression":
+                  Attr("timestamp").gte(Decimal(str(since)))}
+        items = []
+        while True:
+            resp = self.table.scan(**kwargs)
+            items.extend(self._from_item(i) for i in resp.get("Items", []))
+            if "LastEvaluatedKey" not in resp:
+                break
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+        items.sort(key=lambda i: i["timestamp"])
+        return items[:limit] if limit else items
+
+    def status(self):
+        return {"backend": self.backend,
+                "table_name": getattr(self.table, "name", None)}
+
+
+# =============
+# = In Memory =
+# =============
+class MemoryStore(Store):
+    """
+    In-Memory Store
+    A dict behind a lock. For tests, benchmarks and single
+    process runs that do not need to keep the cache.
+    """
+
+    backend = "memory"
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+        return dict(item) if item is not None else None
+
+    def put(self, item):
+        with self._lock:
+            self._items[item["text_hash"]] = dict(item)
+
+    def batch_get(self, keys):
+        with self._lock:
+            return {k: dict(self._items[k]) for k in keys
+                    if k in self._items}
+
+    def batch_put(self, items, max_retries=5):
+        with self._lock:
+            for item in items:
+                self._items[item["text_hash"]] = dict(item)
+        return 0, 0
+
+    def scan_since(self, since=0.0, limit=None):
+        with self._lock:
+            items = [dict(i) for i in self._items.values()
+                     if i["timestamp"] >= since]
+        items.sort(key=lambda i: i["timestamp"])
+        return items[:limit] if limit else items
+
+    def __len__(self):
+        return len(self._items)
+
+    def status(self):
+        return {"backend": self.backend, "items": len(self._items)}
+
+
+# ==========
+# = SQLite =
+# ==========
+class SQLiteStore(Store):
+    """
+    Embedded SQLite Store
+    One file, WAL journal so readers (other threads, the monitor
+    process) never block the writer. text_hash is the primary
+    key, timestamp has its own index for scan_since. The columns
+    the monitor reads are stored next to the full JSON item.
+    Every thread gets its own connection; the SQL strings are
+    constant, so sqlite3 reuses their prepared statements.
+    """
+
+    backend = "sqlite"
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS cache ("
+        " text_hash TEXT PRIMARY KEY,"
+        " timestamp REAL NOT NULL,"
+        " request_text TEXT,"
+        " predicted_bought TEXT,"
+        " true_record TEXT,"
+        " model_version TEXT,"
+        " item TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS cache_timestamp ON cache (timestamp)")
+    GET = "SELECT item FROM cache WHERE text_hash = ?"
+    PUT = ("INSERT OR REPLACE INTO cache (text_hash, timestamp, "
+           "request_text, predicted_bought, true_record, model_version, "
+           "item) VALUES (?, ?, ?, ?, ?, ?, ?)")
+    SCAN = ("SELECT item FROM cache WHERE timestamp >= ? "
+            "ORDER BY timestamp LIMIT ?")
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._conn()
+        with conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                   check_same_thread=False,
+                                   cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: no fsync per commit, still crash safe
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @staticmethod
+    def _row(item):
+        return (item["text_hash"], float(item["timestamp"]),
+                item.get("request_text"), item.get("predicted_bought"),
+                item.get("true_record"), item.get("model_version"),
+                json.dumps(item, ensure_ascii=False, default=float))
+
+    def get(self, key):
+        row = self._conn().execute(self.GET, (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, item):
+        conn = self._conn()
+        with conn:
+            conn.execute(self.PUT, self._row(item))
+
+    def batch_get(self, keys):
+        keys = list(dict.fromkeys(keys))
+        conn = self._conn()
+        found = {}
+        for start in range(0, len(keys), SQLITE_BATCH_GET_LIMIT):
+            chunk = keys[start:start + SQLITE_BATCH_GET_LIMIT]
+            marks = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT text_hash, item FROM cache "
+                f"WHERE text_hash IN ({marks})", chunk)
+            for text_hash, item in rows:
+                found[text_hash] = json.loads(item)
+        return found
+
+    def batch_put(self, items, max_retries=5):
+        # one transaction for the whole batch
+        conn = self._conn()
+        with conn:
+            conn.executemany(self.PUT,
+                             [self._row(i) for i in _latest_per_key(items)])
+        return 0, 0
+
+    def scan_since(self, since=0.0, limit=None):
+        rows = self._conn().execute(self.SCAN, (since, limit or -1))
+        return [json.loads(item) for (item,) in rows]
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def status(self):
+        return {"backend": self.backend, "path": self.path}
@@ -1,16 +1,78 @@
+import asyncio
+import hashlib
+import httpx
+import joblib
+import json
 import main
+import numpy as np
+import os
 import pytest
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
 import types
 from botocore.exceptions import ClientError
 from main import ensure_table, predict, TextInput
+from scoring import NumpyScorer
+from serve import Master, child_pids, memory_usage
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(autouse=True)
+def fresh_local_cache(monkeypatch):
+    # the in-process cache must not carry results between tests
+    monkeypatch.setattr(main, "LOCAL_CACHE", main.LocalCache())
+    monkeypatch.setattr(main, "SINGLE_FLIGHT", main.SingleFlight())
+    monkeypatch.setattr(main, "METRICS", main.Metrics(mode="full"))
+
+
+class FakeClient:
+    # Client behind FakeTable, like table.meta.client of a resource
+    def __init__(self, table):
+        self._table = table
+        self.batch_get_calls = 0
+
+    def batch_get_item(self, RequestItems):
+        self.batch_get_calls += 1
+        keys = RequestItems[self._table.name]["Keys"]
+        assert len(keys) <= 100
+        items = []
+        for key in keys:
+            item = self._table._storage.get(key["text_hash"])
+            if item is not None:
+                items.append(item)
+        return {"Responses": {self._table.name: items},
+                "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems[self._table.name]
+        assert len(requests) <= 25
+        # the first `unprocessed` puts of each call come back unprocessed
+        skip = self._table.unprocessed
+        self._table.unprocessed = max(0, skip - len(requests))
+        for req in requests[skip:]:
+            item = req["PutRequest"]["Item"]
+            self._table.batch_puts += 1
+            self._table._storage[item["text_hash"]] = item
+        left = requests[:skip]
+        return {"UnprocessedItems": {self._table.name: left} if left else {}}
 
 
 class FakeTable:
     def __init__(self, name, exists=True):
+        self.name = name
         self.table_name = name
         self._exists = exists
         self.table_status = "ACTIVE" if exists else None
         self._storage = {}
+        self.batch_puts = 0
+        self.unprocessed = 0
+        self.meta = types.SimpleNamespace(client=FakeClient(self))
 
     def load(self):
         d1 = {"Code": "ResourceNotFoundException", "Message": "Not found"}
@@ -28,6 +90,31 @@ class FakeTable:
         return {"ResponseMetadata": {"HTTPStatusCode": 200}}
 
 
+class FaultyTable(FakeTable):
+    # FakeTable that injects faults: every call sleeps `delay`
+    # seconds and then raises `error` when it is set
+    def __init__(self, name, delay=0.0, error=None):
+        super().__init__(name)
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def _fault(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+
+    def get_item(self, Key):
+        self._fault()
+        return super().get_item(Key)
+
+    def put_item(self, Item):
+        self._fault()
+        return super().put_item(Item)
+
+
 class FakeResource:
     def __init__(self, existing_tables=None):
         self._existing = set(existing_tables or [])
@@ -59,11 +146,33 @@ class FakeResource:
 
 
 class FakeModel:
+    def __init__(self):
+        self.calls = []
+
     def predict(self, X):
-        if "bad" in X[0].lower():
-            return [0]
-        else:
-            return [1]
+        self.calls.append(list(X))
+        return [0 if "bad" in x.lower() else 1 for x in X]
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    # main wired to fakes: cwd in tmp_path with a logs/ directory, a
+    # FakeTable behind a fresh StoreHandle, a LogWriter that is not
+    # started and a FakeModel served as "v0". Replace backend.table
+    # before the first store call, or install another model.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+    env = types.SimpleNamespace(table=FakeTable("Backend_Log_Cache"),
+                                model=FakeModel(), holder=main.ModelHolder(),
+                                log_path=tmp_path / "logs"
+                                / "prediction_logs.json")
+    monkeypatch.setattr(main, "ensure_table",
+                        lambda *args, **kwargs: env.table)
+    monkeypatch.setattr(main, "STORE", main.StoreHandle())
+    monkeypatch.setattr(main, "LOG_WRITER", main.LogWriter())
+    env.holder.install(env.model, "v0")
+    monkeypatch.setattr(main, "MODEL_HOLDER", env.holder)
+    return env
 
 
 def test_ensure_table_existing(monkeypatch):
@@ -93,11 +202,13 @@ def test_ensure_table_creates_if_missing(monkeypatch):
     ("Good thing. Wonderful.", "Positive"),
     ("Five Stars. Pretty.", "Positive"),
     ])
-async def test_predict2(monkeypatch, text, bought):
-    monkeypatch.setattr(main, "ensure_table", lambda *args,
-                        **kwargs: FakeTable("Backend_Log_Cache"))
+async def test_predict2(backend, monkeypatch, text, bought):
     monkeypatch.setattr(main, "load_artifact", lambda *args,
                         **kwargs: FakeModel())
+    monkeypatch.setattr(main, "resolve_model_version", lambda *args,
+                        **kwargs: "v0")
+    # loaded through the registry on the first request
+    monkeypatch.setattr(main, "MODEL_HOLDER", main.ModelHolder())
     # fake_resource = FakeResource(existing_tables={"Backend_Log_Cache"})
     # monkeypatch.setattr(main.boto3, "resource", lambda *args, **kwargs: fake_resource)
     payload = TextInput(text=text, bought=bought)
@@ -105,6 +216,832 @@ async def test_predict2(monkeypatch, text, bought):
     assert pred["predicted_bought"] == bought.capitalize()
 
 
+@pytest.mark.asyncio
+async def test_predict_batch(backend):
+    table, model, holder = backend.table, backend.model, backend.holder
+
+    cached_text = "Cached review. Nice."
+    key = main.cache_key(cached_text, holder.peek_state().digest)
+    table._storage[key] = {
+        "text_hash": key,
+        "predicted_bought": "Negative"}
+    items = [main.TextInput(text=f"Review {i}. bad" if i % 2 else
+                            f"Review {i}. good", bought="Positive")
+             for i in range(250)]
+    items.append(main.TextInput(text=cached_text, bought="Negative"))
+    items.append(main.TextInput(text="Review 0. good", bought="Positive"))
+
+    out = await main.predict_batch(main.BatchInput(items=items))
+    results = out["results"]
+    assert len(results) == 252
+    assert results[0] == {"predicted_bought": "Positive"}
+    assert results[1] == {"predicted_bought": "Negative"}
+    assert results[250] == {"predicted_bought": "Negative",
+                            "cached": "dynamodb"}
+    assert results[251] == results[0]
+    assert out["cache_hits"] == 1
+    assert out["scored"] == 250
+    # one model call for all misses, one BatchGetItem per 100 keys
+    assert len(model.calls) == 1 and len(model.calls[0]) == 250
+    assert table.meta.client.batch_get_calls == 3
+    assert table.batch_puts == 250
+    log_lines = backend.log_path.read_text()
+    assert len(log_lines.splitlines()) == 250
+
+    # second round is served from the in-process cache
+    again = await main.predict_batch(main.BatchInput(items=items[:3]))
+    assert all(r.get("cached") == "memory" for r in again["results"])
+    assert again["memory_hits"] == 3
+    assert len(model.calls) == 1
+    assert table.meta.client.batch_get_calls == 3
+
+
+@pytest.mark.asyncio
+async def test_predict_batch_reports_bad_item():
+    items = [main.TextInput(text="fine", bought="Positive"),
+             main.TextInput(text="fine", bought="maybe")]
+    with pytest.raises(main.HTTPException) as excinfo:
+        await main.predict_batch(main.BatchInput(items=items))
+    assert excinfo.value.status_code == 400
+    assert excinfo.value.detail.startswith("items[1]:")
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_coalesces_concurrent_misses(backend):
+    model = backend.model
+    batcher = main.MicroBatcher(max_size=8, max_wait_ms=50)
+    batcher.start()
+    try:
+        texts = [f"review {i} {'bad' if i % 3 == 0 else 'good'}"
+                 for i in range(12)]
+        preds = await asyncio.gather(*(batcher.predict(t) for t in texts))
+    finally:
+        await batcher.stop()
+
+    assert preds == ["Negative" if i % 3 == 0 else "Positive"
+                     for i in range(12)]
+    # 12 callers, batches capped at 8 items
+    assert [len(c) for c in model.calls] == [8, 4]
+    info = batcher.status()
+    assert info["batches"] == 2
+    assert info["items"] == 12
+    assert info["largest_batch"] == 8
+    assert info["queue_depth"] == 0
+    assert not batcher.running
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_scores_with_the_request_state(monkeypatch):
+    old, new = FakeModel(), FakeModel()
+    holder = main.ModelHolder()
+    holder.install(old, "v0")
+    old_state = holder.peek_state()
+    holder.install(new, "v1")
+    monkeypatch.setattr(main, "MODEL_HOLDER", holder)
+    batcher = main.MicroBatcher(max_size=8, max_wait_ms=50)
+    batcher.start()
+    try:
+        # requests resolved before the swap keep the old model
+        preds = await asyncio.gather(
+            batcher.predict("good one", old_state),
+            batcher.predict("bad one", holder.peek_state()),
+            batcher.predict("good two", old_state))
+    finally:
+        await batcher.stop()
+
+    assert preds == ["Positive", "Negative", "Positive"]
+    assert old.calls == [["good one", "good two"]]
+    assert new.calls == [["bad one"]]
+    assert batcher.status()["batches"] == 1
+
+
+@pytest.mark.asyncio
+async def test_predict_uses_micro_batcher(backend, monkeypatch):
+    model = backend.model
+    monkeypatch.setattr(main, "log_cache", lambda *args: None)
+    batcher = main.MicroBatcher(max_size=32, max_wait_ms=20)
+    monkeypatch.setattr(main, "MICRO_BATCHER", batcher)
+    batcher.start()
+    try:
+        payloads = [TextInput(text=f"Book {i}. Wonderful.", bought="Positive")
+                    for i in range(5)]
+        outs = await asyncio.gather(*(predict(p) for p in payloads))
+    finally:
+        await batcher.stop()
+    assert all(o == {"predicted_bought": "Positive"} for o in outs)
+    assert len(model.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_predict_does_not_block_event_loop(backend, monkeypatch):
+    class SlowLookupTable(FakeTable):
+        def get_item(self, Key):
+            time.sleep(0.2)  # blocking boto3 call
+            return {}
+
+    backend.table = SlowLookupTable("Backend_Log_Cache")
+    # wait for the slow lookup instead of cutting it at the budget
+    monkeypatch.setattr(main, "STORE_LOOKUP_BUDGET_MS", 0)
+    monkeypatch.setattr(main, "log_cache", lambda *args: None)
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    task = asyncio.create_task(ticker())
+    out = await predict(TextInput(text="Nice book.", bought="Positive"))
+    task.cancel()
+    assert out == {"predicted_bought": "Positive"}
+    # the loop kept running while get_item was blocked
+    assert ticks >= 5
+
+
+def install_log_writer(monkeypatch, tmp_path, table, **kwargs):
+    monkeypatch.setattr(main, "LOG_PATH", str(tmp_path / "logs.json"))
+    handle = main.StoreHandle()
+    handle.install(main.DynamoStore(table))
+    monkeypatch.setattr(main, "STORE", handle)
+    return main.LogWriter(**kwargs)
+
+
+def test_log_writer_batches_and_flushes_on_stop(monkeypatch, tmp_path):
+    table = FakeTable("Backend_Log_Cache")
+    table.unprocessed = 3  # first call leaves 3 items for a retry
+    writer = install_log_writer(monkeypatch, tmp_path, table,
+                                batch_size=50, flush_ms=10)
+    records = [main.build_log_record(f"text {i}", "Positive", "positive")
+               for i in range(120)]
+    writer.start()
+    for record in records:
+        assert writer.enqueue(record)
+    writer.stop(timeout=5)
+
+    assert not writer.running
+    assert len(table._storage) == 120
+    assert writer.written == 120
+    assert writer.failed == 0
+    assert writer.retries >= 1
+    lines = (tmp_path / "logs.json").read_text().splitlines()
+    assert len(lines) == 120
+
+
+def test_log_writer_gives_up_after_retries(monkeypatch, tmp_path):
+    table = FakeTable("Backend_Log_Cache")
+    table.unprocessed = 10 ** 6  # DynamoDB never accepts the items
+    writer = install_log_writer(monkeypatch, tmp_path, table,
+                                max_retries=2, flush_ms=10)
+    writer.start()
+    writer.enqueue(main.build_log_record("stuck", "Positive", "positive"))
+    writer.flush()
+    writer.stop()
+    assert writer.failed == 1
+    assert writer.retries == 2
+    # the local log still has the record
+    assert "stuck" in (tmp_path / "logs.json").read_text()
+
+
+def test_log_writer_holds_batches_while_breaker_is_open(monkeypatch,
+                                                        tmp_path):
+    table = FakeTable("Backend_Log_Cache")
+    writer = install_log_writer(monkeypatch, tmp_path, table, maxsize=4)
+    breaker = main.STORE.breaker = main.CircuitBreaker(failure_threshold=1,
+                                                       reset_timeout=60)
+    breaker.record(error=RuntimeError("throttled"))
+    batches = [[main.build_log_record(f"text {i}{j}", "Positive",
+                                      "positive") for j in range(2)]
+               for i in range(3)]
+    for batch in batches[:2]:
+        writer._write(batch)
+    # turned away, held; the oldest batch makes room for the newest
+    assert table._storage == {} and writer.held == 4
+    writer._write(batches[2])
+    assert writer.held == 4 and writer.skipped == 2
+    assert writer.status()["held"] == 4
+
+    # the probe after the reset timeout puts the held batches
+    breaker.reset_timeout = 0
+    writer._put_held()
+    assert breaker.state == "closed" and writer.held == 0
+    assert writer.written == 4 and len(table._storage) == 4
+    assert len((tmp_path / "logs.json").read_text().splitlines()) == 6
+
+
+@pytest.mark.parametrize("policy, kept", [
+    ("drop_newest", ["a", "b"]),
+    ("drop_oldest", ["b", "c"]),
+    ])
+def test_log_writer_drop_policies(policy, kept):
+    writer = main.LogWriter(maxsize=2, policy=policy)
+    # worker not started, so the queue fills up
+    for text in ["a", "b", "c"]:
+        writer.enqueue({"request_text": text})
+    assert writer.dropped == 1
+    left = [writer._queue.get_nowait()["request_text"] for _ in range(2)]
+    assert left == kept
+
+
+def test_log_writer_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        main.LogWriter(policy="spill")
+
+
+@pytest.mark.asyncio
+async def test_predict_enqueues_log_record(backend, monkeypatch, tmp_path):
+    table, holder = backend.table, backend.holder
+    writer = install_log_writer(monkeypatch, tmp_path, table, flush_ms=10)
+    monkeypatch.setattr(main, "LOG_WRITER", writer)
+    writer.start()
+    try:
+        out = await predict(TextInput(text="Lovely.", bought="Positive"))
+        await asyncio.to_thread(writer.flush)
+    finally:
+        writer.stop()
+    assert out == {"predicted_bought": "Positive"}
+    assert writer.enqueued == 1
+    key = main.cache_key("Lovely.", holder.peek_state().digest)
+    assert table._storage[key]["model_version"] == "v0"
+
+
+def test_normalize_text_shares_cache_key():
+    assert main.normalize_text("  Great\u3000read.\n\tFive  Stars ") == \
+        "Great read. Five Stars"
+    # full-width letters fold to ascii
+    assert main.normalize_text("\uff27ood") == "Good"
+    assert main.cache_key("a", "d1") != main.cache_key("a", "d2")
+    assert main.cache_key("a") == main.hash_text("a")
+
+
+@pytest.mark.asyncio
+async def test_new_model_does_not_read_old_cache(backend, monkeypatch):
+    table, holder = backend.table, backend.holder
+    monkeypatch.setattr(main, "LOCAL_CACHE", main.LocalCache(max_size=0))
+    holder.install(FakeModel(), "v0", digest="old")
+
+    first = await predict(TextInput(text="Nice  book.", bought="Positive"))
+    again = await predict(TextInput(text=" Nice book. ", bought="Positive"))
+    assert "cached" not in first and again["cached"] == "dynamodb"
+
+    holder.install(FakeModel(), "v1", digest="new")
+    out = await predict(TextInput(text="Nice book.", bought="Positive"))
+    assert "cached" not in out
+    assert len(table._storage) == 2
+
+
+def test_local_cache_evicts_lru_and_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache = main.LocalCache(max_size=2, ttl=10, negative_ttl=0)
+    cache.put("a", "Positive")
+    cache.put("b", "Negative")
+    assert cache.get("a") == "Positive"  # "b" is now the oldest
+    cache.put("c", "Positive")
+    assert cache.get("b") is None and cache.evictions == 1
+    now[0] += 11
+    assert cache.get("a") is None and cache.expirations == 1
+    # negative caching is off: a miss is not remembered
+    cache.put_miss("d")
+    assert cache.get("d") is None
+    info = cache.status()
+    assert (info["hits"], info["misses"]) == (1, 3)
+
+
+@pytest.mark.asyncio
+async def test_predict_serves_memory_then_skips_known_miss(backend,
+                                                           monkeypatch):
+    table, holder = backend.table, backend.holder
+    lookups = []
+
+    def get_item(Key):
+        lookups.append(Key["text_hash"])
+        return FakeTable.get_item(table, Key)
+
+    table.get_item = get_item
+    monkeypatch.setattr(main, "LOCAL_CACHE",
+                        main.LocalCache(max_size=10, negative_ttl=60))
+
+    first = await predict(TextInput(text="Great.", bought="Positive"))
+    again = await predict(TextInput(text="Great.", bought="Positive"))
+    assert "cached" not in first and again["cached"] == "memory"
+    assert len(lookups) == 1
+
+    # a remembered DynamoDB miss goes straight to the model
+    key = main.cache_key("Other.", holder.peek_state().digest)
+    main.LOCAL_CACHE.put_miss(key)
+    out = await predict(TextInput(text="Other.", bought="Positive"))
+    assert "cached" not in out and len(lookups) == 1
+    assert main.LOCAL_CACHE.negative_hits == 1
+    assert main.LOCAL_CACHE.get(key) == "Positive"
+
+
+@pytest.mark.asyncio
+async def test_predict_coalesces_identical_requests(backend, monkeypatch):
+    table, model = backend.table, backend.model
+    puts = []
+
+    def put_item(Item):
+        puts.append(Item["text_hash"])
+        return FakeTable.put_item(table, Item)
+
+    table.put_item = put_item
+
+    async def slow_scoring(func, *args):
+        await asyncio.sleep(0.05)
+        return func(*args)
+
+    monkeypatch.setattr(main, "run_scoring", slow_scoring)
+    outs = await asyncio.gather(*(
+        predict(TextInput(text="Viral review.", bought="Positive"))
+        for _ in range(20)))
+    assert all(o == {"predicted_bought": "Positive"} for o in outs)
+    assert len(model.calls) == 1 and len(puts) == 1
+    info = main.SINGLE_FLIGHT.status()
+    assert info["coalesced"] == 19 and info["leaders"] == 1
+    assert info["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_metrics_and_server_timing(backend):
+    backend.holder.install(FakeModel(), "v7", digest="abc")
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://test") as client:
+        body = {"text": "Good read.", "bought": "Positive"}
+        miss = await client.post("/predict", json=body)
+        hit = await client.post("/predict", json=body)
+        text = (await client.get("/metrics")).text
+
+    stages = [p.split(";")[0]
+              for p in miss.headers["server-timing"].split(", ")]
+    assert stages == ["memory_cache", "dynamodb_get", "score", "log",
+                      "total"]
+    assert hit.headers["server-timing"].startswith("memory_cache;dur=")
+    assert 'backend_stage_seconds_count{stage="score"} 1' in text
+    assert 'backend_request_seconds_count{path="/predict"} 2' in text
+    assert 'backend_predict_cache_total{tier="memory"} 1' in text
+    assert "backend_cache_hit_ratio 0.5" in text
+    assert 'backend_model_info{version="v7",digest="abc",' in text
+    assert "backend_requests_in_flight 0" in text
+
+
+@pytest.mark.asyncio
+async def test_light_metrics_skip_server_timing(backend, monkeypatch):
+    monkeypatch.setattr(main, "METRICS", main.Metrics(mode="light"))
+    main.LOCAL_CACHE.put(main.cache_key("Hi there.", backend.holder
+                                        .peek_state().digest), "Positive")
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://test") as client:
+        resp = await client.post("/predict", json={"text": "Hi there.",
+                                                   "bought": "Positive"})
+    assert resp.json()["cached"] == "memory"
+    assert "server-timing" not in resp.headers
+    assert main.METRICS.stages["memory_cache"].count == 1
+    with pytest.raises(ValueError):
+        main.Metrics(mode="verbose")
+
+
+def test_load_offsets_ramp_up_to_rate():
+    import evaluate
+    offsets = evaluate.send_offsets(30, rate=10.0, ramp_up=2.0)
+    # 10 requests during the 2 s ramp, then one every 0.1 s
+    assert offsets[0] == 0.0 and offsets == sorted(offsets)
+    assert sum(1 for t in offsets if t < 2.0) == 10
+    assert offsets[-1] == pytest.approx(2.0 + 19 * 0.1)
+
+
+@pytest.mark.asyncio
+async def test_load_generator_cold_then_warm(backend):
+    import evaluate
+    table = backend.table
+
+    entries = [{"text": f"Review {i}. bad", "bought": "Negative"}
+               for i in range(10)]
+    entries += [{"text": f"Review {i}. good", "bought": "Negative"}
+                for i in range(10)]
+    report = await evaluate.run_load(
+        entries, "http://test", concurrency=4, rate=0, ramp_up=0.01,
+        phases=["cold", "warm"],
+        transport=httpx.ASGITransport(app=main.app))
+    cold, warm = report["phases"]["cold"], report["phases"]["warm"]
+    assert cold["ok"] == 20 and cold["errors"] == 0
+    assert cold["cache_tiers"] == {"miss": 20}
+    assert warm["cache_tiers"] == {"memory": 20}
+    assert cold["accuracy"] == warm["accuracy"] == 0.5
+    assert cold["p50_ms"] <= cold["p99_ms"] <= cold["max_ms"]
+    # logged as load test traffic, which feedback readers skip
+    with open(backend.log_path) as f:
+        logged = [json.loads(line) for line in f]
+    assert len(logged) == 20
+    assert {r["source"] for r in logged} == {"loadtest"}
+    assert {i["source"] for i in table._storage.values()} == {"loadtest"}
+    import replay
+    assert replay.read_log_file(str(backend.log_path)) == []
+
+
+def test_replay_reads_logs_and_exports(tmp_path):
+    import replay
+    logs = tmp_path / "prediction_logs.json"
+    logs.write_text(
+        json.dumps({"timestamp": 100.0, "request_text": "A.",
+                    "true_record": "positive"}) + "\n"
+        + "{half a line\n"
+        + json.dumps({"timestamp": 130.0, "request_text": "B.",
+                      "true_sentiment": "Negative"}) + "\n")
+    export = tmp_path / "export.json"
+    export.write_text(
+        json.dumps({"Item": {"timestamp": {"N": "101.5"},
+                             "request_text": {"S": "C."},
+                             "true_record": {"S": "negative"}}}) + "\n"
+        + json.dumps({"Item": {"timestamp": {"N": "102"},
+                               "request_text": {"S": "D."},
+                               "true_record": {"S": "negative"},
+                               "source": {"S": "rewarm"}}}) + "\n")
+    scan = tmp_path / "scan.json"
+    scan.write_text(json.dumps({"Items": [
+        {"timestamp": {"N": "100"}, "request_text": {"S": "A."},
+         "true_record": {"S": "positive"}}]}))
+
+    records = (replay.read_log_file(str(logs))
+               + replay.read_dynamodb_export(str(export))
+               + replay.read_dynamodb_export(str(scan)))
+    assert len(records) == 4
+    entries, offsets = replay.build_schedule(
+        list(dict.fromkeys(records)), speed=2.0, max_gap=10.0)
+    assert [e["text"] for e in entries] == ["A.", "C.", "B."]
+    assert entries[0]["bought"] == "Positive"
+    # 1.5 s, then the 28.5 s gap cut to 10 s, all twice as fast
+    assert offsets == [0.0, 0.75, 5.75]
+
+
+@pytest.mark.asyncio
+async def test_replay_reports_windows(backend):
+    import replay
+    records = [(0.0, "Same.", "Positive"), (0.01, "Same.", "Positive"),
+               (0.15, "Other. bad", "Negative"), (0.16, "Same.", "Positive")]
+    entries, offsets = replay.build_schedule(records)
+    report = await replay.replay(
+        entries, offsets, "http://test", window=0.1,
+        transport=httpx.ASGITransport(app=main.app))
+    assert report["total"]["ok"] == 4
+    assert report["total"]["cache_hit_ratio"] == 0.5
+    windows = report["windows"]
+    assert [w["requests"] for w in windows] == [2, 2]
+    assert windows[0]["start_seconds"] == 0.0
+    assert windows[1]["cache_hit_ratio"] == 0.5
+
+
+def test_swap_rewarms_hot_keys_first(monkeypatch):
+    table = FakeTable("Backend_Log_Cache")
+    monkeypatch.setattr(main, "ensure_table", lambda *args, **kwargs: table)
+    monkeypatch.setattr(main, "STORE", main.StoreHandle())
+    hot = main.HotKeys(max_size=2)
+    for text in ["Hot. bad", "Hot. bad", "Warm.", "Warm.", "Cold."]:
+        hot.touch(text, "positive")
+    monkeypatch.setattr(main, "HOT_KEYS", hot)
+    monkeypatch.setattr(main, "REWARM_TOP_N", 2)
+    versions = iter(["v0", "v1"])
+    monkeypatch.setattr(main, "resolve_model_version",
+                        lambda *args, **kwargs: next(versions))
+    monkeypatch.setattr(main, "load_artifact", lambda *args,
+                        **kwargs: FakeModel())
+
+    live = []
+
+    def before_swap(state):
+        # the old model still serves while the cache is warmed
+        live.append(holder.version)
+        main.rewarm_cache(state)
+
+    holder = main.ModelHolder(before_swap=before_swap)
+    holder.refresh()
+    assert table._storage == {}  # first load: nothing to re-warm
+    state = holder.refresh()
+    assert live == ["v0"] and holder.version == "v1"
+    items = table._storage
+    assert set(items) == {main.cache_key(t, state.digest)
+                          for t in ["Hot. bad", "Warm."]}
+    assert all(v["source"] == "rewarm" for v in items.values())
+    assert items[main.cache_key("Hot. bad", state.digest)][
+        "predicted_bought"] == "Negative"
+
+
+def test_model_holder_swaps_new_version(monkeypatch):
+    versions = iter(["v0", "v0", "v1"])
+    loads = []
+
+    def fake_load(model_name, alias):
+        loads.append(alias)
+        return FakeModel()
+
+    monkeypatch.setattr(main, "resolve_model_version",
+                        lambda *args, **kwargs: next(versions))
+    monkeypatch.setattr(main, "load_artifact", fake_load)
+    holder = main.ModelHolder()
+
+    first = holder.get()
+    assert holder.version == "v0"
+    # same version in the registry: nothing is downloaded again
+    holder.refresh()
+    assert holder.get() is first
+    holder.refresh()
+    assert holder.get() is not first
+    assert loads == ["v0", "v1"]
+
+    info = holder.status()
+    assert info["version"] == "v1"
+    assert info["swaps"] == 1
+    assert info["load_seconds"] is not None
+
+
+def test_model_holder_keeps_model_when_registry_down(monkeypatch):
+    monkeypatch.setattr(main, "resolve_model_version",
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(main, "load_artifact", lambda *args,
+                        **kwargs: FakeModel())
+    holder = main.ModelHolder()
+    model = holder.get()
+    assert holder.version == "local"
+    holder.refresh()
+    assert holder.get() is model
+
+
+def test_dynamo_handle_resolves_once(monkeypatch):
+    calls = []
+
+    def fake_ensure_table(*args, **kwargs):
+        calls.append(kwargs.get("table_name"))
+        return FakeTable("Backend_Log_Cache")
+
+    monkeypatch.setattr(main, "ensure_table", fake_ensure_table)
+    handle = main.StoreHandle()
+    first = handle.get()
+    assert handle.get() is first
+    assert isinstance(first, main.DynamoStore)
+    assert handle.call(lambda store: store.get("x")) is None
+    assert calls == ["Backend_Log_Cache"]
+
+
+def test_dynamo_handle_refreshes_expired_credentials(monkeypatch):
+    monkeypatch.setattr(main, "ensure_table", lambda *args,
+                        **kwargs: FakeTable("Backend_Log_Cache"))
+    handle = main.StoreHandle()
+    stale = handle.get()
+    expired = ClientError({"Error": {"Code": "ExpiredTokenException",
+                                     "Message": "expired"}}, "GetItem")
+
+    def lookup(tb):
+        if tb is stale:
+            raise expired
+        return "fresh"
+
+    assert handle.call(lookup) == "fresh"
+    assert handle.refreshes == 1
+    assert handle.get() is not stale
+
+    # other errors are not swallowed
+    def broken(tb):
+        raise ClientError({"Error": {"Code": "ValidationException"}},
+                          "GetItem")
+    with pytest.raises(ClientError):
+        handle.call(broken)
+    assert handle.refreshes == 1
+
+
+def test_circuit_breaker_opens_probes_and_closes(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    breaker = main.CircuitBreaker(failure_threshold=2,
+                                  slow_call_seconds=0.1, reset_timeout=30)
+    breaker.record(error=RuntimeError("throttled"))
+    breaker.record(0.01)  # a success resets the count
+    breaker.record(error=RuntimeError("throttled"))
+    assert breaker.state == "closed"
+    breaker.record(0.5)  # slow calls count as failures
+    assert breaker.state == "open" and not breaker.allow()
+    assert breaker.short_circuited == 1
+
+    now[0] += 30
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow()  # one probe at a time
+    breaker.record(error=RuntimeError("still down"))
+    assert breaker.state == "open" and breaker.opened == 2
+    now[0] += 30
+    assert breaker.allow()
+    breaker.record(0.01)
+    assert breaker.state == "closed" and breaker.allow()
+
+    # batch puts are timed against their own threshold, off by default
+    breaker.record(0.5, write=True)
+    breaker.record(0.5, write=True)
+    assert breaker.state == "closed" and breaker.slow_calls == 1
+    breaker.slow_write_seconds = 0.2
+    breaker.record(0.5, write=True)
+    breaker.record(0.5, write=True)
+    assert breaker.state == "open" and breaker.slow_calls == 3
+
+
+def install_faulty_store(monkeypatch, table, **breaker_kwargs):
+    # on top of the backend fixture: `table` behind a breaker
+    breaker = main.CircuitBreaker(**breaker_kwargs)
+    handle = main.StoreHandle(backend="dynamodb", breaker=breaker)
+    handle.install(main.DynamoStore(table))
+    monkeypatch.setattr(main, "STORE", handle)
+    return breaker
+
+
+@pytest.mark.asyncio
+async def test_open_breaker_serves_from_model(backend, monkeypatch):
+    throttled = ClientError({"Error": {
+        "Code": "ProvisionedThroughputExceededException",
+        "Message": "slow down"}}, "GetItem")
+    table = FaultyTable("Backend_Log_Cache", error=throttled)
+    breaker = install_faulty_store(monkeypatch, table,
+                                   failure_threshold=2, reset_timeout=60)
+
+    for i in range(4):
+        out = await predict(TextInput(text=f"Book {i} was bad.",
+                                      bought="Negative"))
+        assert out == {"predicted_bought": "Negative"}
+    # lookup + put of the first request open the breaker, the
+    # other requests never reach the table
+    assert breaker.state == "open" and table.calls == 2
+    assert main.health() == {"status": "degraded",
+                             "store_breaker": "open"}
+    assert main.service_status()["store"]["breaker"]["state"] == "open"
+    text = main.metrics().body.decode()
+    assert 'backend_store_breaker_state{state="open"} 1' in text
+    assert ('backend_store_degraded_total{reason="breaker_open"} 3'
+            in text)
+    # a degraded lookup is not remembered as a miss
+    assert len(main.LOCAL_CACHE._items) == 4
+    # every record still reached the local log file
+    with open(backend.log_path) as f:
+        assert len(f.readlines()) == 4
+
+
+@pytest.mark.asyncio
+async def test_slow_lookup_is_cut_at_budget(backend, monkeypatch):
+    table = FaultyTable("Backend_Log_Cache", delay=0.3)
+    monkeypatch.setattr(main, "STORE_LOOKUP_BUDGET_MS", 20)
+    breaker = install_faulty_store(monkeypatch, table,
+                                   failure_threshold=1,
+                                   slow_call_seconds=0.1)
+    monkeypatch.setattr(main, "log_cache", lambda *args: None)
+
+    start = time.perf_counter()
+    out = await predict(TextInput(text="Nice book.", bought="Positive"))
+    assert time.perf_counter() - start < 0.2
+    assert out == {"predicted_bought": "Positive"}
+    assert main.METRICS.counters[
+        ("store_degraded_total", (("reason", "budget"),))] == 1
+    # the breaker counts the call as slow once it returns
+    await asyncio.sleep(0.35)
+    assert breaker.slow_calls == 1 and breaker.state == "open"
+
+
+def test_prefork_workers_share_one_socket(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, WORKERS="2", PORT=str(port), HOST="127.0.0.1",
+               STORE_BACKEND="memory", MODEL_POLL_SECONDS="0",
+               LOG_LEVEL="warning", LOG_PATH=str(tmp_path / "logs.json"))
+    proc = subprocess.Popen([sys.executable, "serve.py"], cwd=HERE,
+                            env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/health", timeout=1)
+                break
+            except httpx.HTTPError:
+                assert time.monotonic() < deadline, "serve.py did not start"
+                time.sleep(0.2)
+        resp = httpx.post(f"http://127.0.0.1:{port}/predict",
+                          json={"text": "Nice book.", "bought": "Positive"})
+        assert resp.json()["predicted_bought"] in ("Positive", "Negative")
+        workers = child_pids(proc.pid)
+        assert len(workers) == 2
+        usage = memory_usage(workers[0])
+        # the model pages loaded in the master are shared, not copied
+        assert usage["pss_mb"] < usage["rss_mb"]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=30) == 0
+
+
+def test_prefork_master_reloads_and_replaces_workers(monkeypatch):
+    versions = iter(["v0", "v1", "v1"])
+    monkeypatch.setattr(main, "resolve_model_version",
+                        lambda *args, **kwargs: next(versions))
+    monkeypatch.setattr(main, "load_artifact", lambda *args,
+                        **kwargs: FakeModel())
+    holder = main.ModelHolder()
+    holder.refresh()
+    backend = types.SimpleNamespace(app=None, MODEL_HOLDER=holder)
+    master = Master(backend, sock=None, workers=2)
+    pids = iter(range(100, 200))
+
+    def fake_spawn(poller=False):
+        pid = next(pids)
+        master.pids[pid] = time.monotonic()
+        if poller:
+            master.poller = pid
+        return pid
+
+    killed = []
+    monkeypatch.setattr("serve.gc.freeze", lambda: None)
+    monkeypatch.setattr(master, "spawn", fake_spawn)
+    monkeypatch.setattr("serve.os.kill",
+                        lambda pid, signum: killed.append((pid, signum)))
+    for i in range(2):
+        master.spawn(poller=i == 0)
+
+    master._reload(signal.SIGHUP, None)
+    assert holder.version == "v1"
+    # fresh workers inherit v1, the old ones are stopped gracefully
+    assert sorted(master.pids) == [102, 103] and master.poller == 102
+    assert master.retiring == {100, 101}
+    assert killed == [(100, signal.SIGTERM), (101, signal.SIGTERM)]
+    # same version again: the workers stay
+    master._reload(signal.SIGHUP, None)
+    assert sorted(master.pids) == [102, 103] and len(killed) == 2
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def local_store(request, tmp_path):
+    if request.param == "memory":
+        store = main.MemoryStore()
+    else:
+        store = main.SQLiteStore(str(tmp_path / "cache.db"))
+    yield store
+    store.close()
+
+
+def test_store_backends_round_trip(local_store):
+    records = [main.build_log_record(f"text {i}", "Positive", "positive")
+               for i in range(5)]
+    for i, record in enumerate(records):
+        record["timestamp"] = 100.0 + i
+    local_store.put(records[0])
+    assert local_store.get(records[0]["text_hash"]) == records[0]
+    assert local_store.get("unknown") is None
+
+    assert local_store.batch_put(records[1:]) == (0, 0)
+    keys = [r["text_hash"] for r in records] + ["unknown"]
+    found = local_store.batch_get(keys)
+    assert set(found) == set(keys[:-1])
+
+    newer = local_store.scan_since(102.0)
+    assert [r["timestamp"] for r in newer] == [102.0, 103.0, 104.0]
+    assert len(local_store.scan_since(0, limit=2)) == 2
+
+
+def test_sqlite_store_uses_wal_and_timestamp_index(tmp_path):
+    path = str(tmp_path / "cache.db")
+    store = main.SQLiteStore(path)
+    store.put(main.build_log_record("Nice book.", "Positive", "positive"))
+    conn = store._conn()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    plan = " ".join(row[-1] for row in conn.execute(
+        "EXPLAIN QUERY PLAN " + store.SCAN, (0.0, -1)))
+    assert "cache_timestamp" in plan
+    # a second process (the monitor) reads the plain columns
+    reader = sqlite3.connect(path)
+    row = reader.execute("SELECT request_text, predicted_bought "
+                         "FROM cache").fetchone()
+    assert row == ("Nice book.", "Positive")
+    reader.close()
+    store.close()
+
+
+def test_store_handle_rejects_unknown_backend():
+    with pytest.raises(ValueError):
+        main.StoreHandle(backend="redis")
+
+
+@pytest.mark.asyncio
+async def test_predict_on_sqlite_store(backend, monkeypatch, tmp_path):
+    # no AWS at all: misses are scored and cached in the SQLite file
+    handle = main.StoreHandle(backend="sqlite",
+                              sqlite_path=str(tmp_path / "cache.db"))
+    monkeypatch.setattr(main, "STORE", handle)
+    monkeypatch.setattr(main, "LOCAL_CACHE", main.LocalCache(max_size=0))
+    monkeypatch.setattr(main, "ensure_table", None)  # never called
+
+    first = await predict(TextInput(text="Nice book.", bought="Positive"))
+    again = await predict(TextInput(text="Nice book.", bought="Positive"))
+    assert "cached" not in first and again["cached"] == "sqlite"
+    assert main.STORE.status()["backend"] == "sqlite"
+    handle.get().close()
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("text, bought, stat_code, expected_detail", [
     ("!!!!", "_", 400, "True_bought can only be either negative or positive."),
@@ -141,3 +1078,278 @@ async def test_predict3(monkeypatch, text, bought, stat_code, expected_detail):
 #     resp.raise_for_status()
 #     pred = resp.json()["sentiment"]
 #     assert pred == true_label
+
+
+# ==================================
+# = NumPy Scoring Engine Parity    =
+# ==================================
+def parity_texts():
+    texts = ["", "!!!", "a b c", "BOOK book Book.", "ÉCOLE Über café naïve",
+             "Five Stars. Gift for my mom that has cancer and she loves it!",
+             "Four Stars. compelling read", "zzzzqqq unseen-words_only 42"]
+    for name in ["prediction_logs.json", "prediction_logs_moive.json"]:
+        with open(os.path.join(HERE, "logs", name), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    texts.append(json.loads(line)["request_text"])
+                except (ValueError, KeyError):
+                    continue
+    for path in [os.path.join(HERE, "test_data.json"),
+                 os.path.join(HERE, "..", "data", "test_data.json")]:
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                texts.extend(r["text"] for r in json.load(f))
+            break
+    return texts
+
+
+@pytest.fixture(scope="module")
+def pipeline():
+    return joblib.load(os.path.join(HERE, "purchase_model.pkl"))
+
+
+def test_numpy_scorer_matches_pipeline(pipeline):
+    texts = parity_texts()
+    scorer = NumpyScorer.from_pipeline(pipeline)
+    assert (scorer.predict(texts) == pipeline.predict(texts)).all()
+
+    vec = pipeline.named_steps["tfidf"]
+    clf = pipeline.named_steps["clf"]
+    expected = clf.predict_joint_log_proba(vec.transform(texts))
+    assert abs(scorer.joint_log_likelihood(texts) - expected).max() < 1e-9
+    # one text at a time gives the same answer as the batch
+    singles = [scorer.predict([text])[0] for text in texts[:50]]
+    assert singles == list(pipeline.predict(texts[:50]))
+
+
+def test_numpy_scorer_save_and_load(pipeline, tmp_path):
+    texts = parity_texts()[:200]
+    path = tmp_path / "engine.npz"
+    NumpyScorer.from_pipeline(pipeline).save(path)
+    loaded = NumpyScorer.load(path)
+    assert (loaded.predict(texts) == pipeline.predict(texts)).all()
+
+
+def test_numpy_scorer_rejects_unsupported_pipeline(pipeline):
+    from sklearn.base import clone
+    other = clone(pipeline).set_params(tfidf__ngram_range=(1, 2))
+    other.fit(["good book", "bad book"], [1, 0])
+    with pytest.raises(ValueError):
+        NumpyScorer.from_pipeline(other)
+    # the backend keeps the sklearn pipeline in that case
+    assert main.build_engine(other, engine="numpy") is other
+    assert isinstance(main.build_engine(pipeline, engine="numpy"),
+                      NumpyScorer)
+
+
+def test_mmap_artifact_matches_pipeline(pipeline, tmp_path):
+    texts = parity_texts()
+    manifest = NumpyScorer.from_pipeline(pipeline).save_mmap(tmp_path)
+    loaded = NumpyScorer.load_mmap(tmp_path, verify=True)
+    assert loaded.digest == manifest["digest"]
+    base = loaded.weights
+    while base.base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert isinstance(base, np.memmap)
+    assert (loaded.predict(texts) == pipeline.predict(texts)).all()
+    singles = [loaded.predict([text])[0] for text in texts[:50]]
+    assert singles == list(pipeline.predict(texts[:50]))
+    vocab = pipeline.named_steps["tfidf"].vocabulary_
+    assert dict(loaded.vocabulary.items()) == vocab
+
+    # a changed file no longer matches its manifest
+    with open(tmp_path / "idf.npy", "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"\x01")
+    with pytest.raises(ValueError):
+        NumpyScorer.load_mmap(tmp_path, verify=True)
+
+
+def test_load_artifact_opens_mmap_layout(pipeline, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    manifest = NumpyScorer.from_pipeline(pipeline).save_mmap(
+        tmp_path / main.MMAP_DIR_NAME)
+    monkeypatch.setattr(main, "MODEL_FORMAT", "mmap")
+
+    def offline():
+        raise RuntimeError("no registry")
+
+    monkeypatch.setattr(main.wandb, "Api", offline)
+    state = main.ModelHolder().refresh()
+    assert isinstance(state.model, NumpyScorer)
+    assert state.digest == manifest["digest"]
+    assert main.engine_name(state.model) == "numpy"
+
+
+def load_train_model():
+    # Model_Management/train_model.py, when it is next to the backend
+    import importlib.util
+    path = os.path.join(HERE, "..", "Model_Management", "train_model.py")
+    if not os.path.exists(path):
+        pytest.skip("Model_Management is not next to the backend")
+    spec = importlib.util.spec_from_file_location("train_model", path)
+    train_model = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(train_model)
+    return train_model
+
+
+def test_train_model_artifact_round_trips(pipeline, tmp_path):
+    # Model_Management writes the layout with scoring.py, which reads it
+    train_model = load_train_model()
+    written = train_model.save_mmap_artifact(pipeline, tmp_path / "train")
+    engine = NumpyScorer.load_mmap(tmp_path / "train", verify=True)
+    assert engine.digest == written["digest"]
+    texts = parity_texts()
+    assert (engine.predict(texts) == pipeline.predict(texts)).all()
+
+
+@pytest.mark.parametrize("model_format", ["pickle", "mmap"])
+def test_load_artifact_opens_compact_artifact(pipeline, monkeypatch,
+                                              tmp_path, model_format):
+    # what train_model logs as the compact model, read by load_artifact
+    train_model = load_train_model()
+    ckpt_path = str(tmp_path / "purchase_model.pkl")
+    joblib.dump(pipeline, ckpt_path)
+    compact_path, _ = train_model.create_compact_model(ckpt_path,
+                                                       threshold=1e-3)
+    compact = joblib.load(compact_path)
+    # the full model stays next to it: loading it instead must fail
+    assert len(compact.named_steps["tfidf"].vocabulary_) < len(
+        pipeline.named_steps["tfidf"].vocabulary_)
+    registry = tmp_path / "registry"
+
+    class StoredArtifact:
+        # files copied under the names they are stored with
+        def __init__(self, name, type, metadata=None):
+            self.name = name
+            registry.joinpath(name).mkdir(parents=True)
+
+        def add_file(self, path, name=None):
+            shutil.copy(path, registry / self.name / name)
+
+        def add_dir(self, path, name=None):
+            shutil.copytree(path, registry / self.name / name)
+
+    class Run:
+        def log_artifact(self, artifact):
+            pass
+
+        def link_model(self, path, registered_model_name, aliases):
+            pass
+
+    monkeypatch.setattr(train_model.wandb, "Artifact", StoredArtifact)
+    train_model.log_model_artifact(
+        Run(), compact_path, model_name="MultinomialNB-compact",
+        alias="compact", file_name="purchase_model.pkl")
+
+    class Api:
+        def artifact(self, path):
+            root = registry / path.split("/")[-1].split(":")[0]
+            return types.SimpleNamespace(
+                download=lambda: str(root),
+                get_path=lambda name: types.SimpleNamespace(
+                    download=lambda: str(root / name)))
+
+    monkeypatch.setattr(main.wandb, "Api", Api)
+    monkeypatch.setattr(main, "MODEL_FORMAT", model_format)
+    monkeypatch.chdir(tmp_path)
+    model = main.load_artifact("MultinomialNB-compact-artifact", "compact")
+    texts = parity_texts()
+    assert (model.predict(texts) == compact.predict(texts)).all()
+    if model_format == "mmap":
+        assert isinstance(model, NumpyScorer)
+        assert len(model.vocabulary) == len(
+            compact.named_steps["tfidf"].vocabulary_)
+    else:
+        assert model.named_steps["tfidf"].vocabulary_ == \
+            compact.named_steps["tfidf"].vocabulary_
+
+
+@pytest.fixture(scope="module")
+def onnx_path(pipeline, tmp_path_factory):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("skl2onnx")
+    from scoring import export_onnx
+    path = tmp_path_factory.mktemp("onnx") / "purchase_model.onnx"
+    return export_onnx(pipeline, str(path))
+
+
+def test_train_model_onnx_export_round_trips(pipeline, onnx_path,
+                                             tmp_path):
+    # Model_Management exports the graph with scoring.py, OnnxScorer runs it
+    from scoring import OnnxScorer
+    train_model = load_train_model()
+    written = train_model.export_onnx(pipeline,
+                                      str(tmp_path / main.ONNX_FILE_NAME))
+    with open(written, "rb") as a, open(onnx_path, "rb") as b:
+        assert a.read() == b.read()
+    texts = parity_texts()
+    engine = OnnxScorer.load(written, intra_op_threads=1)
+    assert (engine.predict(texts) == pipeline.predict(texts)).all()
+
+
+def test_onnx_engine_matches_pipeline(pipeline, onnx_path):
+    from scoring import OnnxScorer
+    texts = parity_texts()
+    engine = OnnxScorer.load(onnx_path, intra_op_threads=1)
+    assert (engine.predict(texts) == pipeline.predict(texts)).all()
+    singles = [engine.predict([text])[0] for text in texts[:50]]
+    assert singles == list(pipeline.predict(texts[:50]))
+    assert len(engine.predict([])) == 0
+
+
+def test_load_artifact_serves_onnx(onnx_path, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(onnx_path, main.ONNX_FILE_NAME)
+    monkeypatch.setattr(main, "INFERENCE_ENGINE", "onnx")
+
+    def offline():
+        raise RuntimeError("no registry")
+
+    monkeypatch.setattr(main.wandb, "Api", offline)
+    state = main.ModelHolder().refresh()
+    assert main.engine_name(state.model) == "onnx"
+    with open(main.ONNX_FILE_NAME, "rb") as f:
+        assert state.digest == hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def test_onnx_engine_without_onnxruntime_serves_sklearn(monkeypatch):
+    monkeypatch.setattr(main, "INFERENCE_ENGINE", "onnx")
+    monkeypatch.setattr(main, "onnxruntime", None)
+    name, load = main.artifact_layout()
+    assert name == "purchase_model.pkl" and load is joblib.load
+
+
+# ======================
+# = Offline Evaluation =
+# ======================
+def test_iter_json_array_streams_across_blocks(tmp_path):
+    import evaluate
+    records = [{"text": f"Review {i}, \"quoted\" ]", "bought": "Positive"}
+               for i in range(50)]
+    path = tmp_path / "test_data.json"
+    path.write_text(json.dumps(records, indent=1))
+    # blocks far smaller than one record
+    assert list(evaluate.iter_json_array(str(path), block_size=7)) == records
+    (tmp_path / "empty.json").write_text("[ ]")
+    assert list(evaluate.iter_json_array(str(tmp_path / "empty.json"))) == []
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_offline_evaluate_matches_sklearn(pipeline, tmp_path, workers):
+    import evaluate
+    from sklearn.metrics import accuracy_score, precision_score
+    texts = parity_texts()[:400]
+    labels = ["Positive" if i % 3 else "Negative" for i in range(len(texts))]
+    path = tmp_path / "test_data.json"
+    path.write_text(json.dumps([{"text": t, "bought": b}
+                                for t, b in zip(texts, labels)]))
+
+    report = evaluate.offline_evaluate(pipeline, str(path), chunk_size=64,
+                                       workers=workers)
+    y_true = [evaluate.LABELS[b] for b in labels]
+    y_pred = pipeline.predict(texts)
+    assert report["rows"] == len(texts)
+    assert report["accuracy"] == round(accuracy_score(y_true, y_pred), 4)
+    assert report["precision"] == round(precision_score(y_true, y_pred), 4)
+    assert sum(map(sum, report["confusion_matrix"]["matrix"])) == len(texts)
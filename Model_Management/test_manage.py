@@ -1,6 +1,21 @@
+import gzip
+import joblib
+import json
+import numpy as np
 import pandas as pd
-# import pytest
+import pytest
 import train_model
+import types
+from sklearn.feature_extraction.text import (TfidfTransformer,
+                                             TfidfVectorizer)
+
+
+@pytest.fixture(autouse=True)
+def feature_cache(tmp_path, monkeypatch):
+    # every test starts with an empty cache outside the repo
+    cache = train_model.FeatureCache(str(tmp_path / "feature_cache"))
+    monkeypatch.setattr(train_model, "FEATURE_CACHE", cache)
+    return cache
 
 
 # Dummy classes to capture calls inside log_artifact
@@ -11,8 +26,11 @@ class DummyArtifact:
         self.metadata = metadata or {}
         self.files = []
 
-    def add_file(self, path):
-        self.files.append(path)
+    def add_file(self, path, name=None):
+        self.files.append(path if name is None else (path, name))
+
+    def add_dir(self, path, name=None):
+        self.files.append((path, name))
 
     def wait(self):
         # no-op for tests
@@ -91,6 +109,407 @@ def test_log_artifact(tmp_path, monkeypatch):
     assert model_art.metadata == {"foo": "bar"}
 
 
+def test_create_pipeline_writes_mmap_artifact(tmp_path, monkeypatch):
+    monkeypatch.setattr(train_model.wandb, "Artifact", DummyArtifact)
+    monkeypatch.setattr(train_model.wandb, "log", lambda data: None)
+    X = pd.Series(["good book, must buy", "boring noval. drop it.",
+                   "great story", "waste of money"])
+    y = pd.Series([1, 0, 1, 0])
+    ckpt_path = tmp_path / "purchase_model.pkl"
+    train_model.create_pipeline(X, y, str(ckpt_path))
+
+    mmap_dir = tmp_path / "purchase_model_mmap"
+    with open(mmap_dir / "manifest.json") as f:
+        manifest = json.load(f)
+    assert manifest["format"] == train_model.scoring.MMAP_FORMAT
+    for name in manifest["files"]:
+        assert (mmap_dir / name).exists()
+
+    # the directory goes into the model artifact next to the pickle
+    data_file = tmp_path / "dummy_data.csv"
+    data_file.write_text("a,b,c\n1,2,3")
+    _, model_art = train_model.log_artifact(
+        run=DummyRun(), data_path=str(data_file),
+        model_path=str(ckpt_path))
+    assert model_art.files == [str(ckpt_path),
+                               (str(mmap_dir), "purchase_model_mmap")]
+
+
+def sample_reviews(n=40):
+    good = ["great story, must buy", "loved every page",
+            "wonderful characters and plot", "a gift I will buy again"]
+    bad = ["boring noval. drop it.", "waste of money",
+           "dull and too long", "returned it after one chapter"]
+    texts = [(good if i % 2 else bad)[i // 2 % 4] + f" copy{i}"
+             for i in range(n)]
+    return pd.Series(texts), pd.Series([i % 2 for i in range(n)])
+
+
+def test_compact_model_prunes_and_casts(tmp_path):
+    X, y = sample_reviews()
+    model = train_model.build_pipeline().fit(X, y)
+
+    same = train_model.compact_model(model, 0.0)
+    assert len(same.named_steps["tfidf"].vocabulary_) == \
+        len(model.named_steps["tfidf"].vocabulary_)
+    assert same.named_steps["clf"].feature_log_prob_.dtype == np.float32
+    assert same.named_steps["tfidf"].transform(X).dtype == np.float32
+    assert (same.predict(X) == model.predict(X)).all()
+
+    contribution = train_model.feature_contribution(model)
+    threshold = float(np.median(contribution))
+    pruned = train_model.compact_model(model, threshold)
+    vocab = pruned.named_steps["tfidf"].vocabulary_
+    kept = model.named_steps["tfidf"].get_feature_names_out()[
+        contribution >= threshold]
+    assert sorted(vocab) == sorted(kept)
+    assert sorted(vocab.values()) == list(range(len(kept)))
+    # a fixed vocabulary, so the vectorizer can be cloned and refitted
+    assert pruned.named_steps["tfidf"].get_params()["vocabulary"] == vocab
+    assert (pruned.predict(X) == model.predict(X)).mean() > 0.9
+
+    manifest = train_model.save_mmap_artifact(pruned, tmp_path / "mmap")
+    assert manifest["n_features"] == len(kept)
+    assert np.load(tmp_path / "mmap" / "weights.npy").dtype == np.float32
+
+
+def test_compact_artifact_uses_the_backend_file_names(tmp_path,
+                                                      monkeypatch):
+    run = DummyRun()
+    monkeypatch.setattr(train_model.wandb, "Artifact", DummyArtifact)
+    X, y = sample_reviews()
+    ckpt_path = str(tmp_path / "purchase_model.pkl")
+    joblib.dump(train_model.fit_pipeline(X, y), ckpt_path)
+    compact_path, _ = train_model.create_compact_model(ckpt_path)
+
+    artifact = train_model.log_model_artifact(
+        run, compact_path, model_name="MultinomialNB-compact",
+        alias="compact", file_name="purchase_model.pkl")
+    # not a version of MultinomialNB-artifact, whose `latest` is served
+    assert artifact.name == "MultinomialNB-compact-artifact"
+    assert artifact.files == [
+        (compact_path, "purchase_model.pkl"),
+        (str(tmp_path / "purchase_model_compact_mmap"),
+         "purchase_model_mmap")]
+
+
+def test_compaction_curve(tmp_path, monkeypatch):
+    # the measured pickles and mmap directories are removed again
+    tmp = tmp_path / "tmp"
+    tmp.mkdir()
+    monkeypatch.setattr(train_model.tempfile, "tempdir", str(tmp))
+    X, y = sample_reviews()
+    rows = train_model.compaction_curve(X, y, thresholds=(0.0, 1e-2))
+    assert [row["dtype"] for row in rows] == \
+        ["float64", "float32", "float32"]
+    assert rows[0]["agreement"] == 1.0
+    assert rows[2]["n_features"] <= rows[1]["n_features"]
+    for row in rows:
+        assert row["pickle_mb"] > 0 and row["load_ms"] > 0
+    assert list(tmp.iterdir()) == []
+
+
+def test_export_onnx_matches_pipeline(tmp_path, monkeypatch):
+    ort = pytest.importorskip("onnxruntime")
+    pytest.importorskip("skl2onnx")
+    X, y = sample_reviews()
+    X = pd.concat([X, pd.Series(["ÉCLAIR Über great", "", "x"])])
+    y = pd.concat([y, pd.Series([1, 0, 1])])
+    model = train_model.build_pipeline().fit(X, y)
+    ckpt_path = tmp_path / "purchase_model.pkl"
+    ckpt_path.write_text("fake")
+    path = train_model.export_onnx(
+        model, train_model.onnx_artifact_path(str(ckpt_path)))
+
+    session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+    batch = np.array(list(X), dtype=object).reshape(-1, 1)
+    labels = session.run(None, {"text": batch})[0]
+    assert (labels == model.predict(X)).all()
+
+    # the ONNX file travels in the model version next to the pickle
+    monkeypatch.setattr(train_model.wandb, "Artifact", DummyArtifact)
+    data_file = tmp_path / "dummy_data.csv"
+    data_file.write_text("a,b,c\n1,2,3")
+    _, model_art = train_model.log_artifact(
+        run=DummyRun(), data_path=str(data_file), model_path=str(ckpt_path))
+    assert model_art.files == [str(ckpt_path), path]
+
+
+def test_streaming_pipeline_reads_csv_in_chunks(tmp_path, monkeypatch):
+    logged = []
+    monkeypatch.setattr(train_model.wandb, "log", logged.append)
+    X, y = sample_reviews()
+    data_path = tmp_path / "review_data.csv"
+    pd.DataFrame({"text": X, "bought": y.map({1: "Positive",
+                                              0: "Negative"})}
+                 ).to_csv(data_path, index=False)
+    ckpt_path = tmp_path / "purchase_model.pkl"
+    (tmp_path / "purchase_model.onnx").write_text("stale")
+
+    stats = train_model.create_streaming_pipeline(
+        str(data_path), str(ckpt_path), chunk_size=7, n_features=2**12)
+    assert stats["stream_rows"] == 40 and stats["stream_chunks"] == 6
+    assert [row["stream/rows"] for row in logged][-1] == 40
+    assert all(row["stream/peak_rss_mb"] > 0 for row in logged)
+    assert not (tmp_path / "purchase_model.onnx").exists()
+
+    model = joblib.load(ckpt_path)
+    assert (model.predict(X) == y).mean() > 0.9
+    # the final IDF is the one of the whole corpus
+    counts = model.named_steps["hashing"].transform(X)
+    expected = TfidfTransformer().fit(counts).idf_
+    assert np.allclose(model.named_steps["idf"].idf_, expected)
+
+
+def test_iter_chunks_reads_raw_jsonl(tmp_path):
+    rows = [{"title": "Great", "text": "must buy", "verified_purchase": True},
+            {"title": "", "text": "no title", "verified_purchase": True},
+            {"title": "Dull", "text": "drop it", "verified_purchase": False},
+            {"title": "Fine", "text": "ok", "verified_purchase": True}]
+    path = tmp_path / "Books.jsonl.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+        f.write("{broken\n")
+    chunks = list(train_model.iter_chunks(str(path), chunk_size=2))
+    assert [texts for texts, _ in chunks] == [
+        ["Great. must buy", "Dull. drop it"], ["Fine. ok"]]
+    assert [list(labels) for _, labels in chunks] == [[1, 0], [1]]
+
+
+def test_run_sweep_shares_features_across_workers():
+    X, y = sample_reviews(60)
+    trials = [{"model": "MultinomialNB", "alpha": 1.0,
+               "ngram_range": (1, 1)},
+              {"model": "LogisticRegression", "C": 1.0,
+               "ngram_range": (1, 1)},
+              {"model": "ComplementNB", "alpha": 0.3,
+               "ngram_range": (1, 2)}]
+    logged = []
+    results, pick, bar = train_model.run_sweep(
+        X, y, trials=trials, workers=2, n_latency=5,
+        log_trial=logged.append)
+    assert sorted(r["trial"] for r in results) == \
+        sorted(train_model.trial_name(t) for t in trials)
+    assert len(logged) == 3
+    assert results[0]["latency_ms"] > 0 and results[0]["fit_seconds"] > 0
+    passing = [r for r in results if r["accuracy"] >= bar]
+    assert pick == min(passing, key=lambda r: r["latency_ms"])
+    assert bar == max(r["accuracy"] for r in results) - 0.01
+
+
+def test_shared_features_round_trip(tmp_path):
+    X, y = sample_reviews()
+    vectorizer = TfidfVectorizer()
+    train = vectorizer.fit_transform(X)
+    train_model.save_features(str(tmp_path), vectorizer, train, train[:5])
+    loaded = train_model.load_features(str(tmp_path), "train")
+    # scipy keeps views of the memory-mapped arrays, no copies
+    base = loaded.data
+    while base.base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert isinstance(base, np.memmap)
+    assert (loaded != train).nnz == 0
+
+
+def test_feature_cache_skips_vectorization(feature_cache):
+    X, y = sample_reviews()
+    first = train_model.fit_pipeline(X, y)
+    assert (feature_cache.hits, feature_cache.misses) == (0, 1)
+
+    second = train_model.fit_pipeline(X, y)
+    assert (feature_cache.hits, feature_cache.misses) == (1, 1)
+    assert second.named_steps["tfidf"].vocabulary_ == \
+        first.named_steps["tfidf"].vocabulary_
+    assert (second.predict(X) == first.predict(X)).all()
+    assert np.allclose(second.predict_proba(X), first.predict_proba(X))
+
+    # other texts or other settings are other entries
+    train_model.fit_pipeline(X[:30], y[:30])
+    feature_cache.fit_transform(TfidfVectorizer(ngram_range=(1, 2)), X)
+    assert (feature_cache.hits, feature_cache.misses) == (1, 3)
+    summary = feature_cache.summary()
+    assert summary["feature_cache_hits"] == 1
+    assert summary["feature_cache_seconds_saved"] >= 0
+
+
+@pytest.mark.parametrize("settings", [
+    {}, {"ngram_range": (1, 2), "sublinear_tf": True},
+    {"smooth_idf": False, "norm": "l1", "lowercase": False}])
+def test_parallel_fit_transform_matches_sklearn(settings):
+    X, _ = sample_reviews(60)
+    expected = TfidfVectorizer(**settings)
+    E = expected.fit_transform(X)
+
+    fitted, M = train_model.parallel_fit_transform(
+        TfidfVectorizer(**settings), X, workers=2, n_shards=7)
+    assert fitted.vocabulary_ == expected.vocabulary_
+    assert np.array_equal(fitted.idf_, expected.idf_)
+    assert M.shape == E.shape
+    assert np.array_equal(M.indptr, E.indptr)
+    assert np.array_equal(M.indices, E.indices)
+    assert np.array_equal(M.data, E.data)
+    assert (fitted.transform(X[:5]) != expected.transform(X[:5])).nnz == 0
+
+
+def feedback_row(ts, text, label, **extra):
+    return dict({"timestamp": ts, "request_text": text,
+                 "text_hash": f"h-{text}", "predicted_bought": "Positive",
+                 "true_record": label}, **extra)
+
+
+def test_read_new_feedback_resumes_from_checkpoint(tmp_path):
+    log = tmp_path / "prediction_logs.json"
+    rows = [feedback_row(1.0, "great read", "positive"),
+            feedback_row(2.0, "dull", "Negative"),
+            feedback_row(3.0, "warm up", "Positive", source="rewarm"),
+            feedback_row(3.5, "load zzrun1", "Positive", source="loadtest"),
+            feedback_row(4.0, "no label", "")]
+    log.write_text("".join(json.dumps(r) + "\n" for r in rows)
+                   + '{"timestamp": 5.0, "request_te')
+    table = [train_model.feedback_record(feedback_row(2.0, "dull",
+                                                      "Negative")),
+             train_model.feedback_record(feedback_row(2.5, "loved it",
+                                                      "Positive"))]
+
+    def scan(name, since):
+        return [r for r in table if r[1] >= since]
+
+    records, cursor = train_model.read_new_feedback(
+        {}, str(log), "logs", scan=scan)
+    assert [(r[2], r[3]) for r in records] == [
+        ("great read", 1), ("dull", 0), ("loved it", 1)]
+    assert cursor["table_since"] == 2.5
+
+    # only what was appended (and the finished last line) since
+    with open(log, "a") as f:
+        f.write('xt": "late", "true_record": "Positive"}\n')
+    records, cursor = train_model.read_new_feedback(
+        cursor, str(log), "logs", scan=scan)
+    assert [(r[1], r[2]) for r in records] == [(5.0, "late")]
+    assert train_model.read_new_feedback(
+        cursor, str(log), "logs", scan=scan)[0] == []
+
+
+def test_scan_feedback_table_failure_keeps_cursor(tmp_path, monkeypatch):
+    from botocore.exceptions import ClientError
+
+    class FailingTable:
+        # first page arrives, the second one is throttled
+        def scan(self, **kwargs):
+            if "ExclusiveStartKey" in kwargs:
+                error = {"Code": "ProvisionedThroughputExceededException",
+                         "Message": "slow down"}
+                raise ClientError({"Error": error}, "Scan")
+            return {"Items": [feedback_row(9.0, "page one", "Positive")],
+                    "LastEvaluatedKey": {"text_hash": "h-page one"}}
+
+    regions = []
+
+    def fake_connect(region=train_model.DDB_REGION):
+        regions.append(region)
+        return types.SimpleNamespace(Table=lambda name: FailingTable())
+
+    monkeypatch.setattr(train_model, "connect_dynamodb", fake_connect)
+    assert train_model.scan_feedback_table("logs", 1.0) == []
+    assert regions == [train_model.DDB_REGION]
+
+    # the table is read again from the same timestamp next run
+    log = tmp_path / "prediction_logs.json"
+    log.write_text(json.dumps(feedback_row(1.0, "great", "Positive")) + "\n")
+    checkpoint = {"table_since": 1.0, "table_seen": ["h-old"]}
+    records, cursor = train_model.read_new_feedback(checkpoint, str(log),
+                                                    "logs")
+    assert [r[2] for r in records] == ["great"]
+    assert cursor["table_since"] == 1.0
+    assert cursor["table_seen"] == ["h-old"]
+
+
+def test_refresh_main_updates_counts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    X, y = sample_reviews()
+    model = train_model.fit_pipeline(X, y)
+    registry = tmp_path / "registry"
+    registry.mkdir()
+    joblib.dump(model, registry / "purchase_model.pkl")
+    # a stale local checkpoint is not what gets refreshed
+    stale = train_model.build_pipeline().fit(["good", "bad"], [1, 0])
+    joblib.dump(stale, "purchase_model.pkl")
+    counts = model.named_steps["clf"].class_count_.copy()
+    vocabulary = dict(model.named_steps["tfidf"].vocabulary_)
+
+    log = tmp_path / "prediction_logs.json"
+    log.write_text("".join(json.dumps(feedback_row(t, text, label)) + "\n"
+                           for t, (text, label) in enumerate(
+                               [("great story", "Positive"),
+                                ("never again", "Negative"),
+                                ("an unseen word", "Positive")])))
+    monkeypatch.setattr(train_model, "FEEDBACK_LOG", str(log))
+    monkeypatch.setattr(train_model, "FEEDBACK_TABLE", "")
+    monkeypatch.setattr(train_model, "REFRESH_CHECKPOINT",
+                        str(tmp_path / "refresh_checkpoint.json"))
+    monkeypatch.setattr(train_model, "EXPORT_ONNX", False)
+    used = []
+
+    class RefreshRun(DummyRun):
+        def use_artifact(self, name):
+            used.append(name)
+            return types.SimpleNamespace(name="MultinomialNB-artifact:v3",
+                                         download=lambda: str(registry))
+
+    monkeypatch.setattr(train_model, "init_wandb", lambda **kw: RefreshRun())
+    monkeypatch.setattr(train_model.wandb, "finish", lambda: None)
+    logged = []
+
+    class Art:
+        aliases = []
+
+        def wait(self):
+            pass
+
+    def fake_log_model_artifact(run, model_path, model_name, alias,
+                                metadata=None):
+        logged.append((model_path, alias, metadata))
+        return Art()
+
+    monkeypatch.setattr(train_model, "log_model_artifact",
+                        fake_log_model_artifact)
+    monkeypatch.setattr(train_model, "TRAIN_MODE", "refresh")
+    monkeypatch.setattr(train_model, "data_load", None)
+    train_model.main()
+
+    refreshed = joblib.load("purchase_model.pkl")
+    assert refreshed.named_steps["tfidf"].vocabulary_ == vocabulary
+    assert (refreshed.named_steps["clf"].class_count_
+            == counts + [1, 2]).all()
+    assert [(path, alias) for path, alias, _ in logged] == [
+        ("./purchase_model.pkl", "staging")]
+    assert logged[0][2]["refresh"]["refresh_rows"] == 3
+    assert used == ["MultinomialNB-artifact:staging"]
+    assert logged[0][2]["refresh"]["refresh_base"] == \
+        "MultinomialNB-artifact:v3"
+    assert (tmp_path / "purchase_model_mmap").is_dir()
+
+    # nothing new: no run, no new version
+    assert train_model.refresh_main(None, {}, "./purchase_model.pkl") is None
+    assert len(logged) == 1
+
+
+def test_log_model_artifact_adds_exports(tmp_path, monkeypatch):
+    monkeypatch.setattr(train_model.wandb, "Artifact", DummyArtifact)
+    ckpt_path = tmp_path / "purchase_model.pkl"
+    ckpt_path.write_text("model")
+    (tmp_path / "purchase_model_mmap").mkdir()
+    (tmp_path / "purchase_model.onnx").write_text("graph")
+    artifact = train_model.log_model_artifact(
+        DummyRun(), str(ckpt_path), model_name="MultinomialNB",
+        alias="staging")
+    assert artifact.files == [
+        (str(ckpt_path), "purchase_model.pkl"),
+        (str(tmp_path / "purchase_model_mmap"), "purchase_model_mmap"),
+        (str(tmp_path / "purchase_model.onnx"), "purchase_model.onnx")]
+
+
 def test_main(tmp_path, monkeypatch):
     # chdir into tmp_path so that relative paths resolve there
     monkeypatch.chdir(tmp_path)
@@ -148,11 +567,30 @@ def test_main(tmp_path, monkeypatch):
 
     monkeypatch.setattr(train_model, "log_artifact", fake_log_artifact)
 
-    # 6) Stub init_wandb to return our DummyRun
+    # 6) Stub the compaction stage
+    monkeypatch.setattr(train_model, "compaction_curve",
+                        lambda X, y, **kwargs: [])
+    monkeypatch.setattr(train_model, "log_compaction_curve",
+                        lambda run, rows: None)
+    monkeypatch.setattr(
+        train_model, "create_compact_model",
+        lambda path: (str(tmp_path / "purchase_model_compact.pkl"), 3))
+
+    def fake_log_model_artifact(run, model_path, model_name, alias,
+                                metadata=None, file_name=None):
+        called["compact_alias"] = alias
+        called["compact_name"] = model_name
+        called["compact_file_name"] = file_name
+        return Art("compact-art")
+
+    monkeypatch.setattr(train_model, "log_model_artifact",
+                        fake_log_model_artifact)
+
+    # 7) Stub init_wandb to return our DummyRun
     run = DummyRun()
     monkeypatch.setattr(train_model, "init_wandb", lambda **kwargs: run)
 
-    # 7) Stub wandb.finish (so main can call it)
+    # 8) Stub wandb.finish (so main can call it)
     monkeypatch.setattr(train_model.wandb, "finish", lambda: None)
 
     # Execute main()
@@ -173,5 +611,73 @@ def test_main(tmp_path, monkeypatch):
     assert run.summary["registered_aliases"] == "staging"
     assert run.summary["git_commit"] == "deadbeef"
     assert run.summary["data_artifact"] == "ds-art"
+    assert called["compact_alias"] == "compact"
+    assert called["compact_name"] == "MultinomialNB-compact"
+    assert called["compact_file_name"] == "purchase_model.pkl"
+    assert run.summary["compact_n_features"] == 3
+    assert run.summary["feature_cache_misses"] == 0
+
+
+def test_main_registers_stream_model_apart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(train_model, "TRAIN_MODE", "stream")
+    monkeypatch.setattr(train_model, "get_git_commit_hash", lambda: "x")
+    monkeypatch.setattr(train_model, "create_streaming_pipeline",
+                        lambda *args, **kwargs: {"stream_rows": 2})
+    called = {}
+
+    class Art:
+        def __init__(self, name):
+            self.name = name
+            self.aliases = []
+
+        def wait(self):
+            pass
+
+    def fake_log_artifact(run, data_path, model_path, dataset_name,
+                          model_name, alias, metadata=None):
+        called["model_name"] = model_name
+        called["alias"] = alias
+        return Art("ds-art"), Art(f"{model_name}-artifact")
+
+    def no_compaction(*args, **kwargs):
+        raise AssertionError("a stream model is not compacted")
+
+    monkeypatch.setattr(train_model, "log_artifact", fake_log_artifact)
+    monkeypatch.setattr(train_model, "compaction_curve", no_compaction)
+    run = DummyRun()
+    monkeypatch.setattr(train_model, "init_wandb", lambda **kwargs: run)
+    monkeypatch.setattr(train_model.wandb, "finish", lambda: None)
+    train_model.main()
+
+    # not a version of MultinomialNB-artifact, which the backend serves
+    assert called == {"model_name": "MultinomialNB-stream", "alias": "stream"}
+    assert run.summary["model_registered_name"] == \
+        "MultinomialNB-stream-artifact"
+    assert run.summary["registered_aliases"] == "stream"
+    assert run.summary["stream_rows"] == 2
+
+
+def test_main_sweep_mode_skips_training(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(train_model, "TRAIN_MODE", "sweep")
+    X, y = sample_reviews()
+    monkeypatch.setattr(train_model, "data_load", lambda path: None)
+    monkeypatch.setattr(train_model, "split_XY", lambda df: (X, y))
+    called = {}
+
+    def fake_sweep_main(X_arg, y_arg, entity, config):
+        called["rows"] = len(X_arg)
+        called["max_iter"] = config["max_iter"]
+
+    def no_training(*args, **kwargs):
+        raise AssertionError("sweep mode must not train the default model")
+
+    monkeypatch.setattr(train_model, "sweep_main", fake_sweep_main)
+    monkeypatch.setattr(train_model, "init_wandb", no_training)
+    monkeypatch.setattr(train_model, "create_pipeline", no_training)
+    train_model.main()
+    assert called == {"rows": 40, "max_iter": 1000}
+
 
 # pytest -v test_manage.py
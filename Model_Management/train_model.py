@@ -1,14 +1,82 @@
+import copy
+import gzip
+import hashlib
+import importlib.util
 import joblib
+import json
 import os
+import resource
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
 import wandb
 import warnings
+import numpy as np
 import pandas as pd
+import requests
+import scipy.sparse as sp
+import sklearn
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.naive_bayes import MultinomialNB
+from sklearn.feature_extraction.text import (CountVectorizer,
+                                             HashingVectorizer,
+                                             TfidfTransformer,
+                                             TfidfVectorizer)
+from sklearn.naive_bayes import ComplementNB, MultinomialNB
 warnings.filterwarnings('ignore')
 
+# The pickle-free (mmap) and ONNX exports are written by the
+# backend's scoring.py, the module that reads them when serving
+SCORING_PATH = os.environ.get(
+    "SCORING_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "..", "FastAPI_Backend", "scoring.py"))
+# skl2onnx is optional, only needed for EXPORT_ONNX=1
+EXPORT_ONNX = os.environ.get("EXPORT_ONNX", "0") == "1"
+# Compaction: features whose mean log-likelihood shift per document
+# is below the threshold are dropped. The trade-off curve is measured
+# at every threshold in COMPACT_THRESHOLDS, the compacted model is
+# registered as "compact".
+COMPACT_THRESHOLD = float(os.environ.get("COMPACT_THRESHOLD", "1e-5"))
+COMPACT_THRESHOLDS = (0.0, 1e-6, 3e-6, 1e-5, 3e-5, 1e-4, 3e-4)
+# memory: TfidfVectorizer on the whole DataFrame, stream: TRAIN_DATA
+# (review_data.csv or the raw Books.jsonl) in STREAM_CHUNK_SIZE rows,
+# hashed features, running IDF and MultinomialNB.partial_fit;
+# sweep: see below, vectorize: vectorizer_scaling() report only,
+# refresh: see FEEDBACK_LOG below
+TRAIN_MODE = os.environ.get("TRAIN_MODE", "memory")
+TRAIN_DATA = os.environ.get("TRAIN_DATA", "../data/review_data.csv")
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", "50000"))
+STREAM_N_FEATURES = int(os.environ.get("STREAM_N_FEATURES", str(2**20)))
+# processes for fitting TfidfVectorizer on shards of the corpus,
+# 1 fits in this process like sklearn
+VECTORIZE_WORKERS = int(os.environ.get("VECTORIZE_WORKERS",
+                                       str(os.cpu_count() or 1)))
+# fitted vectorizers and their TF-IDF matrices, keyed by the texts and
+# the vectorizer settings; "" turns the cache off
+FEATURE_CACHE_DIR = os.environ.get("FEATURE_CACHE_DIR", "./feature_cache")
+# TRAIN_MODE=sweep: every trial of sweep_grid() in SWEEP_WORKERS
+# processes; the pick is the fastest trial whose accuracy is at least
+# SWEEP_ACCURACY_BAR (default: best accuracy minus SWEEP_TOLERANCE)
+SWEEP_WORKERS = int(os.environ.get("SWEEP_WORKERS", str(os.cpu_count() or 1)))
+SWEEP_ACCURACY_BAR = (float(os.environ["SWEEP_ACCURACY_BAR"])
+                      if os.environ.get("SWEEP_ACCURACY_BAR") else None)
+SWEEP_TOLERANCE = float(os.environ.get("SWEEP_TOLERANCE", "0.01"))
+# TRAIN_MODE=refresh: MultinomialNB.partial_fit on the feedback logged
+# since REFRESH_CHECKPOINT, read from FEEDBACK_LOG and, when set, the
+# DynamoDB table FEEDBACK_TABLE
+FEEDBACK_LOG = os.environ.get("FEEDBACK_LOG",
+                              "../FastAPI_Backend/logs/prediction_logs.json")
+FEEDBACK_TABLE = os.environ.get("FEEDBACK_TABLE", "")
+# region of that table, the variable the backend reads
+DDB_REGION = os.environ.get("AWS_REGION", "us-east-1")
+REFRESH_CHECKPOINT = os.environ.get("REFRESH_CHECKPOINT",
+                                    "./refresh_checkpoint.json")
+FEEDBACK_LABELS = {"Positive": 1, "Negative": 0}
+
 
 # ==============
 # = Init WandB =
@@ -27,7 +95,7 @@ def get_git_commit_hash():
 
 def init_wandb(project_name="Book_Purchase_Intention_Prediction",
                experiment_name=None, entity=None, config=None,
-               save_code=True):
+               save_code=True, group=None):
 
     if entity is None:
         entity = os.environ.get("WANDB_ENTITY", None)
@@ -35,7 +103,7 @@ def init_wandb(project_name="Book_Purchase_Intention_Prediction",
     # Initialize a new W&B run
     run = wandb.init(
         project=project_name, name=experiment_name,
-        entity=entity, config=config, reinit=True)
+        entity=entity, config=config, group=group, reinit=True)
 
     if save_code:
         try:
@@ -57,7 +125,11 @@ def log_artifact(run, data_path, model_path, dataset_name="Amazon Review 2023",
     artifact_data = wandb.Artifact(
         name=f"{dataset_name}-artifact",
         type="dataset", metadata=metadata or {})
-    artifact_data.add_file(data_path)  # add the csv file into artifact
+    if TRAIN_MODE == "stream":
+        # too big to upload: W&B only records the path and checksum
+        artifact_data.add_reference(f"file://{os.path.abspath(data_path)}")
+    else:
+        artifact_data.add_file(data_path)  # add the csv file into artifact
     run.log_artifact(artifact_data)
 
     # Create model artifact
@@ -65,6 +137,13 @@ def log_artifact(run, data_path, model_path, dataset_name="Amazon Review 2023",
         name=f"{model_name}-artifact",
         type="model", metadata=metadata or {})
     artifact_model.add_file(model_path)
+    mmap_dir = mmap_artifact_path(model_path)
+    if os.path.isdir(mmap_dir):
+        # the pickle-free layout travels in the same model version
+        artifact_model.add_dir(mmap_dir, name=os.path.basename(mmap_dir))
+    onnx_path = onnx_artifact_path(model_path)
+    if os.path.exists(onnx_path):
+        artifact_model.add_file(onnx_path)
     run.log_artifact(artifact_model)
     run.link_model(path=model_path,
                    registered_model_name=f"{model_name}-artifact",
@@ -90,27 +169,1005 @@ def split_XY(dataset):
     return X, y
 
 
+# =====================
+# = Pickle-free Model =
+# =====================
+def load_scoring(path=SCORING_PATH):
+    # FastAPI_Backend/scoring.py; the copy already imported by the
+    # backend is reused when both run in one process (tests)
+    if "scoring" in sys.modules:
+        return sys.modules["scoring"]
+    spec = importlib.util.spec_from_file_location("scoring", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["scoring"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+scoring = load_scoring()
+
+
+def mmap_artifact_path(ckpt_path):
+    # ./purchase_model.pkl -> ./purchase_model_mmap
+    return os.path.splitext(ckpt_path)[0] + "_mmap"
+
+
+def save_mmap_artifact(model, directory):
+    """
+    Write the fitted TF-IDF + MultinomialNB pipeline as plain .npy
+    files plus manifest.json with scoring.py's NumpyScorer, so the
+    backend opens it memory-mapped in milliseconds instead of
+    unpickling it. Returns the manifest.
+    """
+    return scoring.NumpyScorer.from_pipeline(model).save_mmap(directory)
+
+
+# ===============
+# = ONNX Export =
+# ===============
+def onnx_artifact_path(ckpt_path):
+    # ./purchase_model.pkl -> ./purchase_model.onnx
+    return os.path.splitext(ckpt_path)[0] + ".onnx"
+
+
+def export_onnx(model, path):
+    # TF-IDF + MultinomialNB graph for the backend's onnxruntime
+    # engine, ImportError without skl2onnx
+    return scoring.export_onnx(model, path)
+
+
+# =======================
+# = Parallel Vectorizer =
+# =======================
+# settings parallel_fit_transform reproduces exactly
+_SHARDABLE = {"min_df": 1, "max_df": 1.0, "max_features": None,
+              "vocabulary": None, "use_idf": True, "analyzer": "word"}
+
+
+def _shard_frequencies(analyzer, texts):
+    # {term: document frequency} in order of first appearance, the
+    # order CountVectorizer assigns its provisional column indices
+    frequencies = {}
+    for text in texts:
+        for term in dict.fromkeys(analyzer(text)):
+            frequencies[term] = frequencies.get(term, 0) + 1
+    return frequencies
+
+
+def _shard_transform(vectorizer, tfidf, rank, texts):
+    # Counts with the final vocabulary, entries of every row in the
+    # order fit_transform stores them (by first appearance in the
+    # corpus), so the l2 norms are summed in the same order
+    counts = CountVectorizer.transform(vectorizer, texts)
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    order = np.lexsort((rank[counts.indices], rows))
+    counts.indices = counts.indices[order]
+    counts.data = counts.data[order]
+    counts.has_sorted_indices = False
+    return tfidf.transform(counts, copy=False)
+
+
+def _shards(texts, n_shards):
+    texts = list(texts)
+    size = -(-len(texts) // max(1, n_shards))
+    return [texts[i:i + size] for i in range(0, len(texts), size)] or [[]]
+
+
+def parallel_fit_transform(vectorizer, texts, workers=VECTORIZE_WORKERS,
+                           n_shards=None):
+    """
+    TfidfVectorizer.fit_transform on `workers` processes: document
+    frequencies per shard, merged into the sorted vocabulary and the
+    IDF, then the shards are transformed in parallel and stacked.
+    Vocabulary, IDF and matrix (values and storage order) are the
+    same as sklearn's. Settings it can not shard fall back to
+    vectorizer.fit_transform.
+    """
+    params = vectorizer.get_params()
+    if workers <= 1 or any(params[k] != v for k, v in _SHARDABLE.items()):
+        return vectorizer, vectorizer.fit_transform(texts)
+    shards = _shards(texts, n_shards or workers * 4)
+    analyzer = vectorizer.build_analyzer()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        partial = list(pool.map(_shard_frequencies,
+                                [analyzer] * len(shards), shards))
+
+        first_seen, df = {}, {}
+        for frequencies in partial:
+            for term, count in frequencies.items():
+                first_seen.setdefault(term, len(first_seen))
+                df[term] = df.get(term, 0) + count
+        terms = sorted(first_seen)
+        vectorizer.vocabulary_ = {t: i for i, t in enumerate(terms)}
+        vectorizer.fixed_vocabulary_ = False
+        rank = np.array([first_seen[t] for t in terms], dtype=np.int64)
+
+        # TfidfTransformer.fit on the merged document frequencies
+        dtype = np.dtype(params["dtype"])
+        dtype = dtype if dtype in (np.float64, np.float32) else np.float64
+        doc_freq = np.array([df[t] for t in terms], dtype=dtype)
+        doc_freq += float(params["smooth_idf"])
+        n_samples = sum(len(shard) for shard in shards)
+        idf = np.full_like(doc_freq, n_samples + int(params["smooth_idf"]),
+                           dtype=dtype)
+        idf /= doc_freq
+        np.log(idf, out=idf)
+        idf += 1.0
+        vectorizer.idf_ = idf
+        tfidf = TfidfTransformer(norm=params["norm"], use_idf=True,
+                                 smooth_idf=params["smooth_idf"],
+                                 sublinear_tf=params["sublinear_tf"])
+        tfidf.idf_ = idf
+        tfidf.n_features_in_ = len(terms)
+
+        parts = list(pool.map(_shard_transform,
+                              [vectorizer] * len(shards),
+                              [tfidf] * len(shards),
+                              [rank] * len(shards), shards))
+    return vectorizer, sp.vstack(parts, format="csr")
+
+
+def vectorizer_scaling(texts, worker_counts, vectorizer_factory=None):
+    # wall time of parallel_fit_transform per worker count, each
+    # checked against sklearn's own fit_transform
+    make = vectorizer_factory or TfidfVectorizer
+    start = time.perf_counter()
+    reference = make().fit_transform(texts)
+    reference_seconds = time.perf_counter() - start
+    rows = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        _, X = parallel_fit_transform(make(), texts, workers=workers)
+        seconds = time.perf_counter() - start
+        same = (X.shape == reference.shape
+                and np.array_equal(X.indptr, reference.indptr)
+                and np.array_equal(X.indices, reference.indices)
+                and np.array_equal(X.data, reference.data))
+        rows.append({"workers": workers, "seconds": seconds,
+                     "speedup": reference_seconds / seconds,
+                     "matches_sklearn": bool(same)})
+        print(f"{workers:>3} workers: {seconds:.1f}s, "
+              f"{reference_seconds / seconds:.2f}x sklearn, "
+              f"matches sklearn: {same}")
+    return rows
+
+
+# =================
+# = Feature Cache =
+# =================
+class FeatureCache:
+    """
+    On-disk Feature Cache
+    One directory per (texts digest, vectorizer settings, sklearn
+    version) with the TF-IDF matrix as CSR .npz, the vocabulary as
+    JSON, the IDF vector and a manifest. A hit rebuilds the fitted
+    vectorizer and skips tokenization. Counts hits, misses and the
+    fit time saved.
+    """
+
+    def __init__(self, directory=FEATURE_CACHE_DIR):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def _settings(vectorizer):
+        # JSON-able settings, None when a callable makes them unkeyable
+        settings = {}
+        for name, value in sorted(vectorizer.get_params().items()):
+            if callable(value) and not isinstance(value, type):
+                return None
+            if name == "dtype":
+                value = np.dtype(value).name
+            elif isinstance(value, tuple):
+                value = list(value)
+            elif isinstance(value, (set, frozenset)):
+                value = sorted(value)
+            settings[name] = value
+        return settings
+
+    def key(self, vectorizer, texts):
+        settings = self._settings(vectorizer)
+        if settings is None or not self.directory:
+            return None
+        data = hashlib.sha256()
+        for text in texts:
+            data.update(str(text).encode("utf-8", "surrogatepass"))
+            data.update(b"\0")
+        spec = json.dumps({"texts": data.hexdigest(),
+                           "vectorizer": type(vectorizer).__name__,
+                           "settings": settings,
+                           "sklearn": sklearn.__version__}, sort_keys=True)
+        return hashlib.sha256(spec.encode()).hexdigest()[:24]
+
+    def fit_transform(self, vectorizer, texts):
+        # (fitted vectorizer, TF-IDF matrix), from disk when cached
+        key = self.key(vectorizer, texts)
+        path = os.path.join(self.directory, key) if key else None
+        if path and os.path.exists(os.path.join(path, "manifest.json")):
+            start = time.perf_counter()
+            with open(os.path.join(path, "manifest.json"),
+                      encoding="utf-8") as f:
+                manifest = json.load(f)
+            with open(os.path.join(path, "vocabulary.json"),
+                      encoding="utf-8") as f:
+                vocabulary = json.load(f)
+            fitted = copy.deepcopy(vectorizer)
+            fitted.vocabulary_ = vocabulary
+            fitted.fixed_vocabulary_ = False
+            fitted.idf_ = np.load(os.path.join(path, "idf.npy"))
+            X = sp.load_npz(os.path.join(path, "features.npz"))
+            self.hits += 1
+            self.seconds_saved += max(
+                0.0, manifest["fit_seconds"] - (time.perf_counter() - start))
+            print(f"Feature cache hit {key}: {X.shape[0]} rows, "
+                  f"{X.shape[1]} features")
+            return fitted, X
+
+        start = time.perf_counter()
+        vectorizer, X = parallel_fit_transform(vectorizer, texts,
+                                               workers=VECTORIZE_WORKERS)
+        fit_seconds = time.perf_counter() - start
+        if path:
+            self.misses += 1
+            # written next to the entry, then renamed: a crashed run
+            # never leaves a half-written entry behind
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.directory)
+            sp.save_npz(os.path.join(tmp, "features.npz"), X.tocsr(),
+                        compressed=False)
+            np.save(os.path.join(tmp, "idf.npy"), vectorizer.idf_)
+            with open(os.path.join(tmp, "vocabulary.json"), "w",
+                      encoding="utf-8") as f:
+                json.dump({t: int(c) for t, c in
+                           vectorizer.vocabulary_.items()}, f)
+            with open(os.path.join(tmp, "manifest.json"), "w",
+                      encoding="utf-8") as f:
+                json.dump({"key": key, "rows": X.shape[0],
+                           "n_features": X.shape[1],
+                           "fit_seconds": fit_seconds,
+                           "settings": self._settings(vectorizer)}, f,
+                          indent=2)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # another run stored the same entry first
+                shutil.rmtree(tmp, ignore_errors=True)
+        return vectorizer, X
+
+    def summary(self):
+        return {"feature_cache_hits": self.hits,
+                "feature_cache_misses": self.misses,
+                "feature_cache_seconds_saved": round(self.seconds_saved, 2)}
+
+
+FEATURE_CACHE = FeatureCache()
+
+
 # ==============
 # = Model and  =
 # = Train Func =
 # ==============
+def build_pipeline():
+    return Pipeline([
+           ('tfidf', TfidfVectorizer()),
+           ('clf', MultinomialNB())
+           ])
+
+
+def fit_pipeline(X, y):
+    # Pipeline.fit, with the TF-IDF step from the feature cache
+    model = build_pipeline()
+    vectorizer, features = FEATURE_CACHE.fit_transform(
+        model.named_steps["tfidf"], X)
+    clf = model.named_steps["clf"].fit(features, y)
+    return Pipeline([("tfidf", vectorizer), ("clf", clf)])
+
+
 def create_pipeline(X, y, ckpt_path):
     # Log dataset info to W&B
     wandb.log({
         "n_samples": len(X)
     })
-    model = Pipeline([
-           ('tfidf', TfidfVectorizer()),
-           ('clf', MultinomialNB())
-           ])
-    model.fit(X, y)
+    model = fit_pipeline(X, y)
     joblib.dump(model, ckpt_path)
-    print("Pretrained weight is saved.")
+    save_exports(model, ckpt_path)
+
+
+def save_exports(model, ckpt_path):
+    # mmap and ONNX exports next to the checkpoint
+    manifest = save_mmap_artifact(model, mmap_artifact_path(ckpt_path))
+    print(f"Pretrained weight is saved, mmap digest {manifest['digest']}.")
+    remove_exports(ckpt_path, mmap=False)
+    if EXPORT_ONNX:
+        try:
+            export_onnx(model, onnx_artifact_path(ckpt_path))
+            print("ONNX model is saved.")
+        except (ImportError, ValueError) as e:
+            print(f"Skip ONNX export: {e}")
+
+
+def remove_exports(ckpt_path, mmap=True):
+    # exports of an earlier run must not be logged with a new model
+    if mmap:
+        shutil.rmtree(mmap_artifact_path(ckpt_path), ignore_errors=True)
+    if os.path.exists(onnx_artifact_path(ckpt_path)):
+        os.remove(onnx_artifact_path(ckpt_path))
+
+
+# ====================
+# = Feedback Refresh =
+# ====================
+def feedback_record(row):
+    # (text_hash, timestamp, text, label) of a logged prediction with
+    # feedback, None for anything else. Records with a `source` are
+    # re-warm items or load test / evaluation traffic, not users.
+    # Older logs call the label true_sentiment.
+    if not isinstance(row, dict) or row.get("source"):
+        return None
+    text = row.get("request_text")
+    label = str(row.get("true_record") or row.get("true_sentiment") or "")
+    label = FEEDBACK_LABELS.get(label.capitalize())
+    if not text or label is None or row.get("timestamp") is None:
+        return None
+    key = row.get("text_hash") or hashlib.sha256(
+        text.encode("utf-8")).hexdigest()
+    return key, float(row["timestamp"]), text, label
+
+
+def read_feedback_log(path, offset=0, inode=None):
+    """
+    Feedback appended to the JSON lines log after byte `offset`.
+    Returns (records, offset after the last complete line, inode).
+    A rotated or truncated log is read from the start; a half
+    written last line is left for the next refresh.
+    """
+    records = []
+    if not os.path.exists(path):
+        return records, 0, None
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_ino != inode or stat.st_size < offset:
+            offset = 0
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                rec = feedback_record(json.loads(line))
+            except (UnicodeDecodeError, ValueError, TypeError):
+                continue
+            if rec is not None:
+                records.append(rec)
+    return records, offset, stat.st_ino
+
+
+def is_ec2_env():
+    try:
+        response = requests.get(
+            "http://169.254.169.254/latest/meta-data/",
+            timeout=0.2)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def connect_dynamodb(region=DDB_REGION):
+    # Same as the backend: the IAM role on EC2 (Learner Lab),
+    # otherwise the AWS_* credentials from the environment
+    import boto3
+    if is_ec2_env():
+        print("Detected EC2 (Learner Lab). Using IAM Role credentials...")
+        return boto3.resource("dynamodb", region_name=region)
+    session = boto3.Session(
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        aws_session_token=os.getenv("AWS_SESSION_TOKEN"),
+        region_name=region)
+    return session.resource("dynamodb")
+
+
+def scan_feedback_table(table_name, since=0.0):
+    # Items of the backend's DynamoDB log table with timestamp >= since.
+    # A filtered scan: fine for an hourly job, not for requests.
+    # A failed scan returns nothing, not the pages read so far: items
+    # come in no time order, so the cursor must not move past them.
+    from boto3.dynamodb.conditions import Attr
+    from botocore.exceptions import BotoCoreError, ClientError
+    from decimal import Decimal
+
+    kwargs = {"FilterExpression": Attr("timestamp").gte(Decimal(str(since)))}
+    records = []
+    try:
+        table = connect_dynamodb().Table(table_name)
+        while True:
+            resp = table.scan(**kwargs)
+            for item in resp.get("Items", []):
+                rec = feedback_record(item)
+                if rec is not None:
+                    records.append(rec)
+            if "LastEvaluatedKey" not in resp:
+                break
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    except (BotoCoreError, ClientError) as e:
+        print(f"[DDB] Feedback scan of {table_name} failed, "
+              f"read it next run: {e}")
+        return []
+    return records
+
+
+def read_new_feedback(checkpoint, log_path=FEEDBACK_LOG,
+                      table_name=FEEDBACK_TABLE, scan=scan_feedback_table):
+    """
+    Feedback logged since `checkpoint`, oldest first, and the
+    checkpoint to save once it is in a registered model. The log
+    file is read from the byte offset it stopped at, the table
+    from the last timestamp seen (items at exactly that timestamp
+    are told apart by text_hash). A record found in both is used
+    once.
+    """
+    cursor = dict(checkpoint)
+    records, cursor["log_offset"], cursor["log_inode"] = read_feedback_log(
+        log_path, checkpoint.get("log_offset", 0),
+        checkpoint.get("log_inode"))
+    if table_name:
+        since = checkpoint.get("table_since", 0.0)
+        seen = set(checkpoint.get("table_seen", []))
+        new = [r for r in scan(table_name, since)
+               if r[1] > since or r[0] not in seen]
+        if new:
+            latest = max(r[1] for r in new)
+            cursor["table_since"] = latest
+            cursor["table_seen"] = sorted(
+                {r[0] for r in new if r[1] == latest}
+                | (seen if latest == since else set()))
+        records += new
+    records = sorted(dict.fromkeys(records), key=lambda r: r[1])
+    return records, cursor
+
+
+def load_checkpoint(path=REFRESH_CHECKPOINT):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(cursor, path=REFRESH_CHECKPOINT):
+    # written next to the file, then renamed
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(dict(cursor, updated_at=time.time()), f, indent=2)
+    os.replace(tmp, path)
+
+
+def refresh_model(model, records):
+    """
+    Update the classifier of a fitted pipeline in place with
+    `records`: the texts go through the fitted (frozen) vectorizer
+    steps, MultinomialNB.partial_fit adds their counts. Accuracy
+    is measured on the records before they are learned.
+    """
+    texts = [r[2] for r in records]
+    y = np.array([r[3] for r in records])
+    features = model[:-1].transform(texts)
+    clf = model[-1]
+    accuracy = float((clf.predict(features) == y).mean())
+    clf.partial_fit(features, y)
+    return {"refresh_rows": len(records),
+            "refresh_positive": int(y.sum()),
+            "refresh_accuracy_before": accuracy,
+            "refresh_from": records[0][1],
+            "refresh_to": records[-1][1]}
+
+
+def refresh_main(entity, config, ckpt_path, model_name="MultinomialNB",
+                 alias="staging"):
+    # new feedback -> partial_fit -> new version of the model artifact
+    start = time.perf_counter()
+    records, cursor = read_new_feedback(load_checkpoint(REFRESH_CHECKPOINT),
+                                        FEEDBACK_LOG, FEEDBACK_TABLE)
+    if not records:
+        print("No new feedback since the last refresh.")
+        return None
+    run = init_wandb(experiment_name=f"{model_name}-Refresh",
+                     entity=entity, config=config, save_code=False)
+    # always the version deployed under `alias`: a local checkpoint
+    # may be from another run, and the result replaces that version
+    base = run.use_artifact(f"{model_name}-artifact:{alias}")
+    model = joblib.load(os.path.join(base.download(),
+                                     os.path.basename(ckpt_path)))
+    stats = refresh_model(model, records)
+    stats["refresh_base"] = base.name
+    joblib.dump(model, ckpt_path)
+    if "tfidf" in model.named_steps:
+        save_exports(model, ckpt_path)
+    else:
+        # hashed pipeline of TRAIN_MODE=stream, no vocabulary
+        remove_exports(ckpt_path)
+    stats["refresh_seconds"] = time.perf_counter() - start
+    artifact_model = log_model_artifact(
+        run, ckpt_path, model_name=model_name, alias=alias,
+        metadata={"refresh": stats})
+    artifact_model.wait()
+    artifact_model.aliases.append(alias)
+    run.summary.update(stats)
+    wandb.finish()
+    save_checkpoint(cursor, REFRESH_CHECKPOINT)
+    print(f"Refreshed {model_name} with {stats['refresh_rows']} rows "
+          f"in {stats['refresh_seconds']:.1f}s, accuracy on them before "
+          f"the update {stats['refresh_accuracy_before']:.4f}.")
+    return stats
+
+
+# ======================
+# = Streaming Training =
+# ======================
+def iter_chunks(path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield (texts, labels) of at most `chunk_size` reviews at a time
+    from review_data.csv, or from the raw Books.jsonl(.gz) filtered
+    and labeled the way read_data.py does. Labels: Positive 1.
+    """
+    if not path.endswith((".jsonl", ".jsonl.gz")):
+        for df in pd.read_csv(path, chunksize=chunk_size):
+            X, y = split_XY(df.dropna(subset=["text"]))
+            known = y.notna()
+            yield X[known].tolist(), y[known].to_numpy(dtype=np.int64)
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    texts, labels = [], []
+    with opener(path, "rt", encoding="utf-8") as fp:
+        for line in fp:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            buy = row.get("verified_purchase")
+            if not row.get("title") or not row.get("text") or buy is None:
+                continue
+            texts.append(row["title"] + ". " + row["text"])
+            labels.append(1 if buy == 1 else 0)
+            if len(texts) == chunk_size:
+                yield texts, np.array(labels, dtype=np.int64)
+                texts, labels = [], []
+    if texts:
+        yield texts, np.array(labels, dtype=np.int64)
+
+
+class DocumentFrequencies:
+    """
+    Running document frequency of every hashed feature. idf() is
+    TfidfVectorizer's smooth IDF over all documents seen so far.
+    """
+
+    def __init__(self, n_features):
+        self.df = np.zeros(n_features, dtype=np.int64)
+        self.n_docs = 0
+
+    def update(self, counts):
+        # counts: CSR from HashingVectorizer, one entry per term
+        self.df += np.bincount(counts.indices, minlength=len(self.df))
+        self.n_docs += counts.shape[0]
+
+    def idf(self):
+        return np.log((1 + self.n_docs) / (1 + self.df)) + 1.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def create_streaming_pipeline(data_path, ckpt_path,
+                              chunk_size=STREAM_CHUNK_SIZE,
+                              n_features=STREAM_N_FEATURES, alpha=1.0):
+    """
+    Out-of-core training: every chunk is hashed, counted into the
+    document frequencies, weighted with the IDF so far and fed to
+    MultinomialNB.partial_fit. Memory depends on chunk_size and
+    n_features, not on the number of rows. Early chunks see an IDF
+    from fewer documents; the saved pipeline has the final one.
+    """
+    hasher = HashingVectorizer(n_features=n_features, alternate_sign=False,
+                               norm=None)
+    frequencies = DocumentFrequencies(n_features)
+    tfidf = TfidfTransformer()
+    tfidf.n_features_in_ = n_features
+    clf = MultinomialNB(alpha=alpha)
+    rows, chunks = 0, 0
+    start = time.perf_counter()
+    for texts, labels in iter_chunks(data_path, chunk_size):
+        counts = hasher.transform(texts)
+        frequencies.update(counts)
+        tfidf.idf_ = frequencies.idf()
+        clf.partial_fit(tfidf.transform(counts), labels, classes=[0, 1])
+        rows += len(texts)
+        chunks += 1
+        elapsed = time.perf_counter() - start
+        wandb.log({"stream/rows": rows,
+                   "stream/rows_per_sec": rows / elapsed,
+                   "stream/peak_rss_mb": peak_rss_mb()})
+        print(f"{rows} rows, {rows / elapsed:.0f} rows/sec, "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+    if rows == 0:
+        raise ValueError(f"No training rows in {data_path}")
+
+    model = Pipeline([("hashing", hasher), ("idf", tfidf), ("clf", clf)])
+    joblib.dump(model, ckpt_path)
+    # the backend's numpy / mmap / ONNX engines need a vocabulary,
+    # this model is served by sklearn
+    remove_exports(ckpt_path)
+    elapsed = time.perf_counter() - start
+    stats = {"stream_rows": rows, "stream_chunks": chunks,
+             "stream_seconds": elapsed,
+             "stream_rows_per_sec": rows / elapsed,
+             "stream_peak_rss_mb": peak_rss_mb()}
+    print(f"Pretrained weight is saved, {rows} rows in {elapsed:.1f}s.")
+    return stats
+
+
+# =========================
+# = Hyperparameter Sweep  =
+# =========================
+def sweep_grid(alphas=(0.1, 0.3, 1.0, 3.0), ngram_ranges=((1, 1), (1, 2)),
+               Cs=(0.3, 1.0, 3.0)):
+    # one dict per trial; "ngram_range" picks the shared features
+    trials = []
+    for ngram_range in ngram_ranges:
+        for alpha in alphas:
+            trials.append({"model": "MultinomialNB", "alpha": alpha,
+                           "ngram_range": ngram_range})
+            trials.append({"model": "ComplementNB", "alpha": alpha,
+                           "ngram_range": ngram_range})
+        for C in Cs:
+            trials.append({"model": "LogisticRegression", "C": C,
+                           "ngram_range": ngram_range})
+        trials.append({"model": "SGDClassifier", "alpha": 1e-5,
+                       "ngram_range": ngram_range})
+    return trials
+
+
+def make_classifier(trial, max_iter=1000, random_state=42):
+    name = trial["model"]
+    if name == "MultinomialNB":
+        return MultinomialNB(alpha=trial["alpha"])
+    if name == "ComplementNB":
+        return ComplementNB(alpha=trial["alpha"])
+    if name == "LogisticRegression":
+        return LogisticRegression(C=trial["C"], solver="liblinear",
+                                  max_iter=max_iter)
+    if name == "SGDClassifier":
+        return SGDClassifier(loss="hinge", alpha=trial["alpha"],
+                             max_iter=max_iter, random_state=random_state)
+    raise ValueError(f"Unknown model {name!r}")
+
+
+def trial_name(trial):
+    params = ",".join(f"{k}={v}" for k, v in trial.items()
+                      if k not in ("model", "ngram_range"))
+    low, high = trial["ngram_range"]
+    return f"{trial['model']}({params},ngram={low}-{high})"
+
+
+def save_features(directory, vectorizer, X_train, X_test):
+    # CSR arrays as plain .npy, so every worker memory-maps the
+    # same pages instead of unpickling its own copy
+    os.makedirs(directory, exist_ok=True)
+    for split, X in (("train", X_train), ("test", X_test)):
+        X = sp.csr_matrix(X)
+        for part in ("data", "indices", "indptr"):
+            np.save(os.path.join(directory, f"{split}_{part}.npy"),
+                    getattr(X, part))
+        np.save(os.path.join(directory, f"{split}_shape.npy"),
+                np.array(X.shape))
+    joblib.dump(vectorizer, os.path.join(directory, "vectorizer.pkl"))
+
+
+def load_features(directory, split, mmap_mode="r"):
+    parts = [np.load(os.path.join(directory, f"{split}_{part}.npy"),
+                     mmap_mode=mmap_mode)
+             for part in ("data", "indices", "indptr")]
+    shape = tuple(np.load(os.path.join(directory, f"{split}_shape.npy")))
+    return sp.csr_matrix(tuple(parts), shape=shape, copy=False)
+
+
+# per worker process: features directory -> (X_train, X_test, vectorizer)
+_FEATURES = {}
+
+
+def _shared_features(directory):
+    if directory not in _FEATURES:
+        _FEATURES[directory] = (
+            load_features(directory, "train"),
+            load_features(directory, "test"),
+            joblib.load(os.path.join(directory, "vectorizer.pkl")))
+    return _FEATURES[directory]
+
+
+def run_trial(trial, directory, y_train, y_test, texts, max_iter=1000):
+    """
+    Fit and score one trial on the shared features of its n-gram
+    range. Returns fit seconds, accuracy and the median latency of
+    vectorizing and predicting one text.
+    """
+    X_train, X_test, vectorizer = _shared_features(directory)
+    clf = make_classifier(trial, max_iter)
+    start = time.perf_counter()
+    clf.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    accuracy = float(np.mean(clf.predict(X_test) == y_test))
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        clf.predict(vectorizer.transform([text]))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {"trial": trial_name(trial), "params": trial,
+            "fit_seconds": fit_seconds, "accuracy": accuracy,
+            "latency_ms": float(np.median(latencies)),
+            "n_features": X_train.shape[1]}
+
+
+def pick_trial(results, accuracy_bar=None, tolerance=SWEEP_TOLERANCE):
+    # fastest trial that meets the bar
+    if accuracy_bar is None:
+        accuracy_bar = max(r["accuracy"] for r in results) - tolerance
+    passing = [r for r in results if r["accuracy"] >= accuracy_bar]
+    return min(passing, key=lambda r: r["latency_ms"]), accuracy_bar
+
+
+def run_sweep(X, y, trials=None, workers=SWEEP_WORKERS, test_size=0.2,
+              random_state=42, max_iter=1000, n_latency=200,
+              accuracy_bar=SWEEP_ACCURACY_BAR, log_trial=None):
+    """
+    Vectorize once per n-gram range (fit on the train split), then
+    train and score every trial in a process pool on the shared
+    read-only features. log_trial(result) runs in this process as
+    each trial finishes. Returns (results, pick, accuracy_bar).
+    """
+    trials = trials or sweep_grid()
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=test_size, random_state=random_state, stratify=y)
+    y_train = np.asarray(y_train)
+    y_test = np.asarray(y_test)
+    texts = list(X_test[:n_latency])
+    root = tempfile.mkdtemp(prefix="sweep_")
+    directories = {}
+    try:
+        for ngram_range in sorted({tuple(t["ngram_range"]) for t in trials}):
+            start = time.perf_counter()
+            vectorizer = TfidfVectorizer(ngram_range=ngram_range)
+            vectorizer, train = FEATURE_CACHE.fit_transform(vectorizer,
+                                                            X_train)
+            directory = os.path.join(root, f"ngram_{ngram_range[0]}_"
+                                           f"{ngram_range[1]}")
+            save_features(directory, vectorizer, train,
+                          vectorizer.transform(X_test))
+            directories[ngram_range] = directory
+            print(f"Vectorized ngram_range={ngram_range}: "
+                  f"{train.shape[1]} features in "
+                  f"{time.perf_counter() - start:.1f}s")
+
+        results = []
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [pool.submit(run_trial, trial,
+                                   directories[tuple(trial["ngram_range"])],
+                                   y_train, y_test, texts, max_iter)
+                       for trial in trials]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(f"{result['trial']}: accuracy "
+                      f"{result['accuracy']:.4f}, fit "
+                      f"{result['fit_seconds']:.2f}s, latency "
+                      f"{result['latency_ms']:.3f} ms")
+                if log_trial is not None:
+                    log_trial(result)
+        print(f"{len(trials)} trials in {time.perf_counter() - start:.1f}s "
+              f"on {workers} workers")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    pick, accuracy_bar = pick_trial(results, accuracy_bar)
+    return results, pick, accuracy_bar
+
+
+def log_sweep_trial(result, entity=None, group=None, config=None):
+    # one W&B run per trial, grouped by sweep
+    run = init_wandb(experiment_name=result["trial"], entity=entity,
+                     config={**(config or {}), **result["params"]},
+                     save_code=False, group=group)
+    run.log({"accuracy": result["accuracy"],
+             "fit_seconds": result["fit_seconds"],
+             "latency_ms": result["latency_ms"],
+             "n_features": result["n_features"]})
+    run.summary.update({k: result[k] for k in
+                        ("accuracy", "fit_seconds", "latency_ms")})
+    run.finish()
+
+
+# ====================
+# = Model Compaction =
+# ====================
+def compact_artifact_path(ckpt_path):
+    # ./purchase_model.pkl -> ./purchase_model_compact.pkl
+    stem, ext = os.path.splitext(ckpt_path)
+    return f"{stem}_compact{ext}"
+
+
+def feature_contribution(model):
+    # Mean shift of the class log-likelihoods a feature causes per
+    # training document: its tf-idf mass per document times the
+    # spread of its log-probabilities across the classes
+    clf = model.named_steps["clf"]
+    flp = clf.feature_log_prob_
+    mass = clf.feature_count_.sum(axis=0) / clf.class_count_.sum()
+    return mass * (flp.max(axis=0) - flp.min(axis=0))
+
+
+def compact_model(model, threshold, dtype=np.float32):
+    """
+    Copy of the fitted pipeline without the features below
+    `threshold` and with the IDF vector and the NB weights in
+    `dtype`. Dropped terms are treated as unknown words.
+    """
+    vec = model.named_steps["tfidf"]
+    clf = model.named_steps["clf"]
+    keep = np.flatnonzero(feature_contribution(model) >= threshold)
+    terms = vec.get_feature_names_out()[keep]
+
+    # same settings with a fixed vocabulary, idf_ set through its
+    # public setter: nothing is refitted
+    new_vec = TfidfVectorizer(**dict(
+        vec.get_params(), dtype=dtype,
+        vocabulary={term: i for i, term in enumerate(terms)}))
+    new_vec.idf_ = vec.idf_[keep].astype(dtype)
+
+    new_clf = copy.deepcopy(clf)
+    new_clf.feature_count_ = clf.feature_count_[:, keep].astype(dtype)
+    new_clf.feature_log_prob_ = clf.feature_log_prob_[:, keep].astype(dtype)
+    new_clf.n_features_in_ = len(keep)
+    return Pipeline([("tfidf", new_vec), ("clf", new_clf)])
+
+
+def measure_model(model, X_test, y_test, reference=None, n_latency=200):
+    # size on disk, load time, per-request latency and accuracy
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model.pkl")
+        joblib.dump(model, path)
+        mmap_dir = mmap_artifact_path(path)
+        save_mmap_artifact(model, mmap_dir)
+        start = time.perf_counter()
+        joblib.load(path)
+        load_ms = (time.perf_counter() - start) * 1000
+        pickle_mb = os.path.getsize(path) / 2**20
+        mmap_mb = sum(os.path.getsize(os.path.join(mmap_dir, f))
+                      for f in os.listdir(mmap_dir)) / 2**20
+    texts = list(X_test[:n_latency])
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        model.predict([text])
+        latencies.append((time.perf_counter() - start) * 1000)
+    pred = model.predict(X_test)
+    row = {"n_features": len(model.named_steps["tfidf"].vocabulary_),
+           "pickle_mb": pickle_mb,
+           "mmap_mb": mmap_mb,
+           "load_ms": load_ms,
+           "latency_ms": float(np.median(latencies)),
+           "accuracy": float(np.mean(pred == np.asarray(y_test)))}
+    if reference is not None:
+        row["agreement"] = float(np.mean(pred == reference))
+    return row
+
+
+def compaction_curve(X, y, thresholds=COMPACT_THRESHOLDS, test_size=0.2,
+                     random_state=42):
+    """
+    Fit on a train split and measure the full float64 model and
+    every threshold on the held-out split. One row per model.
+    """
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=test_size, random_state=random_state, stratify=y)
+    model = fit_pipeline(X_train, y_train)
+    reference = model.predict(X_test)
+    full = measure_model(model, X_test, y_test, reference)
+    full.update(threshold=None, dtype="float64")
+    rows = [full]
+    for threshold in thresholds:
+        row = measure_model(compact_model(model, threshold),
+                            X_test, y_test, reference)
+        row.update(threshold=threshold, dtype="float32")
+        rows.append(row)
+    return rows
+
+
+def log_compaction_curve(run, rows):
+    columns = ["threshold", "dtype", "n_features", "pickle_mb", "mmap_mb",
+               "load_ms", "latency_ms", "accuracy", "agreement"]
+    table = wandb.Table(columns=columns,
+                        data=[[row.get(c) for c in columns] for row in rows])
+    run.log({
+        "compaction/curve": table,
+        "compaction/accuracy_vs_features": wandb.plot.line(
+            table, "n_features", "accuracy",
+            title="Accuracy vs. kept features"),
+        "compaction/accuracy_vs_size": wandb.plot.line(
+            table, "pickle_mb", "accuracy",
+            title="Accuracy vs. model size (MB)"),
+        "compaction/latency_vs_features": wandb.plot.line(
+            table, "n_features", "latency_ms",
+            title="Per-request latency (ms) vs. kept features")})
+
+
+def create_compact_model(ckpt_path, threshold=COMPACT_THRESHOLD):
+    # compact the trained checkpoint, written next to it with its own
+    # pickle-free layout; returns the path and the kept feature count
+    model = compact_model(joblib.load(ckpt_path), threshold)
+    compact_path = compact_artifact_path(ckpt_path)
+    joblib.dump(model, compact_path)
+    save_mmap_artifact(model, mmap_artifact_path(compact_path))
+    n_features = len(model.named_steps["tfidf"].vocabulary_)
+    print(f"Compact model with {n_features} features is saved.")
+    return compact_path, n_features
+
+
+def log_model_artifact(run, model_path, model_name="NB", alias="compact",
+                       metadata=None, file_name=None):
+    # A version of the model artifact `model_name`-artifact. file_name
+    # stores the checkpoint and its mmap and ONNX exports under the
+    # names the backend loads (purchase_model.pkl, ...).
+    artifact_model = wandb.Artifact(
+        name=f"{model_name}-artifact",
+        type="model", metadata=metadata or {})
+    file_name = file_name or os.path.basename(model_path)
+    artifact_model.add_file(model_path, name=file_name)
+    mmap_dir = mmap_artifact_path(model_path)
+    if os.path.isdir(mmap_dir):
+        artifact_model.add_dir(
+            mmap_dir, name=os.path.basename(mmap_artifact_path(file_name)))
+    onnx_path = onnx_artifact_path(model_path)
+    if onnx_path != model_path and os.path.exists(onnx_path):
+        artifact_model.add_file(onnx_path,
+                                name=onnx_artifact_path(file_name))
+    run.log_artifact(artifact_model)
+    run.link_model(path=model_path,
+                   registered_model_name=f"{model_name}-artifact",
+                   aliases=[alias])
+    return artifact_model
 
 
 # =================
 # = Main Workflow =
 # =================
+def sweep_main(X, y, entity, config):
+    # every trial as its own run, then one run with the table and pick
+    group = f"sweep-{time.strftime('%Y%m%d-%H%M%S')}"
+    results, pick, accuracy_bar = run_sweep(
+        X, y, test_size=config["test_size"],
+        random_state=config["random_state"], max_iter=config["max_iter"],
+        log_trial=lambda result: log_sweep_trial(result, entity, group,
+                                                 config))
+    run = init_wandb(experiment_name=f"{group}-summary", entity=entity,
+                     config=config, save_code=False, group=group)
+    columns = ["trial", "accuracy", "fit_seconds", "latency_ms",
+               "n_features"]
+    run.log({"sweep/trials": wandb.Table(
+        columns=columns, data=[[r[c] for c in columns] for r in results])})
+    run.summary.update({"accuracy_bar": accuracy_bar,
+                        "pick": pick["trial"],
+                        "pick_accuracy": pick["accuracy"],
+                        "pick_latency_ms": pick["latency_ms"],
+                        **FEATURE_CACHE.summary()})
+    wandb.finish()
+    print(f"Fastest trial with accuracy >= {accuracy_bar:.4f}: "
+          f"{pick['trial']} ({pick['accuracy']:.4f}, "
+          f"{pick['latency_ms']:.3f} ms)")
+    return results, pick
+
+
 def main():
     # Prepare info for WandB
     entity = "jsfoggy"
@@ -130,10 +1187,28 @@ def main():
     # promote_to_production_threshold = 0.9
 
     # Load data and run model
-    file_path = '../data/review_data.csv'
+    file_path = TRAIN_DATA
     ckpt_path = './purchase_model.pkl'
-    movie_reviews = data_load(file_path)
-    X, y = split_XY(movie_reviews)
+    if TRAIN_MODE == "refresh":
+        # only the feedback since the last refresh, not the dataset
+        refresh_main(entity, config, ckpt_path)
+        return
+    stream = TRAIN_MODE == "stream"
+    if stream:
+        # read chunk by chunk inside the run
+        config.update({"train_mode": "stream",
+                       "chunk_size": STREAM_CHUNK_SIZE,
+                       "n_features": STREAM_N_FEATURES})
+    else:
+        movie_reviews = data_load(file_path)
+        X, y = split_XY(movie_reviews)
+    if TRAIN_MODE == "sweep":
+        sweep_main(X, y, entity, config)
+        return
+    if TRAIN_MODE == "vectorize":
+        # scaling of the sharded TF-IDF fit, 1 to VECTORIZE_WORKERS
+        vectorizer_scaling(X, range(1, max(1, VECTORIZE_WORKERS) + 1))
+        return
     models = {
         "MultinomialNB": lambda config: "create_pipeline(X,y)"
     }
@@ -146,7 +1221,17 @@ def main():
 
         run.config.update({"model_name": model_name})
 
-        create_pipeline(X, y, ckpt_path)
+        if stream:
+            run.summary.update(create_streaming_pipeline(
+                file_path, ckpt_path, alpha=config["alpha"]))
+        else:
+            create_pipeline(X, y, ckpt_path)
+        # A stream-trained model has no vocabulary, so no mmap or
+        # ONNX export: it is registered under its own name, never as
+        # a version of MultinomialNB-artifact that the backend serves
+        registered_name, alias = run.config["model_name"], "staging"
+        if stream:
+            registered_name, alias = f"{registered_name}-stream", "stream"
         # Promote to Staging or Production
         # aliases = ["latest", "staging"]
         # if metrics["accuracy"] >= promote_to_production_threshold:
@@ -154,22 +1239,54 @@ def main():
         artifact_data, artifact_model = log_artifact(
             run, data_path=file_path, model_path=ckpt_path,
             dataset_name="Amazon_Review_2023",
-            model_name=run.config["model_name"],
-            alias="staging", metadata=None)
+            model_name=registered_name,
+            alias=alias, metadata=None)
 
         # Promote to Staging or Production
         artifact_data.wait()
         artifact_data.aliases.append("staging")
         artifact_model.wait()
         # use "production" or aliases when we officially run model
-        artifact_model.aliases.append("staging")
-        print("Model registered and promoted to 'staging'.")
+        artifact_model.aliases.append(alias)
+        print(f"Model registered and promoted to '{alias}'.")
 
         run.summary["model_registered_name"] = f"{artifact_model.name}"
-        run.summary["registered_aliases"] = "staging"  # aliases
+        run.summary["registered_aliases"] = alias  # aliases
         run.summary["git_commit"] = git_hash
         run.summary["data_artifact"] = f"{artifact_data.name}"
 
+        # The ONNX model (also inside the model version above) as its
+        # own artifact, for consumers that only run onnxruntime
+        onnx_path = onnx_artifact_path(ckpt_path)
+        if EXPORT_ONNX and os.path.exists(onnx_path):
+            artifact_onnx = log_model_artifact(
+                run, onnx_path, model_name=f"{run.config['model_name']}-onnx",
+                alias="staging", metadata={"opset": scoring.ONNX_OPSET})
+            run.summary["onnx_artifact"] = f"{artifact_onnx.name}"
+
+        # Compaction: trade-off curve on a held-out split, then the
+        # compacted checkpoint registered under its own alias. Needs
+        # the data in memory and a vocabulary, so not when streaming.
+        if not stream:
+            log_compaction_curve(run, compaction_curve(
+                X, y, test_size=config["test_size"],
+                random_state=config["random_state"]))
+            compact_path, n_features = create_compact_model(ckpt_path)
+            # Its own artifact, stored under the file names of the full
+            # model: a version of MultinomialNB-artifact would move
+            # `latest` (what the backend serves) to the compact model
+            artifact_compact = log_model_artifact(
+                run, compact_path,
+                model_name=f"{run.config['model_name']}-compact",
+                alias="compact", file_name=os.path.basename(ckpt_path),
+                metadata={"threshold": COMPACT_THRESHOLD,
+                          "n_features": n_features, "dtype": "float32"})
+            artifact_compact.wait()
+            artifact_compact.aliases.append("compact")
+            run.summary["compact_threshold"] = COMPACT_THRESHOLD
+            run.summary["compact_n_features"] = n_features
+        run.summary.update(FEATURE_CACHE.summary())
+
         wandb.finish()
         print(f"Experiment for {model_name} completed!\n")
 
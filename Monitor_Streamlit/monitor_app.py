@@ -1,6 +1,7 @@
 import boto3
 import os
 import requests
+import sqlite3
 import pandas as pd
 import plotly.express as px
 import streamlit as st
@@ -15,6 +16,10 @@ from sklearn.metrics import precision_score
 
 DDB_TABLE_NAME = os.environ.get("DDB_TABLE", "Backend_Log_Cache")
 DDB_REGION = os.environ.get("AWS_REGION", "us-east-1")
+# where the backend keeps its logs: dynamodb or sqlite, the same
+# variable the backend reads
+STORE_BACKEND = os.environ.get("STORE_BACKEND", "dynamodb")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "./logs/cache.db")
 
 
 # ================================
@@ -126,11 +131,14 @@ def log_dynamodb_caches2(table=None):
       texts: list of request_text
       preds: list of predicted_bought
       true_label: list of true_label (capitalized')
+    Rows tagged with a traffic source (load tests, replays,
+    benchmarks) are skipped.
     """
     expr_names = {"#r": "request_text",
                   "#p": "predicted_bought",
-                  "#t": "true_record"}
-    projection = ", ".join(expr_names.keys())  # "#r, #p, #t"
+                  "#t": "true_record",
+                  "#s": "source"}
+    projection = ", ".join(expr_names.keys())  # "#r, #p, #t, #s"
     scan_kwargs = {
         "ProjectionExpression": projection,
         "ExpressionAttributeNames": expr_names,
@@ -140,6 +148,8 @@ def log_dynamodb_caches2(table=None):
         resp = table.scan(**scan_kwargs)
         items = resp.get("Items", [])
         for it in items:
+            if it.get("source"):
+                continue
             texts.append(it.get("request_text"))
             preds.append(it.get("predicted_bought").capitalize())
             ts = it.get("true_record")
@@ -150,6 +160,8 @@ def log_dynamodb_caches2(table=None):
             resp = table.scan(**scan_kwargs)
             items = resp.get("Items", [])
             for it in items:
+                if it.get("source"):
+                    continue
                 texts.append(it.get("request_text"))
                 preds.append(it.get("predicted_bought").capitalize())
                 ts = it.get("true_record")
@@ -168,6 +180,41 @@ def log_dynamodb_caches2(table=None):
     return texts, preds, true_recd
 
 
+# =================
+# = Get Variables =
+# = From SQLite   =
+# =================
+def log_sqlite_caches(path=SQLITE_PATH):
+    """
+    Read the backend's SQLite store (STORE_BACKEND=sqlite) and
+    return the same three lists as log_dynamodb_caches2, without
+    rows tagged with a traffic source. Opened read-only; the WAL
+    journal lets the backend keep writing.
+    """
+    if not os.path.exists(path):
+        st.error(f"[SQLite] log store not found at {path}")
+        return [], [], []
+    texts, preds, true_recd = [], [], []
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("SELECT request_text, predicted_bought, "
+                                "true_record FROM cache WHERE "
+                                "json_extract(item, '$.source') IS NULL"
+                                ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        st.error(f"[SQLite] read error: {e}")
+        print(f"[SQLite] read error: {e}")
+        return [], [], []
+    for text, pred, ts in rows:
+        texts.append(text)
+        preds.append((pred or "").capitalize())
+        true_recd.append(ts.capitalize() if isinstance(ts, str) else ts)
+    return texts, preds, true_recd
+
+
 # =====================
 # = Load Book Reviews =
 # =====================
@@ -198,9 +245,12 @@ def main():
     # 3. Load the Log and Book Review data
     st.header("1. Loading Log and Book Review Data")
 
-    load_table = ensure_table(create_if_missing=True)
-    print("Table status:", load_table.table_status)
-    texts, preds, true_sent = log_dynamodb_caches2(table=load_table)
+    if STORE_BACKEND == "sqlite":
+        texts, preds, true_sent = log_sqlite_caches(SQLITE_PATH)
+    else:
+        load_table = ensure_table(create_if_missing=True)
+        print("Table status:", load_table.table_status)
+        texts, preds, true_sent = log_dynamodb_caches2(table=load_table)
 
     st.write(f"Finish DataLoading. Loaded {len(texts)} log entries.")
     text_len = [len(t) for t in texts]
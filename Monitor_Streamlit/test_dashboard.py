@@ -1,6 +1,7 @@
 # tests/test_streamlit_launch.py
 import monitor_app
 import pytest
+import sqlite3
 import types
 from botocore.exceptions import ClientError
 from monitor_app import main, ensure_table
@@ -92,4 +93,44 @@ def test_main(monkeypatch):
     except Exception as exc:
         pytest.fail(f"Calling main() raised an exception: {exc}")
 
+
+def test_log_sqlite_caches(tmp_path):
+    # same table layout as the backend's SQLiteStore
+    path = str(tmp_path / "cache.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE cache (text_hash TEXT PRIMARY KEY, "
+                 "timestamp REAL, request_text TEXT, predicted_bought TEXT,"
+                 " true_record TEXT, model_version TEXT, item TEXT)")
+    conn.execute("INSERT INTO cache VALUES "
+                 "('h1', 1.0, 'Nice book.', 'Positive', 'positive', 'v1',"
+                 " '{}')")
+    conn.execute("INSERT INTO cache VALUES "
+                 "('h2', 2.0, 'Load test.', 'Negative', NULL, 'v1',"
+                 " '{\"source\": \"loadtest\"}')")
+    conn.commit()
+    conn.close()
+
+    texts, preds, true_recd = monitor_app.log_sqlite_caches(path)
+    assert (texts, preds, true_recd) == (["Nice book."], ["Positive"],
+                                         ["Positive"])
+    assert monitor_app.log_sqlite_caches(str(tmp_path / "none.db")) == \
+        ([], [], [])
+
+
+def test_log_dynamodb_caches2_skips_tagged_traffic():
+    class ScanTable:
+        def scan(self, **kwargs):
+            self.kwargs = kwargs
+            return {"Items": [
+                {"request_text": "Nice book.", "predicted_bought": "positive",
+                 "true_record": "positive"},
+                {"request_text": "Load test.", "predicted_bought": "negative",
+                 "source": "loadtest"}]}
+
+    table = ScanTable()
+    texts, preds, true_recd = monitor_app.log_dynamodb_caches2(table)
+    assert (texts, preds, true_recd) == (["Nice book."], ["Positive"],
+                                         ["Positive"])
+    assert table.kwargs["ExpressionAttributeNames"]["#s"] == "source"
+
 # pytest -v test_dashboard.py